@@ -0,0 +1,182 @@
+# coding: utf-8
+
+# # Benchmark of the pipeline that prepares the Personality Disorder data for Gephi
+
+# ## Overview of the code
+#
+# This code times each stage of <em>Gephi_Input_files_from_PD_data_v6.py</em> on synthetic data (from <em>Generate_synthetic_PD_data.py</em>) of increasing size, so that we can see how the pipeline behaves as the data grows, and compare one version of the pipeline with another.
+#
+# For each size in <em>benchmark_info['SIZES']</em> (10<sup>4</sup> to 10<sup>8</sup> rows) a synthetic input file is created (and kept, to be used again), and the stages are run in turn:
+#
+# 1. Reading and preparing the data: <em>read_data()</em>, <em>clean_data()</em>, <em>calculate_LoS()</em>, <em>delete_zero_LoS()</em>, <em>sort_data()</em>, <em>add_one_OOA_node_column()</em>
+# 2. The whole network: <em>update_dictionary()</em>, <em>output_SM_file()</em>, <em>output_Edge_file()</em>, <em>output_Node_file()</em>
+# 3. The subgroup networks for Locality_Edit (representing the removed data) and Cluster (not representing the removed data), looping through the categories (<em>create_network_data_for_subgroup()</em>) and in one pass (<em>create_network_data_for_subgroup_single_pass()</em>)
+# 4. The whole network and the Locality_Edit networks from the input file in chunks (<em>create_networks_streaming()</em>)
+#
+# The stages in 1 to 3 hold all of the data in memory, and are only run up to <em>benchmark_info['MAXROWS']</em> rows (the looping through the categories only up to <em>benchmark_info['LOOP_MAXROWS']</em> rows, as it is slow).  The streaming stage is run for every size.  A stage that runs out of memory is recorded as failed, and the next size is started.
+#
+# For each stage the wall time, CPU time and peak resident set size (RSS) are recorded.  The results are added to the csv file <em>benchmark_info['RESULTS']</em>, a row per (size, stage), with the version of the pipeline (a hash of its code) so that the results of two versions can be compared.
+#
+# Run with the largest size to run as an argument, for example: <em>python Benchmark_PD_pipeline.py 1000000</em>
+
+# In[ ]:
+
+import datetime
+import os
+import platform
+import sys
+import time
+
+import pandas as pd
+
+import Gephi_Input_files_from_PD_data_v6 as pipeline
+import Generate_synthetic_PD_data as generator
+
+
+# ## Function set_dictionary_for_benchmark()
+# The settings for the benchmark
+
+# In[ ]:
+
+
+def set_dictionary_for_benchmark():
+    """Sets the directory (benchmark_info) that contains the settings for the benchmark"""
+
+    benchmark_info = {"SIZES" : [10**4, 10**5, 10**6, 10**7, 10**8], #number of rows of synthetic data
+                      "MAXROWS" : 10**7, #largest size to run the in-memory stages for
+                      "LOOP_MAXROWS" : 10**6, #largest size to run the loop through the categories for
+                      "FOLDER" : 'Benchmark/', #for the synthetic input files, and the output files
+                      "RESULTS" : 'Benchmark/benchmark_results.csv',
+                      "SEED" : 0}
+    return benchmark_info
+
+
+# ## Function time_stage()
+# Runs one stage of the pipeline, and adds its row to the results
+
+# In[ ]:
+
+
+def time_stage(results, run_info, stage, function, *args):
+    """Runs function(*args) and records the wall time, CPU time and peak RSS of the stage in results (a list)
+    run_info: dictionary of the values that are the same for every stage of the run (version, size...)
+    Returns the value returned by function"""
+
+    memory_report = pipeline.start_memory_report([], stage)
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+        value = function(*args)
+        status = 'ok'
+    except MemoryError:
+        value = None
+        status = 'failed: out of memory'
+    seconds = time.perf_counter() - wallStart
+    cpuSeconds = time.process_time() - cpuStart
+    pipeline.end_memory_report(memory_report)
+    results.append(dict(run_info, Stage = stage, Status = status, Seconds = seconds, CPUSeconds = cpuSeconds,
+                        StartRSS_MB = memory_report[0]['StartRSS_MB'], PeakRSS_MB = memory_report[0]['PeakRSS_MB']))
+    if status != 'ok':
+        raise MemoryError(stage)
+    return value
+
+
+# ## Function benchmark_size()
+# Runs the stages for one size of synthetic data
+
+# In[ ]:
+
+
+def benchmark_size(benchmark_info, size, results):
+    """Creates (if not already created) the synthetic data with size rows, and times each stage of the pipeline on it"""
+
+    synthetic_info = generator.set_dictionary_for_synthetic_data()
+    synthetic_info.update(ROWS = size, SEED = benchmark_info['SEED'])
+    file_output_info = pipeline.set_dictionary_for_filenames()
+    file_output_info.update(FOLDER = benchmark_info['FOLDER'], FILESTART = 'Synthetic_' + str(size), CACHE = 0,
+                            CACHEFOLDER = benchmark_info['FOLDER'] + 'cache/', CHUNKSIZE = min(size, 10**6))
+    inputFile = file_output_info['FOLDER'] + file_output_info['FILESTART'] + '.csv'
+    run_info = {'Version' : pipeline.hash_file(pipeline.__file__)[:12],
+                'Date' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+                'Python' : platform.python_version(),
+                'Pandas' : pd.__version__,
+                'Size' : size}
+    if not os.path.exists(inputFile):
+        time_stage(results, run_info, 'create_synthetic_data', generator.create_synthetic_data, synthetic_info, inputFile)
+
+    try:
+        if size <= benchmark_info['MAXROWS']:
+            benchmark_in_memory(benchmark_info, size, file_output_info, run_info, results)
+        networks = [{"WARDTEAM" : 'WardTeamOneOOA', "COLUMN" : '', "REPRESENT_REMOVED" : 0, "SUBGROUP_NODE_NAME" : '',
+                     "SUBGROUP_FILENAME" : '_OneOOA'},
+                    {"WARDTEAM" : 'WardTeam', "COLUMN" : 'Locality_Edit', "REPRESENT_REMOVED" : 1,
+                     "SUBGROUP_NODE_NAME" : 'Locality ', "SUBGROUP_FILENAME" : '_Locality_'}]
+        time_stage(results, run_info, 'create_networks_streaming', pipeline.create_networks_streaming, networks, file_output_info)
+    except MemoryError:
+        pass
+    return
+
+
+def benchmark_in_memory(benchmark_info, size, file_output_info, run_info, results):
+    """Times the stages that hold all of the data in memory"""
+
+    DATA = time_stage(results, run_info, 'read_data', pipeline.read_data, file_output_info)
+    run_info['Rows'] = len(DATA)
+    DATA = time_stage(results, run_info, 'clean_data', pipeline.clean_data, DATA)
+    DATA = time_stage(results, run_info, 'calculate_LoS', pipeline.calculate_LoS, DATA)
+    DATA = time_stage(results, run_info, 'delete_zero_LoS', pipeline.delete_zero_LoS, DATA)
+    DATA = time_stage(results, run_info, 'sort_data', pipeline.sort_data, DATA)
+    DATA = time_stage(results, run_info, 'add_one_OOA_node_column', pipeline.add_one_OOA_node_column, DATA)
+
+    #The whole network, a stage at a time
+    subgroup_info = {"DATA" : DATA, "WARDTEAM" : 'WardTeamOneOOA', "COLUMN" : '', "REPRESENT_REMOVED" : 0,
+                     "SUBGROUP_NODE_NAME" : '', "SUBGROUP_FILENAME" : '_OneOOA'}
+    network_file_output_info = dict(file_output_info, DATA_SG = DATA, ROWS = None)
+    network_file_output_info = time_stage(results, run_info, 'update_dictionary', pipeline.update_dictionary,
+                                          subgroup_info, network_file_output_info, "", "")
+    servMove = time_stage(results, run_info, 'output_SM_file', pipeline.output_SM_file, network_file_output_info)
+    time_stage(results, run_info, 'output_Edge_file', pipeline.output_Edge_file, servMove, network_file_output_info)
+    time_stage(results, run_info, 'output_Node_file', pipeline.output_Node_file, network_file_output_info)
+
+    #The subgroup networks, looping through the categories and in one pass
+    for column, represent_removed, wardteam in (('Locality_Edit', 1, 'WardTeam'), ('Cluster', 0, 'WardTeamOneOOA')):
+        subgroup_info = {"DATA" : DATA, "WARDTEAM" : wardteam, "COLUMN" : column, "REPRESENT_REMOVED" : represent_removed,
+                         "SUBGROUP_NODE_NAME" : column + ' ', "SUBGROUP_FILENAME" : '_' + column + '_'}
+        if size <= benchmark_info['LOOP_MAXROWS']:
+            time_stage(results, run_info, 'create_network_data_for_subgroup_' + column,
+                       pipeline.create_network_data_for_subgroup, dict(subgroup_info, SINGLE_PASS = 0), file_output_info)
+        time_stage(results, run_info, 'create_network_data_for_subgroup_single_pass_' + column,
+                   pipeline.create_network_data_for_subgroup_single_pass, subgroup_info, dict(file_output_info))
+    return
+
+
+# ## Function write_results()
+# Adds the results to the results csv file
+
+# In[ ]:
+
+
+def write_results(benchmark_info, results):
+    """Adds the results (a list of dictionaries, a row per stage) to the csv file benchmark_info['RESULTS']"""
+
+    columns = ['Version', 'Date', 'Python', 'Pandas', 'Size', 'Rows', 'Stage', 'Status', 'Seconds', 'CPUSeconds',
+               'StartRSS_MB', 'PeakRSS_MB']
+    resultsFile = benchmark_info['RESULTS']
+    RESULTS = pd.DataFrame(results, columns = columns).astype({'Rows' : 'Int64'})
+    RESULTS.to_csv(resultsFile, mode = 'a', header = not os.path.exists(resultsFile), index = False)
+    return
+
+
+# In[ ]:
+
+if __name__ == '__main__':
+
+    benchmark_info = set_dictionary_for_benchmark()
+    largest = int(float(sys.argv[1])) if len(sys.argv) > 1 else max(benchmark_info['SIZES'])
+    if not os.path.isdir(benchmark_info['FOLDER']):
+        os.makedirs(benchmark_info['FOLDER'])
+    for size in benchmark_info['SIZES']:
+        if size <= largest:
+            results = []
+            benchmark_size(benchmark_info, size, results)
+            write_results(benchmark_info, results)
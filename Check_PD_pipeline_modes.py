@@ -0,0 +1,192 @@
+# coding: utf-8
+
+# # Check that every mode of the pipeline that prepares the Personality Disorder data for Gephi gives the same output files
+
+# ## Overview of the code
+#
+# This code runs <em>Gephi_Input_files_from_PD_data_v6.py</em> (through <em>run_specs()</em> of <em>Run_PD_networks.py</em>) on seeded synthetic data (from <em>Generate_synthetic_PD_data.py</em>), once looping through the categories of each network (the baseline), and once in each of the other modes in <em>check_info['MODES']</em>:
+#
+# 1. single_pass: all of the categories of each subgroup column together (<em>SINGLE_PASS</em> 1)
+# 2. workers: the networks created by worker processes (<em>WORKERS</em>)
+# 3. streaming: the networks created from the input file in chunks (<em>STREAMING</em> 1)
+# 4. sharded: the patients split into partitions, each processed on its own, and the results merged (<em>SHARDS</em>)
+# 5. delta: the networks of the earlier referrals (the history), updated with the later referrals (<em>DELTA</em> 1).  The input file is split at the date <em>check_info['DELTA_SHARE']</em> of the way through the referrals
+# 6. deduplicate: the SM and Pathway files counted from the distinct pathways of the patients (<em>DEDUPLICATE</em> 1), against the baseline counted from every patient (<em>DEDUPLICATE</em> 0)
+#
+# Each run is made in a folder of its own (in <em>check_info['FOLDER']</em>), with no cache, and the output files of each mode (SM, SMsparse, Edge, Node and Pathway) are compared byte for byte with the output files of its baseline.  A line is printed for each mode, and the code exits with status 1 if any output file differs or is missing.
+#
+# Run with the number of rows of synthetic data as an argument, for example: <em>python Check_PD_pipeline_modes.py 20000</em>
+
+# In[ ]:
+
+import filecmp
+import os
+import shutil
+import sys
+
+import pandas as pd
+
+import Gephi_Input_files_from_PD_data_v6 as pipeline
+import Generate_synthetic_PD_data as generator
+import Run_PD_networks as runner
+
+
+# ## Function set_dictionary_for_check()
+# The settings for the check
+
+# In[ ]:
+
+
+def set_dictionary_for_check():
+    """Sets the directory (check_info) that contains the settings for the check"""
+
+    check_info = {"ROWS" : 20000, #number of rows of synthetic data
+                  "SEED" : 0,
+                  "FOLDER" : 'Check/', #for the synthetic input file, and a folder per run
+                  "CHUNKSIZE" : 3000, #small, so that the streaming mode reads the data in several chunks
+                  "DELTA_SHARE" : 0.8, #share of the referrals (by date) in the history file of the delta mode
+                  "MODES" : [{"NAME" : 'single_pass', "NETWORKS" : {"SINGLE_PASS" : 1}},
+                             {"NAME" : 'workers', "SETTINGS" : {"WORKERS" : 2}},
+                             {"NAME" : 'streaming', "SETTINGS" : {"STREAMING" : 1}},
+                             {"NAME" : 'sharded', "SETTINGS" : {"SHARDS" : 3}},
+                             {"NAME" : 'delta', "SETTINGS" : {"DELTA" : 1}},
+                             {"NAME" : 'deduplicate', "SETTINGS" : {"PATHWAYS" : [3, 4], "DEDUPLICATE" : 1},
+                              "BASELINE" : {"PATHWAYS" : [3, 4], "DEDUPLICATE" : 0}}]}
+    return check_info
+
+
+# ## Function check_networks()
+# The networks to create in each run: the whole network, the services used by one patient, and a network for each category of four subgroup columns
+
+# In[ ]:
+
+
+def check_networks(DATA):
+    """Returns the list of networks (as in a spec file) to create in each run, for the patient with the most rows of DATA"""
+
+    clientID = int(DATA.ClientID.value_counts().index[0])
+    networks = [{"NAME" : 'OneOOA', "WARDTEAM" : 'WardTeamOneOOA', "COLUMN" : '', "REPRESENT_REMOVED" : 0,
+                 "SUBGROUP_NODE_NAME" : '', "SUBGROUP_FILENAME" : '_OneOOA'},
+                {"NAME" : 'ClientID', "CLIENTID" : clientID, "WARDTEAM" : 'WardTeam', "COLUMN" : '', "REPRESENT_REMOVED" : 0,
+                 "SUBGROUP_NODE_NAME" : '', "SUBGROUP_FILENAME" : '_ClientID_' + str(clientID)}]
+    for column, represent_removed, wardteam in (('Locality_Edit', 1, 'WardTeam'), ('Cluster', 0, 'WardTeamOneOOA'),
+                                                ('GenSpecialty_Age', 1, 'WardTeamOneOOA'), ('AgeAtRefGroup', 0, 'WardTeamOneOOA')):
+        networks.append({"NAME" : column, "WARDTEAM" : wardteam, "COLUMN" : column, "REPRESENT_REMOVED" : represent_removed,
+                         "SUBGROUP_NODE_NAME" : column + ' ', "SUBGROUP_FILENAME" : '_' + column + '_'})
+    return networks
+
+
+# ## Function split_for_delta()
+# Splits the input file into the history file and the file of the new period, for the delta mode
+
+# In[ ]:
+
+
+def split_for_delta(check_info, inputFile, folder):
+    """Writes the rows of inputFile referred before the date check_info['DELTA_SHARE'] of the way through the referrals
+    (and the rows with no referral date) to History.csv in folder, and the other rows to NewPeriod.csv"""
+
+    DATA = pd.read_csv(inputFile, dtype = str, keep_default_na = False)
+    dates = pd.to_datetime(DATA.ReferralDate, format = pipeline.set_dictionary_for_data_schema()['DATEFORMAT'], errors = 'coerce')
+    cut = dates.quantile(check_info['DELTA_SHARE'])
+    history = ~(dates >= cut)
+    DATA[history].to_csv(folder + 'History.csv', index = False)
+    DATA[~history].to_csv(folder + 'NewPeriod.csv', index = False)
+    return
+
+
+# ## Function run_mode()
+# Runs the pipeline with the given settings in a new folder, and returns the output files
+
+# In[ ]:
+
+
+def run_mode(check_info, inputFile, name, settings, networks):
+    """Creates the output files of networks with settings (added to the settings of the pipeline) in the folder name,
+    from inputFile.  Returns a dictionary of the output files (full paths), by the end of their name after FILESTART"""
+
+    folder = check_info['FOLDER'] + name + '/'
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    settings = dict(settings, FOLDER = folder, FILESTART = 'Synthetic', CACHE = 0, RESULT_CACHE = 0,
+                    CACHEFOLDER = folder + 'cache/', SHARDFOLDER = folder + 'shards/', CHUNKSIZE = check_info['CHUNKSIZE'])
+    if settings.get('DELTA'):
+        split_for_delta(check_info, inputFile, folder)
+        settings.update(FILESTART = 'History', DELTAFILE = 'NewPeriod')
+    else:
+        shutil.copyfile(inputFile, folder + 'Synthetic.csv')
+    runner.run_specs([{'FILE' : name, 'SETTINGS' : settings, 'NETWORKS' : networks}])
+
+    file_output_info = dict(pipeline.set_dictionary_for_filenames(), **settings)
+    ends = tuple(file_output_info[key] + file_output_info['FILEEX'] for key in
+                 ('FILEENDSM', 'FILEENDSMSPARSE', 'FILEENDEDGE', 'FILEENDNODE', 'FILEENDPATHWAY'))
+    return {filename[len(settings['FILESTART']):] : folder + filename for filename in os.listdir(folder)
+            if filename.startswith(settings['FILESTART']) and filename.endswith(ends)}
+
+
+# ## Function compare_outputs()
+# Compares the output files of a mode with the output files of its baseline
+
+# In[ ]:
+
+
+def compare_outputs(baseline, outputs):
+    """Returns the number of output files in baseline, and the lists of the files that differ from baseline
+    (byte for byte), are missing from outputs, or are only in outputs"""
+
+    differ = [name for name in sorted(baseline) if name in outputs and not filecmp.cmp(baseline[name], outputs[name], shallow = False)]
+    missing = [name for name in sorted(baseline) if name not in outputs]
+    extra = [name for name in sorted(outputs) if name not in baseline]
+    return len(baseline), differ, missing, extra
+
+
+# ## Function check_modes()
+# Runs the baseline and each mode, and prints whether their output files are the same
+
+# In[ ]:
+
+
+def check_modes(check_info):
+    """Creates (if not already created) the synthetic data, runs each mode in check_info['MODES'] and its baseline
+    (looping through the categories, with no worker processes), and compares their output files.
+    Returns 1 if the output files of any mode differ from its baseline, otherwise 0"""
+
+    synthetic_info = generator.set_dictionary_for_synthetic_data()
+    synthetic_info.update(ROWS = check_info['ROWS'], SEED = check_info['SEED'])
+    inputFile = check_info['FOLDER'] + 'Synthetic_' + str(check_info['ROWS']) + '_' + str(check_info['SEED']) + '.csv'
+    if not os.path.exists(inputFile):
+        generator.create_synthetic_data(synthetic_info, inputFile)
+    networks = check_networks(pd.read_csv(inputFile, usecols = ['ClientID']))
+
+    baselines = {}
+    status = 0
+    for mode in check_info['MODES']:
+        baselineSettings = mode.get('BASELINE', {})
+        key = repr(sorted(baselineSettings.items()))
+        if key not in baselines:
+            baselines[key] = run_mode(check_info, inputFile, 'baseline_' + str(len(baselines)), baselineSettings,
+                                      [dict(network, SINGLE_PASS = 0) for network in networks])
+        modeNetworks = [dict(network, **mode.get('NETWORKS', {})) for network in networks]
+        outputs = run_mode(check_info, inputFile, mode['NAME'], mode.get('SETTINGS', {}), modeNetworks)
+        nFiles, differ, missing, extra = compare_outputs(baselines[key], outputs)
+        same = not (differ or missing or extra)
+        print(mode['NAME'] + ': ' + ('same' if same else 'DIFFERENT') + ' (' + str(nFiles) + ' files compared, ' +
+              str(len(differ)) + ' differ, ' + str(len(missing)) + ' missing, ' + str(len(extra)) + ' extra)')
+        for name in differ + missing + extra:
+            print('    ' + name)
+        if not same:
+            status = 1
+    return status
+
+
+# In[ ]:
+
+if __name__ == '__main__':
+
+    check_info = set_dictionary_for_check()
+    if len(sys.argv) > 1:
+        check_info['ROWS'] = int(float(sys.argv[1]))
+    if not os.path.isdir(check_info['FOLDER']):
+        os.makedirs(check_info['FOLDER'])
+    sys.exit(check_modes(check_info))
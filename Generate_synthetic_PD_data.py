@@ -0,0 +1,179 @@
+# coding: utf-8
+
+# # Synthetic Personality Disorder data, for testing and benchmarking
+
+# ## Overview of the code
+#
+# The Personality Disorder dataset cannot leave our environment, so this code creates a synthetic dataset with the same columns (and the same kinds of values) as <em>ServUse15To18v6.csv</em>, of any size.  It can be used as the input file for <em>Gephi_Input_files_from_PD_data_v6.py</em>, and is used by <em>Benchmark_PD_pipeline.py</em> to time the pipeline as the data grows.
+#
+# The values are random, but follow the structure of the real data:
+#
+# 1. Each patient (ClientID) has a number of referrals (on average <em>REFERRALS_PER_CLIENT</em>), each to a WardTeam, on a random date between <em>STARTDATE</em> and <em>ENDDATE</em>, with a random length of stay.  A share of the admissions are still open (no ReferralDischarge), a few have a discharge before the referral (a negative LoS, removed by the pipeline), and a few have no ReferralDate.
+# 2. There are <em>WARDTEAMS</em> WardTeams, a share of which (<em>OOA_SHARE</em>) are out of area (Setting "OOA", Locality_Edit "OOA").  The other WardTeams are Community or Inpatient, each in one of the <em>LOCALITIES</em> localities.  WardTeam "Harford" is both Inpatient and OOA, as in the real data.
+# 3. The subgroup columns have <em>CLUSTERS</em> clusters (per patient), <em>AGEGROUPS</em> age groups (per patient) and <em>SPECIALTIES</em> general specialties (per referral), each with a share of missing values (<em>MISSING_SHARE</em>).
+#
+# The data is created and written in chunks of <em>CHUNKCLIENTS</em> patients, so a dataset larger than memory can be created.  The same <em>SEED</em> gives the same dataset.
+#
+# Run with the number of rows (about) and the output file as arguments, for example: <em>python Generate_synthetic_PD_data.py 1000000 Data/ServUse_synthetic.csv</em>.  The output file defaults to <em>Data/ServUse_synthetic.csv</em> (not the name of the real data), and an existing file is only overwritten with <em>--overwrite</em>.
+
+# In[ ]:
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# ## Function set_dictionary_for_synthetic_data()
+# The settings (knobs) for the synthetic dataset
+
+# In[ ]:
+
+
+def set_dictionary_for_synthetic_data():
+    """Sets the directory (synthetic_info) that contains the settings for the synthetic PD data"""
+
+    synthetic_info = {"ROWS" : 100000, #number of referrals (about)
+                      "REFERRALS_PER_CLIENT" : 3., #mean number of referrals per patient
+                      "WARDTEAMS" : 50, #number of WardTeams (including the OOA WardTeams and Harford)
+                      "OOA_SHARE" : 0.3, #share of the WardTeams that are out of area
+                      "LOCALITIES" : ['North Devon', 'Exeter', 'South Devon', 'Devon Wide'],
+                      "CLUSTERS" : 8, #number of Clusters
+                      "AGEGROUPS" : 6, #number of AgeAtRefGroup categories
+                      "SPECIALTIES" : ['Adult', 'Old Age'], #GenSpecialty_Age categories
+                      "MISSING_SHARE" : 0.05, #share of missing values in each subgroup column
+                      "OPEN_SHARE" : 0.05, #share of admissions with no ReferralDischarge
+                      "STARTDATE" : '2015-01-01',
+                      "ENDDATE" : '2018-02-18',
+                      "CHUNKCLIENTS" : 100000, #number of patients to create at a time
+                      "FIRSTCLIENTID" : 1000000,
+                      "SEED" : 0}
+    return synthetic_info
+
+
+# ## Function create_wardteams()
+# Each WardTeam has one Setting and one Locality (except Harford, which is Inpatient or OOA)
+
+# In[ ]:
+
+
+def create_wardteams(synthetic_info, rng):
+    """Returns a Pandas dataframe with a row per WardTeam: WardTeam, Setting, Locality_Edit, and the chance a referral is to it"""
+
+    nOOA = int(round(synthetic_info['WARDTEAMS'] * synthetic_info['OOA_SHARE']))
+    nLocal = max(synthetic_info['WARDTEAMS'] - nOOA - 1, 1)
+    wardteams = pd.DataFrame({'WardTeam' : ['Ward Team ' + str(i + 1) for i in range(nLocal)] +
+                                           ['OOA Ward Team ' + str(i + 1) for i in range(nOOA)] + ['Harford'],
+                              'Setting' : [['Community', 'Inpatient'][i % 2] for i in range(nLocal)] + ['OOA'] * nOOA +
+                                          ['Inpatient'],
+                              'Locality_Edit' : [synthetic_info['LOCALITIES'][i % len(synthetic_info['LOCALITIES'])]
+                                                 for i in range(nLocal)] + ['OOA'] * nOOA + ['Devon Wide']})
+    #Some WardTeams are used much more than others (the OOA WardTeams are used less)
+    weight = rng.pareto(1.5, len(wardteams)) + 1
+    weight[nLocal:nLocal + nOOA] /= 4
+    wardteams['Chance'] = weight / weight.sum()
+    return wardteams
+
+
+# ## Function create_chunk()
+# Creates the referrals for a chunk of patients
+
+# In[ ]:
+
+
+def create_chunk(synthetic_info, wardteams, firstClient, nClients, rng):
+    """Returns a Pandas dataframe of the referrals for nClients patients, with ClientIDs from firstClient, in the columns
+    (and format) of the PD data"""
+
+    #Number of referrals for each patient (at least 1)
+    nReferrals = 1 + rng.poisson(synthetic_info['REFERRALS_PER_CLIENT'] - 1, nClients)
+    clientID = np.repeat(np.arange(firstClient, firstClient + nClients), nReferrals)
+    client = np.repeat(np.arange(nClients), nReferrals)
+    n = len(clientID)
+
+    ward = rng.choice(len(wardteams), n, p = wardteams.Chance.values)
+    wardTeam = wardteams.WardTeam.values[ward]
+    setting = wardteams.Setting.values[ward].astype(object)
+    locality = wardteams.Locality_Edit.values[ward].astype(object)
+    harford = wardTeam == 'Harford'
+    harfordOOA = harford & (rng.random(n) < 0.5)
+    setting[harfordOOA] = 'OOA'
+    locality[harfordOOA] = 'OOA'
+
+    startDate = pd.Timestamp(synthetic_info['STARTDATE'])
+    days = (pd.Timestamp(synthetic_info['ENDDATE']) - startDate).days
+    referralDay = rng.integers(0, days, n)
+    #Inpatient stays are shorter than community stays, a few are negative (recording errors)
+    los = np.where(setting == 'Community', rng.exponential(120, n), rng.exponential(30, n)).astype(np.int64)
+    negative = rng.random(n) < 0.005
+    los[negative] = -rng.integers(1, 10, np.count_nonzero(negative))
+    dischargeDay = referralDay + los
+    #Format each day once (the dates are day numbers from STARTDATE)
+    firstDay = min(0, dischargeDay.min())
+    calendar = (startDate + pd.to_timedelta(np.arange(firstDay, max(days, dischargeDay.max()) + 1), unit = 'D'))
+    calendar = calendar.strftime('%d/%m/%Y').values.astype(object)
+    referralDate = calendar[referralDay - firstDay]
+    referralDischarge = calendar[dischargeDay - firstDay]
+    referralDischarge[rng.random(n) < synthetic_info['OPEN_SHARE']] = np.nan
+    referralDate[rng.random(n) < 0.005] = np.nan
+
+    #Cluster and age group belong to the patient, specialty to the referral
+    cluster = (1. + rng.integers(0, synthetic_info['CLUSTERS'], nClients))[client]
+    ageGroup = (1 + rng.integers(0, synthetic_info['AGEGROUPS'], nClients))[client].astype(object)
+    specialty = np.array(synthetic_info['SPECIALTIES'], dtype = object)[rng.integers(0, len(synthetic_info['SPECIALTIES']), n)]
+    for column in (locality, specialty, ageGroup):
+        column[rng.random(n) < synthetic_info['MISSING_SHARE']] = np.nan
+    cluster[rng.random(n) < synthetic_info['MISSING_SHARE']] = np.nan
+
+    DATA = pd.DataFrame({'ClientID' : clientID,
+                         'ReferralSource' : np.array(['GP', 'Self', 'Other', np.nan], dtype = object)[rng.integers(0, 4, n)],
+                         'ReferralDate' : referralDate,
+                         'ReferralDischarge' : referralDischarge,
+                         'WardTeam' : wardTeam,
+                         'Setting' : setting,
+                         'Locality_Edit' : locality,
+                         'Cluster' : cluster,
+                         'AgeAtRefGroup' : ageGroup,
+                         'GenSpecialty_Age' : specialty})
+    #The rows of the input file are not in patient order
+    return DATA.iloc[rng.permutation(n)]
+
+
+# ## Function create_synthetic_data()
+# Creates the synthetic data a chunk of patients at a time, and writes it to a csv file
+
+# In[ ]:
+
+
+def create_synthetic_data(synthetic_info, filename):
+    """Writes the synthetic PD data (about synthetic_info['ROWS'] rows) to the csv file filename
+    Returns the number of rows written"""
+
+    rng = np.random.default_rng(synthetic_info['SEED'])
+    wardteams = create_wardteams(synthetic_info, rng)
+    nClients = max(int(synthetic_info['ROWS'] / synthetic_info['REFERRALS_PER_CLIENT']), 1)
+    nRows = 0
+    for firstClient in range(0, nClients, synthetic_info['CHUNKCLIENTS']):
+        DATA = create_chunk(synthetic_info, wardteams, synthetic_info['FIRSTCLIENTID'] + firstClient,
+                            min(synthetic_info['CHUNKCLIENTS'], nClients - firstClient), rng)
+        DATA.to_csv(filename, mode = 'w' if firstClient == 0 else 'a', header = firstClient == 0, index = False)
+        nRows += len(DATA)
+    return nRows
+
+
+# In[ ]:
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Creates a synthetic dataset with the columns of the PD data')
+    parser.add_argument('rows', nargs = '?', type = float, help = 'the number of rows (about)')
+    parser.add_argument('filename', nargs = '?', default = 'Data/ServUse_synthetic.csv', help = 'the output csv file')
+    parser.add_argument('--overwrite', action = 'store_true', help = 'overwrite the output file if it exists')
+    args = parser.parse_args()
+    if os.path.exists(args.filename) and not args.overwrite:
+        parser.error(args.filename + ' exists, give --overwrite to replace it')
+    synthetic_info = set_dictionary_for_synthetic_data()
+    if args.rows is not None:
+        synthetic_info['ROWS'] = int(args.rows)
+    create_synthetic_data(synthetic_info, args.filename)
@@ -23,9 +23,12 @@
 # 
 # 3. Service movement file: 
 # The <em>Service movement</em> file is an interime working file that contains a matrix of the frequency of use of the links from all services to all other services (a row and column per service [Ward Team]).  The <em>Edge</em> file is created driectly from the <em>Service movement</em> file. 
+# The same matrix is also written with only its non-zero elements (a row per Source, Target, Weight), as most of the elements are zero.
+# 
+# The networks can also be returned as igraph graphs (see <em>create_network_graphs()</em>), to be analysed without writing the files.
 # 
 # ### Code Structure
-# In addition to the main code, the code is divided into 14 functions (a function is defined by beginning with <em>def ______():</em> and ending with <em>return</em>. It is worth creating a function for script that is used multiple times, or to break code down into smaller chunks. 
+# In addition to the main code, the code is divided into 121 functions (a function is defined by beginning with <em>def ______():</em> and ending with <em>return</em>. It is worth creating a function for script that is used multiple times, or to break code down into smaller chunks. 
 # 
 # Three of the functions create and output each of the three output files: (1) <em>output_SM_file()</em>, (2) <em>output_Edge_file()</em>, (3) <em>output_Node_file()</em>.
 # 
@@ -42,16 +45,74 @@
 # Function (9) <em>clean_data(DATA)</em>: Receives a Pandas dataframe (DATA) containing the PD data. Cleans the data
 # & returns the Pandas dataframe
 #     
-# Function (10) <em>calculate_variables(DATA)</em>: Receives a Pandas dataframe (DATA) containing the PD data. Changes the format of the date columns and calculates the length of stay (LoS). Returns the Pandas dataframe
+# Function (10) <em>calculate_variables(DATA)</em>: Receives a Pandas dataframe (DATA) containing the PD data. Calculates the length of stay (LoS) from the date columns. Returns the Pandas dataframe
 #     
 # Function (11) <em>delete_zero_LoS(DATA)</em>: Receives a Pandas dataframe (DATA) containing the PD data.  Removes any instance with a negative LoS. Returns the Pandas dataframe
 #         
 # Function (12) <em>sort_data(DATA)</em>: Receives a Pandas dataframe (DATA) containing the PD data.  Sorts the data by patient and orders their admissions chronologically on the date the service was accessed
 #     
-# Function (13) <em>create_DATA_with_one_OOA_node(DATA_OneOOA)</em>: Dupicates the PD data (DATA) and represents all of the OOA nodes as one single node. Changes all of the OOA node WardTeams to "All OOA Services".
+# Function (13) <em>add_one_OOA_node_column(DATA)</em>: Adds a column to the PD data (WardTeamOneOOA) that represents all of the OOA nodes as one single node. A copy of WardTeam with all of the OOA node WardTeams changed to "All OOA Services".
 # 
 # Function (14) <em>create_network_data_for_subgroup(subgroup_info,file_output_info)</em>: Passed a dictionary, pandas dataframe and the subgroup in focus.  Adds 2 new columns: newWardTeam & Setting.  Depending on the value of subgroup_info['REPRESENT_REMOVED'] these new columns are either duplicate WardTeam & Setting (if not representing the excluded instances as a single subgroup node) but these 2 columns need to be present for consistency in the code to use these column names.  Or copy WardTeam & Setting & change the values for the subgroups not in focus (if representing the excluded instances as a single subgroup node)
 # 
+# Function (15) <em>calculate_transitions(file_output_info)</em>: Finds every chronological (Source, Target) pair of services used by a patient in a single pass of the data, by comparing each row with the next row.  Used by <em>output_SM_file()</em>.
+# 
+# Functions (16) <em>write_SM_file(servMove,file_output_info)</em> and (17) <em>write_Node_file(nodesdf,file_output_info)</em>: Output the Service movement and Node files, for results that have already been calculated.
+# 
+# Function (18) <em>create_network_data_for_subgroup_single_pass(subgroup_info,file_output_info)</em>: Creates the same output files as <em>create_network_data_for_subgroup()</em> for every category of the subgroup column, from one pass of the data (used when subgroup_info['SINGLE_PASS'] is 1).
+# 
+# Function (19) <em>subgroup_values(file_output_info,column)</em>: Returns the values of a column for the rows of the subgroup, without copying the PD data.
+# 
+# Functions (20) <em>read_memory()</em>, (21) <em>start_memory_report(memory_report,network)</em> and (22) <em>end_memory_report(memory_report)</em>: Record the memory used (resident set size) while creating each network.
+# 
+# Functions (23) <em>set_worker_data(DATA)</em>, (24) <em>list_network_jobs(subgroup_info,file_output_info)</em>, (25) <em>run_network_job(job)</em>, (26) <em>run_network_jobs(jobs,DATA,workers)</em> and (27) <em>create_networks(networks,file_output_info,DATA)</em>: Split the networks into independent jobs and run them, in a pool of worker processes if file_output_info['WORKERS'] is more than 1.
+# 
+# Functions (28) <em>prepare_data(file_output_info)</em>, (29) <em>hash_file(filename)</em>, (30) <em>prepared_data_key(file_output_info)</em> and (31) <em>load_prepared_data(file_output_info)</em>: Read in and prepare the PD data, or load the prepared data from the cache if the input file and the cleaning rules are unchanged.
+# 
+# Functions (32) <em>code_subgroup_names(subgroup_info,groups,npWardTeam)</em>, (33) <em>count_subgroup_links(subgroup_info,clientID,groupCode,wardCode,subgroupCode,nGroups)</em>, (34) <em>add_group_moves(links,groupMove,subgroupCode)</em> and (35) <em>write_subgroup_networks(subgroup_info,file_output_info,groups,names,subgroupCode,links,wardStats,subgroupStats,singles,singlesGroup)</em>: The steps of <em>create_network_data_for_subgroup_single_pass()</em>, also used when streaming.
+# 
+# Functions (36) <em>read_prepared_chunks(file_output_info)</em>, (37) <em>stream_client_blocks(file_output_info)</em>, (38) <em>external_sort_by_client(file_output_info)</em>, (39) <em>create_networks_streaming(networks,file_output_info)</em>, (40) <em>accumulate_network(subgroup_info,DATA,accumulator)</em>, (41) <em>los_stats(los,keys,file_output_info)</em> and (42) <em>write_accumulated_networks(subgroup_info,file_output_info,accumulator)</em>: Create the networks from the input file in chunks, for a dataset too large to hold in memory (used when file_output_info['STREAMING'] is 1).
+# 
+# Functions (43) <em>set_dictionary_for_data_schema()</em>, (44) <em>read_data(file_output_info,chunksize)</em> and (45) <em>parse_columns(DATA,data_schema)</em>: Read in the PD data with a fixed schema (the columns used, their types, and the date format).
+# 
+# Functions (46) <em>new_network_accumulator(keepTails,sketch)</em>, (47) <em>network_rows(subgroup_info,DATA)</em> and (48) <em>accumulate_nodes(subgroup_info,DATA,accumulator,sign)</em>: Keep the running totals of a network, used when streaming and in delta mode.
+# 
+# Functions (49) <em>network_name(subgroup_info)</em>, (50) <em>update_networks(networks,file_output_info)</em> and (51) <em>apply_delta(networks,file_output_info,state)</em>: Update the networks with a new period of referrals, from the saved state of the networks (used when file_output_info['DELTA'] is 1).
+# 
+# Functions (52) <em>write_network_files(group,servMove,nodesdf,file_output_info)</em>, (53) <em>network_graph(servMove,nodesdf)</em> and (54) <em>create_network_graphs(subgroup_info,file_output_info)</em>: Return the networks as igraph graphs, built from the transition counts without writing files (writing the files is optional).
+# 
+# Functions (55) <em>reset_peak_memory()</em>, (56) <em>start_instrumentation(hooks,worker)</em>, (57) <em>stop_instrumentation()</em>, (58) <em>stage(name,network,rowsIn)</em>, (59) <em>record_stage(record)</em> and (60) <em>write_run_report(file_output_info,report)</em>: Record the time, memory, rows, nodes and edges of each stage of the run, and output them as a run report (used when file_output_info['INSTRUMENT'] is 1).
+# 
+# Functions (61) <em>load_node_registry(file_output_info)</em>, (62) <em>register_nodes(file_output_info,names)</em>, (63) <em>save_node_registry(file_output_info)</em>, (64) <em>create_node_registry(file_output_info,DATA)</em>, (65) <em>node_codes(file_output_info,DATA,column,rows)</em> and (66) <em>code_subgroup_nodes(subgroup_info,file_output_info,groups,npNodeCode)</em>: Give every node name an integer code once, in a node registry that is the same for every network, so the networks work with the codes rather than the names.
+# 
+# Functions (67) <em>relabel_codes(DATA,column,rows)</em>, (68) <em>apply_relabel_rules(rules,node,values)</em>, (69) <em>relabel(DATA,rules,column,rows)</em> and (70) <em>network_nodes(subgroup_info,DATA,rows,setting)</em>: Change the node names (collapse the OOA WardTeams, represent the removed subgroups, split Harford, or a mapping table) from a list of rules, applied once to each combination of values rather than to each row.
+# 
+# Functions (71) <em>count_pathways(clientID,nodeID,length,top,weights)</em> and (72) <em>output_Pathway_file(file_output_info,labels)</em>: Count the pathways of 3 or more services used one after the other by a patient (the Edge file has the pathways of 2 services), and output the most used to a <em>Pathway</em> file for each network (used when file_output_info['PATHWAYS'] has the lengths to count).
+# 
+# Functions (73) <em>subgroup_transitions(subgroup_info,clientID,groupCode,wardCode)</em>, (74) <em>transition_links(subgroup_info,transitions,subgroupCode,nGroups,count)</em>, (75) <em>snapshot_windows(file_output_info,dates)</em>, (76) <em>create_network_snapshots(networks,file_output_info)</em>, (77) <em>create_subgroup_snapshots(subgroup_info,file_output_info)</em> and (78) <em>write_dynamic_network(snapshots,file_output_info)</em>: Create the networks for each month or quarter (fixed or sliding windows) from one table of the transitions ordered by date, as output files for each window or as a dynamic graph for Gephi's timeline (used when file_output_info['SNAPSHOTS'] is 'M' or 'Q').
+# 
+# Functions (79) <em>create_transition_cube(file_output_info,DATA,wardteam)</em>, (80) <em>load_transition_cube(file_output_info,DATA,wardteam)</em>, (81) <em>cube_positions(cube,side,filters)</em>, (82) <em>query_transition_cube(cube,filters,represent_removed,file_output_info)</em> and (83) <em>output_cube_network(cube,filters,file_output_info,represent_removed)</em>: Keep every transition, with codes for the values of its rows and an index on each column, so that the network for any combination of filters (for example Cluster 7, North Devon and age group 2) is found without another pass of the data (used for file_output_info['CUBE_QUERIES']).
+# 
+# Functions (84) <em>start_output_writer(file_output_info)</em>, (85) <em>write_output(filename,write)</em>, (86) <em>flush_output_writer()</em> and (87) <em>stop_output_writer(file_output_info)</em>: Write each output file to a temporary name and rename it when it is complete, in background threads (with a bounded queue) so the next network is calculated while the files of the last are written, and output a manifest of the files of the run.
+# 
+# Functions (88) <em>check_output_formats(file_output_info)</em>, (89) <em>edge_table(servMove,edgeStats)</em>, (90) <em>write_text(filename,text)</em>, (91) <em>network_gexf(servMove,nodesdf,edgeStats)</em> and (92) <em>output_Graph_files(servMove,nodesdf,file_output_info)</em>: Output each network in the formats of file_output_info['FORMATS'] as well as (or instead of) the csv files: a compressed sparse matrix (NPZ), typed Parquet tables, or one GEXF or GraphML file with the node and edge attributes for Gephi.
+# 
+# Function (93) <em>unique_pathways(clientID,nodeID)</em>: Collapse the patients with the same sequence of services into one pathway with the number of patients that have it (by hashing each sequence of node IDs), so the pathways, and the transitions when looping through the categories, are counted once for each distinct sequence (used when file_output_info['DEDUPLICATE'] is 1).
+# 
+# Functions (94) <em>node_stat_columns(file_output_info)</em>, (95) <em>sketch_los(los,accuracy)</em> and (96) <em>node_stats(nodes,keys,file_output_info,first)</em>: Calculate the count, mean, median and percentiles of the LoS of each node in one grouped pass (file_output_info['NODE_STATS'] adds columns to the Node file), optionally from a mergeable quantile sketch with a bounded error (file_output_info['LOS_SKETCH']), so the running totals when streaming or in delta mode stay small.
+# 
+# Functions (97) <em>write_partitions(file_output_info,partitionNames)</em>, (98) <em>read_partition(partitionName)</em>, (99) <em>shard_filename(file_output_info,name)</em>, (100) <em>load_partition_description(file_output_info)</em>, (101) <em>partition_by_client(file_output_info)</em>, (102) <em>process_shard(networks,file_output_info,shard,key)</em>, (103) <em>run_shard_job(job)</em>, (104) <em>merge_accumulators(accumulator,other)</em>, (105) <em>merge_shard_results(networks,file_output_info,description)</em> and (106) <em>create_networks_sharded(networks,file_output_info)</em>: Split the patients by a hash of ClientID into partitions on disk, process each partition on its own (in worker processes, or on several hosts sharing a folder) and merge the partial results into the output files (used when file_output_info['SHARDS'] is more than 0).
+# 
+# Functions (107) <em>code_version()</em>, (108) <em>job_fingerprint(job,dataKey,codeKey)</em>, (109) <em>load_result_cache(file_output_info)</em>, (110) <em>outputs_unchanged(entry)</em> and (111) <em>save_result_cache(file_output_info,results)</em>: Skip the network jobs whose output files are there unchanged from the same input data, job settings and code, from a fingerprint of each job kept with a list of its output files in a result cache (used when file_output_info['RESULT_CACHE'] is 1).
+# 
+# Functions (112) <em>run_networks(networks,file_output_info,DATA,memory_report)</em> and (113) <em>write_memory_report(file_output_info,memory_report)</em>: Create the output files for a list of networks in the way set in file_output_info, and output the memory report, used by the main code and by <em>Run_PD_networks.py</em> (which runs the networks listed in spec files, such as <em>P206_networks.json</em>).
+# 
+# Functions (114) <em>grouped_stats(code,values,nGroups,stats)</em>, (115) <em>edge_stat_columns(file_output_info)</em>, (116) <em>transition_waits(dates,discharges,sourceRow,targetRow)</em>, (117) <em>edge_stats(keys,wait,file_output_info)</em> and (118) <em>subgroup_edge_stats(subgroup_info,file_output_info,transitions,wait,subgroupCode,nGroups)</em>: Calculate the mean, median and percentiles of the wait between the services of each link (from the discharge of the Source to the referral of the Target), found with the transitions and reduced for all of the links in one grouped pass, as columns of the Edge file (used when file_output_info['EDGE_STATS'] is not empty).
+# 
+# Function (119) <em>check_network_rows(name,nRows)</em>: Raises an error for a network with no rows of the PD data (for example a ClientID that is not in the data), in every way of creating the networks.
+# 
+# Functions (120) <em>write_frame(zipFile,name,frame)</em> and (121) <em>read_frame(zipFile,name)</em>: Store a Pandas dataframe in a zip file as NumPy arrays and json rather than pickled, for the partitions of the patients and their partial results (which can be shared by several hosts).
+# 
 # The main code reads in the Personality Disorder dataset, calls the functions to clean and sort the data, and then prepares the necessary rows to be passed to function <em>create_output_files()</em> that calls the three functions in turn to create the output files.
 # 
 # First let's define the functions.
@@ -62,8 +123,16 @@
 
 import pandas as pd
 import numpy as np
-import igraph
+import scipy.sparse
+import contextlib
 import datetime
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+import zipfile
 
 # ## Function make_filename()
 # Function <em>make_filename()</em> is passed <em>filename</em> that contains the name to represent the subgroup of the data (taken from one of the categories in the PD data file) and is used to create a subgroup specific filename.  
@@ -89,36 +158,211 @@ def make_filename(filename):
     return(filename)
 
 
+# ## Function subgroup_values()
+# The PD data for a network (<em>DATA_SG</em>) is not a copy of the data.  It is the complete (base) PD dataframe, which is never changed, together with:
+# 
+# 1. <em>file_output_info['ROWS']</em>: the positions of the rows in the base dataframe that are in the subgroup (None to use all of the rows)
+# 2. <em>file_output_info['SG_COLUMNS']</em>: a dictionary of NumPy arrays, a value per subgroup row, for the columns that are only needed for this network (newNodeCode, newSetting, wardTeamCat, wardTeamCatCode)
+# 
+# Function <em>subgroup_values()</em> returns the values of a column for the rows of the subgroup, taking it from the side arrays if it is one of these columns, otherwise from the base dataframe.  Only the requested column is taken for the subgroup rows, and so a subgroup never holds a copy of the whole dataset.
+
+# In[ ]:
+
+
+def subgroup_values(file_output_info, column):
+    """Returns a NumPy array of the values in the column for the rows of the subgroup
+    Columns only needed for this network are held in file_output_info['SG_COLUMNS'], the other columns are taken from the 
+    base Pandas dataframe (DATA_SG) for the rows in file_output_info['ROWS'] (all rows if None)"""
+    
+    if column in file_output_info.get('SG_COLUMNS', {}):
+        return file_output_info['SG_COLUMNS'][column]
+    values = file_output_info['DATA_SG'][column].to_numpy()
+    if file_output_info.get('ROWS') is None:
+        return values
+    return values[file_output_info['ROWS']]
+
+
+# ## The node registry
+# 
+# Every node name (each WardTeam, the one OOA node "All OOA services", and each subgroup node, "SUBGROUP_NODE_NAME" + category) is given an integer code once, in the node registry (<em>file_output_info['NODE_REGISTRY']</em>), so that the networks work with integer codes rather than with the names.  A name keeps its code: new names are added to the end of the registry, and so the same node has the same code in every network (and, as the registry is kept in <em>file_output_info['CACHEFOLDER']</em> if <em>file_output_info['CACHE']</em> is 1, in every run).
+# 
+# The registry is a dictionary:
+# 
+# "NAMES" : NumPy array of the names, in the order of their codes
+# "INDEX" : Pandas index of the names, to find the code of a name
+# "RANK" : NumPy array of the position of each name in the sorted list of names
+# "SAVED" : the number of names in the registry file
+# 
+# Function <em>create_node_registry()</em> adds the names in the WardTeam columns of the prepared PD data, when the data is read in.  The node names of a network are categorical (see <em>network_nodes()</em>), so <em>node_codes()</em> finds the registry code of each category once, and then gives the code of each row by indexing with the category codes of the rows (no names are compared).  The subgroup nodes are added when the jobs are listed (see <em>list_network_jobs()</em>).
+# 
+# Gephi needs the node IDs of each network to run from 1 to n, so <em>categorise_columns()</em> gives the nodes of a network their IDs in the sorted order of their names (using RANK), the same IDs as before.  The ID of a node in a network is its position among that network's nodes; its registry code is the same in all networks.
+
+# In[ ]:
+
+
+def load_node_registry(file_output_info):
+    """Returns the node registry from the registry file in file_output_info['CACHEFOLDER'] (if file_output_info['CACHE'] is 1
+    and there is one), otherwise an empty registry"""
+    
+    names = []
+    registryFile = file_output_info.get('CACHEFOLDER', '') + str(file_output_info.get('FILESTART', '')) + '_node_registry.csv'
+    if file_output_info.get('CACHE', 0) and os.path.exists(registryFile):
+        names = pd.read_csv(registryFile, dtype = {'Name' : str}, keep_default_na = False).Name.tolist()
+    names = np.array(names, dtype = object)
+    rank = np.empty(len(names), dtype = np.int64)
+    rank[np.argsort(names)] = np.arange(len(names))
+    return {'NAMES' : names, 'INDEX' : pd.Index(names), 'RANK' : rank, 'SAVED' : len(names)}
+
+
+def register_nodes(file_output_info, names):
+    """Adds the node names (a NumPy array) that are not already in the node registry (file_output_info['NODE_REGISTRY'], 
+    loaded with load_node_registry() if not there) to the end of the registry
+    Returns a NumPy array of the registry code of each name"""
+    
+    registry = file_output_info.get('NODE_REGISTRY')
+    if registry is None:
+        registry = load_node_registry(file_output_info)
+    names = np.asarray(names, dtype = object)
+    codes = registry['INDEX'].get_indexer(names)
+    if np.any(codes < 0):
+        #A new registry, rather than changing the one shared with other copies of file_output_info
+        allNames = np.concatenate((registry['NAMES'], pd.unique(names[codes < 0])))
+        rank = np.empty(len(allNames), dtype = np.int64)
+        rank[np.argsort(allNames)] = np.arange(len(allNames))
+        registry = {'NAMES' : allNames, 'INDEX' : pd.Index(allNames), 'RANK' : rank, 'SAVED' : registry['SAVED']}
+        codes = registry['INDEX'].get_indexer(names)
+    file_output_info['NODE_REGISTRY'] = registry
+    return codes
+
+
+def save_node_registry(file_output_info):
+    """Writes the node registry to the registry file in file_output_info['CACHEFOLDER'], if file_output_info['CACHE'] is 1 
+    and names have been added since it was last written"""
+    
+    registry = file_output_info.get('NODE_REGISTRY')
+    if not file_output_info.get('CACHE', 0) or registry is None or registry['SAVED'] == len(registry['NAMES']):
+        return
+    if not os.path.isdir(file_output_info['CACHEFOLDER']):
+        os.makedirs(file_output_info['CACHEFOLDER'])
+    registryFile = file_output_info['CACHEFOLDER'] + str(file_output_info['FILESTART']) + '_node_registry.csv'
+    pd.DataFrame({'NodeCode' : np.arange(len(registry['NAMES'])), 'Name' : registry['NAMES']}).to_csv(
+        registryFile + '.tmp', sep = ',', index = False)
+    os.replace(registryFile + '.tmp', registryFile)
+    registry['SAVED'] = len(registry['NAMES'])
+    return
+
+
+def create_node_registry(file_output_info, DATA):
+    """Adds the names in the WardTeam columns of the prepared PD data (DATA) to the node registry, and writes the registry 
+    file (see save_node_registry())"""
+    
+    for column in ('WardTeam', 'WardTeamOneOOA'):
+        register_nodes(file_output_info, np.asarray(DATA[column].cat.categories, dtype = object))
+    save_node_registry(file_output_info)
+    return file_output_info
+
+
+def node_codes(file_output_info, nodes):
+    """Returns a NumPy array of the registry code of each node name in nodes (a Pandas Categorical, see network_nodes())"""
+    
+    #The code of each category, then the code of each row from its category
+    categoryCodes = register_nodes(file_output_info, np.asarray(nodes.categories, dtype = object))
+    return categoryCodes[nodes.codes]
+
+
 # ## Function add_columns_wardteamcatcode()
 # Function <em>add_columns_wardteamcatcode()</em> is passed a pandas dataframe (the PD data to be represented as a network, so either the full dataset, or a subgroup), and adds two columns in order to format the WardTeam column (object) into a unique numerical ID that can be used as the nodes reference in the output file. 
-# This is done in two stages: WardTeamCat (converts the object to a categorical variable) and WardTeamCatCode (converts the categorical variable to the unique numerical ID).
+# This is done in two stages: WardTeamCat (the name of the node) and WardTeamCatCode (the unique numerical ID of the node, running from 1 to n in the sorted order of the names).  Both are found from the registry code of each row's node (newNodeCode, see <em>node_codes()</em>), without comparing any names.
+# 
+# The two columns are stored as side arrays for the subgroup (see <em>subgroup_values()</em>) rather than added to the dataframe.
 
 # In[41]:
 
 
 def categorise_columns(file_output_info):
-    """Converts the WardTeam column into a numerical ID field"""
-    
-    #To have categories represented as numbers, first need data type as categories  
-    file_output_info['DATA_SG']['wardTeamCat'] = file_output_info['DATA_SG']['newWardTeam'].astype('category')
-    
-    #Then store the categories as the numerical codes
-    file_output_info['DATA_SG']['wardTeamCatCode'] = file_output_info['DATA_SG']['wardTeamCat'].cat.codes + 1
+    """Converts the node registry codes (newNodeCode) into a numerical ID field, running from 1 to n in the order of the names"""
+    
+    registry = file_output_info['NODE_REGISTRY']
+    nodeCode = subgroup_values(file_output_info, 'newNodeCode')
+    #The nodes in this network, in the sorted order of their names
+    used = np.flatnonzero(np.bincount(nodeCode, minlength = len(registry['NAMES'])))
+    used = used[np.argsort(registry['RANK'][used])]
+    nodeID = np.zeros(len(registry['NAMES']), dtype = np.int64)
+    nodeID[used] = np.arange(1, len(used) + 1)
+    
+    #Store the nodes as the numerical codes, and as categories (the names)
+    wardTeamCatCode = nodeID[nodeCode]
+    file_output_info['SG_COLUMNS']['wardTeamCatCode'] = wardTeamCatCode
+    file_output_info['SG_COLUMNS']['wardTeamCat'] = pd.Categorical.from_codes(wardTeamCatCode - 1, registry['NAMES'][used])
     return file_output_info
 
 
+# ## Function calculate_transitions()
+# 
+# This function recieves the PD data as a pandas dataframe (DATA_SG), already grouped by patient and ordered chronologically on the date the services they accessed (.ReferralDate).
+# 
+# Rather than filtering the data for each patient in turn, the <em>ClientID</em> and <em>wardTeamCatCode</em> columns are each compared against themselves shifted by one row.  Wherever a row and the next row belong to the same patient, the pair of <em>wardTeamCatCode</em> values is a transition (Source: this service, Target: next service).
+# 
+# The same comparison gives the patients that only have 1 service use (no edges can be recorded for that patient): the row that starts their block of rows is also the row that ends it.
+# 
+# If the distinct pathways of the network have been found (<em>file_output_info['UNIQUE_PATHWAYS']</em>, see <em>unique_pathways()</em>), the transitions are taken from them instead, each counted for the number of patients with the pathway.
+# 
+# If <em>file_output_info['EDGE_STATS']</em> is given, the wait of each transition (the days from the discharge of its Source row to the referral of its Target row, see <em>transition_waits()</em>) is found from the same comparison of the rows, and its statistics for each (Source, Target) pair are calculated by <em>edge_stats()</em> in one grouped pass.
+
+# In[ ]:
+
+def calculate_transitions(file_output_info):
+    """Finds every chronological (Source, Target) pair of services used by a patient, in a single pass of the data
+    Recieves the PD data as a Pandas dataframe (DATA_SG), could either be the whole network or a subgroup.
+    The data is already grouped by patient and ordered chronologically on the date the services they accessed (.ReferralDate).
+    Returns four NumPy arrays: the Source wardTeamCatCode and Target wardTeamCatCode of each transition, the number of 
+    times each was made (1, or the number of patients with the pathway if file_output_info['UNIQUE_PATHWAYS'] is given), 
+    and the ClientIDs of the patients that only have 1 service use; and the statistics of the wait of each (Source, Target)
+    pair (a Pandas dataframe from edge_stats(), None if file_output_info['EDGE_STATS'] is empty)"""
+
+    clientID = subgroup_values(file_output_info, 'ClientID')
+    #int64 so that the codes can be used to index the flattened servMove matrix without overflowing
+    wardTeamCode = subgroup_values(file_output_info, 'wardTeamCatCode').astype(np.int64)
+
+    #True where the next row is for the same patient as this row
+    sameClient = clientID[:-1] == clientID[1:]
+    if 'UNIQUE_PATHWAYS' in file_output_info:
+        pathway, pathwayNode, weights = file_output_info['UNIQUE_PATHWAYS']
+        samePathway = pathway[:-1] == pathway[1:]
+        source = pathwayNode[:-1][samePathway]
+        target = pathwayNode[1:][samePathway]
+        count = weights[:-1][samePathway]
+    else:
+        source = wardTeamCode[:-1][sameClient]
+        target = wardTeamCode[1:][sameClient]
+        count = np.ones(len(source), dtype = np.int64)
+
+    #A patient with a single service use has a row that both starts and ends their block of rows (no rows if there are none)
+    startsBlock = np.concatenate(([True], ~sameClient))[:len(clientID)]
+    endsBlock = np.concatenate((~sameClient, [True]))[:len(clientID)]
+    singles = clientID[startsBlock & endsBlock]
+
+    #The wait of every transition of the rows (also when counted from the distinct pathways, as the waits of the patients 
+    #with a pathway are not the same)
+    waits = None
+    if file_output_info.get('EDGE_STATS'):
+        sourceRow = np.flatnonzero(sameClient)
+        wait = transition_waits(subgroup_values(file_output_info, 'ReferralDate'), 
+                                subgroup_values(file_output_info, 'ReferralDischarge'), sourceRow, sourceRow + 1)
+        waits = edge_stats((wardTeamCode[sourceRow], wardTeamCode[sourceRow + 1]), wait, file_output_info)
+    return source, target, count, singles, waits
+
+
 # ## Function output_SM_file()
 # 
 # This is the first in a series of 3 functions that outputs a file.
 # 
 # This function recieves the PD data as a pandas dataframe (DATA_SG), from which to create the network.  This data is grouped by patient and ordered chronologically on the date the services they accessed (.ReferralDate).
-# This function returns a NumPy array (<em>servMove</em>) with a row and column for each unique WardTeam in the passed Pandas dataframe.  The values stored are the frequency a patient chronologically used a service following another service.
-# 
-# <em>servMove</em> is initialised as a matrix of zeros.
+# This function returns a sparse matrix (<em>servMove</em>) with a row and column for each unique WardTeam in the passed Pandas dataframe.  The values stored are the (integer) frequency a patient chronologically used a service following another service.  Most services are never used one after the other, so only the non-zero elements are stored (a SciPy CSR matrix).  This matters when the OOA services are kept as individual nodes, as then there are many nodes but few links.
 # 
-# Go through the <em>DATA_SG</em> records by patient.  Use the current (j) <em>wardTeamCatCode</em> to set the row, and the next (j+1) wardTeamCatCode to set the column [need to use -1 as the codes run from 1 to n, whereas row and column reference run from 0 to n-1].  Increment the respective element in the <em>servMove</em> array (row n: from service, column m: to service) by +1.
+# The (Source, Target) pairs are found by function <em>calculate_transitions()</em> in one pass of <em>DATA_SG</em>.  Use the Source <em>wardTeamCatCode</em> to set the row, and the Target wardTeamCatCode to set the column [need to use -1 as the codes run from 1 to n, whereas row and column reference run from 0 to n-1].  All of the pairs are counted into the <em>servMove</em> matrix (row n: from service, column m: to service) in one go, as the conversion to CSR adds together the repeated (row, column) pairs.
 # 
-# The <em>servMove</em> array is written to an output file (location and filename is passed into the function by 5 arguments) and also returned to the main code.
+# The <em>servMove</em> matrix is written to two output files by function <em>write_SM_file()</em> (location and filename is passed into the function by 5 arguments) and also returned to the main code.  The first is the full matrix as before (a row and column per service), the second only contains the non-zero elements (a row per element: Source, Target, Weight).
 
 # In[42]:
 
@@ -127,103 +371,120 @@ def output_SM_file(file_output_info):#DATA_SG, FOLDER, FILESTART, FILEMIDDLE, FI
     The numpy array is used in function output_Edge_file()), and also outputted to a csv file
     Recieves the PD data as a Pandas dataframe (DATA_SG), could either be the whole network or a subgroup. 
     The data is already grouped by patient and ordered chronologically on the date the services they accessed (.ReferralDate). 
-    Returns a NumPy array (servMove) with a row and column for each unique WardTeam in the passed Pandas dataframe. 
-    The values stored in the array are the frequency patients chronologically used a service following another service."""
-    
-    #set up a matrix of zeros, with number of columns and rows = number of wardTeams 
-    #Each entry will record the frequency a patient chronologically used a service following another service
-    servMove = np.zeros((max(file_output_info['DATA_SG'].wardTeamCatCode), max(file_output_info['DATA_SG'].wardTeamCatCode)))
-
-    #stores the number of patients that only have 1 service use (no edges can be recorded for that patient)
-    singles = 0
-    #get a vector of unique patient ID's
-    clientIDUni = file_output_info['DATA_SG'].ClientID.unique()             
-
-    # loop through each unique ClientID
-    for ID in clientIDUni:                              
-        #take the wardTeam column for the instances for the ClientID
-        cWardTeam = file_output_info['DATA_SG'][file_output_info['DATA_SG'].ClientID == ID].wardTeamCatCode 
-        l = len(cWardTeam)
-        if (l > 1):                                       #if more than 1 admission, then can do source and target
-            for j in range(0,(l - 1)):                    #Go through each service use
-                # Record the use from Source (this service) and Target (next service)
-                servMove[int(cWardTeam.iloc[j]) - 1,int(cWardTeam.iloc[j + 1]) - 1] += 1 
-        else:
-            #If 1 entry then record the clients accessing only one service during this time period
-            singles = np.vstack((singles,ID))               
+    Returns a SciPy sparse matrix (servMove) with a row and column for each unique WardTeam in the passed Pandas dataframe. 
+    The values stored in the matrix are the frequency patients chronologically used a service following another service."""
+    
+    #get every (Source, Target) pair of services, and the patients that only have 1 service use
+    source, target, count, singles, waits = calculate_transitions(file_output_info)
+    file_output_info['SINGLES'] = singles
+    file_output_info['EDGE_WAITS'] = waits
+
+    #set up a sparse matrix with number of columns and rows = number of wardTeams 
+    #Each entry records the frequency a patient chronologically used a service following another service
+    #Each pair is entered with its count, converting to CSR sums the counts for repeated pairs
+    n = int(max(subgroup_values(file_output_info, 'wardTeamCatCode')))
+    servMove = scipy.sparse.coo_matrix((count, (source - 1, target - 1)),
+                                       shape = (n, n)).tocsr()
+
+    write_SM_file(servMove, file_output_info)
+    return servMove
 
-    #Create the output filename
+
+def write_SM_file(servMove, file_output_info):
+    """Outputs the servMove sparse matrix to two csv files: the full matrix, and only the non-zero elements"""
+
+    if 'CSV' not in file_output_info.get('FORMATS', ['CSV']):
+        return
+    #Create the output filenames
     FileNameSM = (file_output_info['FILESTART'] + file_output_info['FILEMIDDLE'] + 
                   file_output_info['FILEENDSM'] + file_output_info['FILEEX'])
+    FileNameSMSparse = (file_output_info['FILESTART'] + file_output_info['FILEMIDDLE'] + 
+                        file_output_info['FILEENDSMSPARSE'] + file_output_info['FILEEX'])
 
     #output service movement matrix as csv
-    np.savetxt(file_output_info['FOLDER'] + FileNameSM, servMove, delimiter = ",")       
-    return servMove
+    write_output(file_output_info['FOLDER'] + FileNameSM, np.savetxt, servMove.toarray(), delimiter = ",")       
+
+    #output the non-zero elements of the service movement matrix as csv (IDs run from 1 to n, as in the Edge file)
+    smCoo = servMove.tocoo()
+    smSparsedf = pd.DataFrame({'Source' : smCoo.row + 1, 'Target' : smCoo.col + 1, 'Weight' : smCoo.data})
+    write_output(file_output_info['FOLDER'] + FileNameSMSparse, smSparsedf.to_csv, sep = ',', index = False)
+    return
 
 
 # ## Function output_Edge_file()
 # 
 # This is the second in a series of 3 functions that outputs a file.  Uses the <em>servMove</em> array created in function <em>output_servMove_file()</em> to create and output the Edge file.
 # 
-# This function recieves the NumPy array <em>servMove</em> with a row and column for each unique WardTeam.  The values stored are the frequency a patient chronologically used a service following another service.
+# This function recieves the sparse matrix <em>servMove</em> with a row and column for each unique WardTeam.  The values stored are the frequency a patient chronologically used a service following another service.
+# 
+# Only the non-zero elements of <em>servMove</em> are stored, and each of these is a link.  The row number (source WardTeam ID), the column number (the target WardTeam ID) and the recorded value (the frequency of patients that have used that link) are taken for all of the non-zero elements at once, and ordered by target then source WardTeam.
 # 
-# A NumPy array (<em>edges</em>) is initialised with a single row with 3 columns of zero values.  The code loops through each row of <em>servMove</em> (which is a WardTeam) and for any column with a value greater than zero, a row is added to the edges NumPy array to store the row number (source WardTeam ID) the colmun number (the target WardTeam ID) and the recorded value (the frequency of patients that have used that link).
+# These now contain a row per link.  Convert to a Pandas dataframe and output as a csv file
 # 
-# The <em>edges</em> NumPy matrix is cleaned to remove the redundant first row used to initialise the matrix.
-# The NumPy array (<em>edges</em>) now contains a row per link.  Convert to a Pandas dataframe and output as a csv file
+# If the statistics of the wait of each link have been found (<em>file_output_info['EDGE_WAITS']</em>, see <em>edge_stats()</em>), they are added as columns after Weight.
 # 
 # The <em>edge</em> file is written to an output file (location and filename is passed into the function by 5 arguments).
 
 # In[43]:
 
 def output_Edge_file(servMove, file_output_info):#FOLDER, FILESTART, FILEMIDDLE, FILEEND, FILEEX):
-    """Creates the EDGE file for Gephi (outputs a csv file) from the servMove NumPy array
-    Recieves the NumPy array servMove with a row and column for each unique WardTeam. 
+    """Creates the EDGE file for Gephi (outputs a csv file) from the servMove sparse matrix
+    Recieves the SciPy sparse matrix servMove with a row and column for each unique WardTeam. 
     The values stored are the frequency a patient chronologically used a service following another service.
     For any value > 0 in servMove, a row in the EDGE file is created, with 5 columns:
     1) Source node ID [the servMove row] 
     2) Target node ID [the servMove column]
     3) Type [for this case, always DIRECTED]
     4) Edge ID [unique]
-    5) Frequency of patient using the edge"""
-
-    #initialise the numpy array (delete this redundant row later)
-    edges = np.zeros((1,3))              
-    lenRow = servMove.shape[0]           #number of rows (the number of wardTeams)
-    for i in range (0,lenRow):           #for loop to extract the used Source-Target combinations, and their activity
-        for j in range(0,lenRow):
-            if (int(servMove[j, i]) > 0):
-                #Record an edge for any Source-Target which has been used (activity>0)
-                rowData = np.array([[j + 1,i + 1, int(servMove[j, i])]])    #Source, Target, Activity
-                edges = np.vstack((edges,rowData))                    #Add the row onto the numpy array
-    edges=edges.astype(int)                 
-    edges = edges[1:edges.shape[0], :]          #clean up edges matrix, remove the superflous first row
-    lenEdge = edges.shape[0]                    #number of rows (number of Source-Target combinations)
-    edgetype = np.repeat("Directed", lenEdge)   #change depending on whether producing a directed or undirected graph
-    edgeid = np.arange(0, lenEdge)              #Create a unique edgeid for the output file
-    edges = np.vstack((edges[:, 0], edges[:, 1], edgetype, edgeid, edges[:, 2])) #create the output file
-    edges = np.transpose(edges)                  #need to transpose the data (currently in rows, need in columns)
-    edgesdf = pd.DataFrame(edges, columns = ['Source', 'Target', 'Type', 'Id', 'Weight'])
+    5) Frequency of patient using the edge
+    and a column for each statistic of the wait of the edge (see edge_stat_columns()) if file_output_info['EDGE_WAITS'] is given"""
+
+    if 'CSV' not in file_output_info.get('FORMATS', ['CSV']):
+        return
+    edgesdf = edge_table(servMove, file_output_info.get('EDGE_WAITS'))
     
     #Create the output filename
     FileNameEdge = (file_output_info['FILESTART'] + file_output_info['FILEMIDDLE'] + 
                    file_output_info['FILEENDEDGE'] + file_output_info['FILEEX'])
     #output edges list as csv
-    edgesdf.to_csv(file_output_info['FOLDER'] + FileNameEdge, sep = ',')           
+    write_output(file_output_info['FOLDER'] + FileNameEdge, edgesdf.to_csv, sep = ',')           
     return
 
 
+def edge_table(servMove, edgeStats = None):
+    """Returns the Pandas dataframe of the Edge file (Source, Target, Type, Id, Weight) for the servMove sparse matrix
+    edgeStats: (optional) Pandas dataframe indexed by (Source, Target) node IDs, from edge_stats(), with columns to add"""
+
+    #Extract the used Source-Target combinations, and their activity (the non-zero elements)
+    smCoo = servMove.tocoo()
+    used = smCoo.data > 0
+    source = smCoo.row[used]
+    target = smCoo.col[used]
+    activity = smCoo.data[used].astype(int)
+    order = np.lexsort((source, target))        #order the edges by Target, then by Source
+    lenEdge = len(order)                        #number of rows (number of Source-Target combinations)
+    edgesdf = pd.DataFrame({'Source' : source[order] + 1, 
+                            'Target' : target[order] + 1,
+                            'Type' : np.repeat("Directed", lenEdge), #change depending on whether producing a directed or undirected graph
+                            'Id' : np.arange(0, lenEdge),            #Create a unique edgeid for the output file
+                            'Weight' : activity[order]}, 
+                           columns = ['Source', 'Target', 'Type', 'Id', 'Weight'])
+    if edgeStats is not None:
+        edgesdf = edgesdf.join(edgeStats, on = ['Source', 'Target'])
+    return edgesdf
+
+
 # ## Function output_Node_file()
 # 
 # This is the third in a series of 3 functions that outputs a file.  Outputs the <em>Node</em> file.
 # 
 # This function recieves the PD data as a Pandas dataframe (<em>DATA_SG</em>), from which to create the network, and creates a reference file for the nodes (WardTeams), a row per node.
 # 
-# Using the Pandas function "groupby" to calclate the mean and median LoS.
+# Using function <em>node_stats()</em> to calculate the mean and median LoS (and any statistics in <em>file_output_info['NODE_STATS']</em>) in one grouped pass, with the name and Setting of the first row of each node.
 # 
-# Creates a NumPy array (<em>nodes</em>) with a row per node storing the nodes ID, name, mean LoS, median Los, Setting.  The numpy array is converted to a Pandas dataframe.
+# Creates a Pandas dataframe (<em>nodesdf</em>) with a row per node storing the nodes ID, name, mean LoS, median Los, Setting (and the other statistics), each column with its own type.
 # 
-# The <em>node</em> Pandas dataframe is written to an output csv file (location and filename is passed into the function by 5 arguments).
+# The <em>node</em> Pandas dataframe is written to an output csv file by function <em>write_Node_file()</em> (location and filename is passed into the function by 5 arguments).
 # 
 
 # In[44]:
@@ -231,34 +492,423 @@ def output_Edge_file(servMove, file_output_info):#FOLDER, FILESTART, FILEMIDDLE,
 def output_Node_file(file_output_info):#DATA_SG, FOLDER, FILESTART, FILEMIDDLE, FILEEND, FILEEX):
     """Creates the NODE input file for Gephi (outputs a csv file) from the PD data
     Recieves the PD data as a Pandas dataframe (DATA_SG), could either be the whole network or a subgroup. 
-    Creates a NumPy array containing a reference list for the nodes (WardTeams), a row per node.
-    NumPy array is outputed as a csv file"""
+    Creates a Pandas dataframe containing a reference list for the nodes (WardTeams), a row per node.
+    The dataframe is outputed as a csv file, and returned"""
 #    ***CREATE THE NODE FILE***
 
-    #Calculate mean and median LoS using pandas groupby function
-    daysMeans = file_output_info['DATA_SG'].groupby('wardTeamCatCode')['LoSdays'].mean()
-    daysMedians = file_output_info['DATA_SG'].groupby('wardTeamCatCode')['LoSdays'].median()
-
-    #Take a single case of occurence of WardTeamCat, Code & Setting
+    #Take the columns needed for the subgroup rows
     df = pd.DataFrame()
-    df['wardTeamCat'] = file_output_info['DATA_SG'].wardTeamCat
-    df['wardTeamCatCode'] = file_output_info['DATA_SG'].wardTeamCatCode
-    df['Setting'] = file_output_info['DATA_SG'].newSetting
-
-    # keep one case for each WardTeam
-    df.drop_duplicates(subset = ['wardTeamCat', 'wardTeamCatCode', 'Setting'], inplace = True)
-    df.sort_values('wardTeamCatCode', inplace = True)
-
-    #Join all output columns as numpy array, transpose, and store as pandas for easier file formatting
-    nodes = np.vstack((df.wardTeamCatCode, df.wardTeamCat, daysMeans, daysMedians, df.Setting))
-    nodes = np.transpose(nodes)
-    nodesdf = pd.DataFrame(nodes,columns = ['ID', 'Label', 'MeanLoS', 'MedianLoS', 'Setting'])
-    
+    df['wardTeamCat'] = subgroup_values(file_output_info, 'wardTeamCat')
+    df['wardTeamCatCode'] = subgroup_values(file_output_info, 'wardTeamCatCode')
+    df['Setting'] = subgroup_values(file_output_info, 'newSetting')
+    df['LoSdays'] = subgroup_values(file_output_info, 'LoSdays')
+
+    #Calculate the mean and median LoS (and any other statistics) in one grouped pass, and take the name and Setting of the 
+    #first row for each WardTeam (a node relabelled from WardTeams in more than one Setting keeps the Setting of its first row)
+    stats = node_stats(df, ['wardTeamCatCode'], file_output_info, first = ['wardTeamCat', 'Setting'])
+
+    #Store as pandas for easier file formatting, a row per node in the order of the codes
+    nodesdf = pd.DataFrame({'ID' : stats.index.values,
+                            'Label' : stats.wardTeamCat.values,
+                            'MeanLoS' : stats.MeanLoS.values,
+                            'MedianLoS' : stats.MedianLoS.values,
+                            'Setting' : stats.Setting.values},
+                           columns = ['ID', 'Label', 'MeanLoS', 'MedianLoS', 'Setting'])
+    for column in node_stat_columns(file_output_info):
+        nodesdf[column] = stats[column].values
+
+    write_Node_file(nodesdf, file_output_info)
+    return nodesdf
+
+
+def write_Node_file(nodesdf, file_output_info):
+    """Outputs the nodesdf Pandas dataframe (a row per node: ID, Label, MeanLoS, MedianLoS, Setting) as a csv file"""
+    
+    if 'CSV' not in file_output_info.get('FORMATS', ['CSV']):
+        return
     #Create the output filename from passed in variables, and output the nodedf as a csv file 
     FileNameNode = (file_output_info['FILESTART'] + file_output_info['FILEMIDDLE'] + 
                    file_output_info['FILEENDNODE'] + file_output_info['FILEEX'])
 
-    nodesdf.to_csv(file_output_info['FOLDER'] + FileNameNode, sep = ',')
+    write_output(file_output_info['FOLDER'] + FileNameNode, nodesdf.to_csv, sep = ',')
+    return
+
+
+# ## Node statistics
+# 
+# The Node file has the mean and median LoS of each node.  Function <em>node_stats()</em> calculates them for every node in one grouped pass: the rows are sorted once by node and LoS (as one integer key), so the count and the sum of the LoS are a count of each node's rows, and the median (and any percentile) is read from the position of the middle (or other) row of each node.  Other statistics can be added to the Node file with <em>file_output_info['NODE_STATS']</em>: 'Count' (the number of admissions to the node) and percentiles of the LoS (for example 25, 75 and 90 add the columns P25LoS, P75LoS and P90LoS, found by linear interpolation between the rows either side, as by Pandas' <em>quantile()</em>).
+# 
+# An exact median needs every LoS of a node together, so it cannot be put together from the medians of parts of the data.  When streaming, and in delta mode, the running totals of the nodes are instead a count of each LoS value for each node (see <em>accumulate_nodes()</em>), which can be added together for the chunks (or taken away, for the open admissions in delta mode), and the statistics are calculated from these counts by <em>los_stats()</em>, with the same results.  These counts grow with the number of distinct LoS values of each node.  If <em>file_output_info['LOS_SKETCH']</em> is more than 0 (for example 0.01), each LoS is first rounded by <em>sketch_los()</em> to the middle of its bucket of a log-scaled quantile sketch (buckets from gamma<sup>i-1</sup> to gamma<sup>i</sup> days, where gamma = (1 + LOS_SKETCH) / (1 - LOS_SKETCH)).  The counts then have at most a few hundred values for each node, whatever the size of the data, and can still be added together; the mean, median and every percentile are then within LOS_SKETCH of the exact value, relative to the value (within 1% for 0.01, so 0.5 days in 50 days), and an LoS of 0 days is kept exact.  The sketch is used for every network of the run (in memory, streaming or delta), so the results do not depend on how the data was processed.
+
+# In[ ]:
+
+
+def node_stat_columns(file_output_info):
+    """Returns the names of the columns of the Node file for the statistics in file_output_info['NODE_STATS'] ('Count', or
+    a percentile of the LoS: 'P' + the percentile + 'LoS')"""
+    return ['Count' if stat == 'Count' else 'P' + str(stat) + 'LoS' for stat in file_output_info.get('NODE_STATS', [])]
+
+
+def sketch_los(los, accuracy):
+    """Returns the LoS values (NumPy array) rounded to the middle of their bucket of the quantile sketch, so that any value 
+    found from them is within accuracy of the exact value (relative to the value), or unchanged if accuracy is 0"""
+    
+    los = np.asarray(los, dtype = np.float64)
+    if not accuracy:
+        return los
+    gamma = (1 + accuracy) / (1 - accuracy)
+    sketched = los.copy()
+    positive = los > 0
+    bucket = np.ceil(np.log(los[positive]) / np.log(gamma))
+    sketched[positive] = 2 * gamma ** bucket / (gamma + 1)
+    return sketched
+
+
+def grouped_stats(code, values, nGroups, stats):
+    """Calculates statistics of the values of each group in one grouped pass: the values are sorted once by group then value
+    (one sort of an integer key: the group, then the rank of the value)
+    code: NumPy array of the group of each value (0 to nGroups - 1, every group with at least one value)
+    stats: list of 'Count', 'Mean', 'Median' and percentiles (found by linear interpolation, as by Pandas' quantile())
+    Returns a list of NumPy arrays, the value of each statistic in stats for each group"""
+    
+    if len(values) == 0:
+        return [np.zeros(0, dtype = np.int64 if stat == 'Count' else np.float64) for stat in stats]
+    #The values sorted by group then value, and the position of the first value of each group
+    count = np.bincount(code, minlength = nGroups)
+    valueCode, distinct = pd.factorize(values, sort = True)
+    sortedValues = distinct[np.sort(code.astype(np.int64) * len(distinct) + valueCode) % len(distinct)]
+    start = np.concatenate(([0], np.cumsum(count)[:-1]))
+    results = []
+    for stat in stats:
+        if stat == 'Count':
+            results.append(count)
+        elif stat == 'Mean':
+            results.append(np.bincount(code, weights = values, minlength = nGroups) / count)
+        elif stat == 'Median':
+            results.append((sortedValues[start + (count - 1) // 2] + sortedValues[start + count // 2]) / 2)
+        else:
+            position = (count - 1) * (stat / 100.)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.minimum(lower + 1, count - 1)
+            results.append(sortedValues[start + lower] + (sortedValues[start + upper] - sortedValues[start + lower]) * 
+                           (position - lower))
+    return results
+
+
+def node_stats(nodes, keys, file_output_info, first = ()):
+    """Calculates the LoS statistics of each node in one grouped pass: MeanLoS, MedianLoS and the statistics in 
+    file_output_info['NODE_STATS'] (see node_stat_columns())
+    Recieves a Pandas dataframe (nodes) with the columns in keys (the node), LoSdays, and the columns in first
+    Returns a Pandas dataframe indexed by keys (sorted), with a column for each statistic and the first value of each node
+    for each column in first (as from nodes.groupby(keys).agg())"""
+    
+    grouped = nodes.groupby(keys, sort = True)
+    code = grouped.ngroup().values
+    stats = grouped[list(first)].first() if first else pd.DataFrame(index = grouped.size().index)
+    los = sketch_los(nodes.LoSdays.values, file_output_info.get('LOS_SKETCH', 0))
+    
+    results = grouped_stats(code, los, len(stats), ['Mean', 'Median'] + list(file_output_info.get('NODE_STATS', [])))
+    for column, result in zip(['MeanLoS', 'MedianLoS'] + node_stat_columns(file_output_info), results):
+        stats[column] = result
+    return stats
+
+
+# ## Edge statistics
+# 
+# The wait of a transition is the number of days from the discharge of its Source row (ReferralDischarge) to the referral of its Target row (ReferralDate).  A negative wait is a patient referred to the next service before being discharged from the last, so the two services overlap (this includes the admissions that are still open, whose ReferralDischarge is the date the data was taken).
+# 
+# <em>file_output_info['EDGE_STATS']</em> lists the statistics of the waits of each link to add to the Edge file (and to the Parquet, GEXF and GraphML files), for example ['Mean', 'Median', 90] adds the columns MeanWait, MedianWait and P90Wait.  The waits are found with the transitions, from the same comparison of each row with the next row (<em>calculate_transitions()</em>, or <em>subgroup_transitions()</em> in the single pass), and <em>edge_stats()</em> calculates the statistics for every link in one grouped pass (<em>grouped_stats()</em>, as for the LoS of the nodes), keyed on the codes of its (Source, Target), or (category, Source, Target) for all the categories of the single pass at once.  The waits of each patient are used, also when the transitions are counted from the distinct pathways (<em>file_output_info['DEDUPLICATE']</em>).
+# 
+# The statistics are found for the networks created from the prepared data in memory, looping through the categories or in one pass.  The networks created when streaming, from partitions (sharded), in delta mode, for each time window or from the transition cube do not have them.
+
+# In[ ]:
+
+
+def edge_stat_columns(file_output_info):
+    """Returns the names of the columns of the Edge file for the statistics in file_output_info['EDGE_STATS'] ('Mean' + 'Wait',
+    'Median' + 'Wait', or a percentile of the wait: 'P' + the percentile + 'Wait')"""
+    return [stat + 'Wait' if stat in ('Mean', 'Median') else 'P' + str(stat) + 'Wait' 
+            for stat in file_output_info.get('EDGE_STATS', [])]
+
+
+def transition_waits(dates, discharges, sourceRow, targetRow):
+    """Returns a NumPy array of the wait of each transition, in days: the ReferralDate (dates) of its Target row less the 
+    ReferralDischarge (discharges) of its Source row
+    sourceRow, targetRow: NumPy arrays of the positions of the rows of each transition in dates and discharges"""
+    return (dates[targetRow] - discharges[sourceRow]) / np.timedelta64(1, 'D')
+
+
+def edge_stats(keys, wait, file_output_info):
+    """Calculates the statistics of the waits of each link in one grouped pass (see grouped_stats())
+    keys: tuple of NumPy arrays of integers from 0 (for example the Source and Target node IDs) that give the link of each wait
+    Returns a Pandas dataframe indexed by keys (sorted), with a column for each statistic in file_output_info['EDGE_STATS'] 
+    (see edge_stat_columns())"""
+    
+    shape = tuple(int(key.max()) + 1 if len(key) else 1 for key in keys)
+    code, linkKey = pd.factorize(np.ravel_multi_index(keys, shape), sort = True)
+    results = grouped_stats(code, wait, len(linkKey), file_output_info['EDGE_STATS'])
+    index = pd.MultiIndex.from_arrays(np.unravel_index(np.asarray(linkKey, dtype = np.int64), shape))
+    return pd.DataFrame(dict(zip(edge_stat_columns(file_output_info), results)), index = index)
+
+
+# ## Function output_Pathway_file()
+#
+# The Edge file only has the pairs of services used one after the other (a pathway of 2 services).  This function finds the longer pathways: every sequence of <em>length</em> services used one after the other by a patient (for example, Community to Inpatient to Community is a pathway of 3 services), and how many times each was used.  It is used when <em>file_output_info['PATHWAYS']</em> has the lengths to count (for example [3, 4]).
+#
+# The rows are in the same patient & chronological order as for the Edge file.  Rather than taking the sequence of services for each patient in turn, the node IDs are compared with themselves shifted by 1, 2, ... length-1 rows (a rolling window over the rows): the window that starts at a row is a pathway if its first and last rows are for the same patient (as the rows of a patient are together, all of the rows between are then for the patient too).
+#
+# Each pathway is packed into a single integer key (the node IDs as the digits of a number in base n+1), so the pathways are counted by hashing one integer per window rather than comparing tuples of names.  If the key would be too large for a 64 bit integer (many nodes and long pathways), the key of the first services is replaced by the code of its distinct value before the next service is added, so the key never overflows.  A pathway is read back from the services at the first window that has its key.
+#
+# Function <em>count_pathways()</em> returns the pathways ordered from the most used, keeping the top <em>file_output_info['PATHWAYS_TOP']</em> for each length (all of them if 0).  Function <em>output_Pathway_file()</em> writes them to the <em>Pathway</em> file, next to the Edge file: a row per pathway with its length, rank, the node IDs (as in the Node file) and names, and the weight (the number of times patients used the pathway).
+#
+# The Pathway files are written when looping through the categories and in the single pass (for each category, the same rows in the same order as its Edge file), but not when streaming or in delta mode, which only keep the running totals of the links.
+#
+# Many patients have exactly the same sequence of services (for example one community team, or one team then one inpatient ward).  If <em>file_output_info['DEDUPLICATE']</em> is 1, function <em>unique_pathways()</em> first collapses the patients with the same sequence into one pathway, with the number of patients that have it, and the pathways (and, when looping through the categories, the transitions of the SM file) are counted once for each distinct sequence and weighted by that number.  The counts are the same as without deduplicating.  Each patient's sequence is hashed in one pass of the rows: the sum of (node ID + 1) x BASE<sup>position</sup> as an unsigned 64 bit integer (which wraps around), together with the length of the sequence.  Every patient is then checked against the first patient with the same hash, and a patient with a different sequence (a hash collision, very unlikely) is given a pathway of its own, so the counts are always exact.  The stage <em>unique_pathways</em> of the run report has the rows before (RowsIn) and after (RowsOut), so the compression is RowsIn / RowsOut.
+
+# In[ ]:
+
+
+#The base of the hash of a patient's sequence of services in unique_pathways() (a prime larger than the number of nodes)
+PATHWAY_HASH_BASE = 1000003
+
+
+def unique_pathways(clientID, nodeID):
+    """Collapses the patients with the same sequence of services (the same node IDs in the same order) into one pathway
+    Recieves NumPy arrays for the rows (ordered by patient & chronologically): ClientID and node ID
+    Returns NumPy arrays for the rows of the distinct pathways (the rows of the first patient with each pathway): the code of 
+    the pathway (0 to the number of pathways - 1), the node ID, and the number of patients with the pathway (on each of its 
+    rows), so that each returned row stands for that number of rows of the data"""
+
+    nodeID = np.asarray(nodeID, dtype = np.int64)
+    nRows = len(nodeID)
+    with stage('unique_pathways', rowsIn = nRows) as record:
+        if nRows == 0:
+            record['RowsOut'] = 0
+            return np.zeros(0, dtype = np.int64), nodeID, np.zeros(0, dtype = np.int64)
+        #The patient of each row, and the position of the row within the patient's rows
+        startsBlock = np.concatenate(([True], clientID[1:] != clientID[:-1]))
+        blockStart = np.flatnonzero(startsBlock)
+        blockLength = np.diff(np.append(blockStart, nRows))
+        client = np.cumsum(startsBlock) - 1
+        position = np.arange(nRows) - blockStart[client]
+        
+        #Hash each patient's sequence, and give a code to each distinct (hash, length)
+        with np.errstate(over = 'ignore'):
+            powers = np.cumprod(np.full(blockLength.max(), PATHWAY_HASH_BASE, dtype = np.uint64))
+            hashes = np.add.reduceat((nodeID.astype(np.uint64) + np.uint64(1)) * powers[position], blockStart)
+        pathway = pd.factorize(pd.factorize(hashes)[0].astype(np.int64) * (int(blockLength.max()) + 1) + blockLength)[0]
+        
+        #Check each patient's services against the first patient with the same code, a patient that differs has its own code
+        first = np.unique(pathway, return_index = True)[1]
+        differs = nodeID != nodeID[blockStart[first[pathway]][client] + position]
+        if differs.any():
+            clash = np.unique(client[differs])
+            pathway[clash] = len(first) + np.arange(len(clash))
+            pathway = pd.factorize(pathway)[0]
+            first = np.unique(pathway, return_index = True)[1]
+        
+        #Keep the rows of the first patient with each pathway (the codes are in the order of these patients)
+        isFirst = np.zeros(len(blockStart), dtype = bool)
+        isFirst[first] = True
+        keep = isFirst[client]
+        rowPathway = pathway[client[keep]]
+        record['RowsOut'] = len(rowPathway)
+    return rowPathway, nodeID[keep], np.bincount(pathway)[rowPathway]
+
+
+
+def count_pathways(clientID, nodeID, length, top = 0, weights = None):
+    """Counts every sequence of length services used one after the other by a patient
+    Recieves NumPy arrays for the rows (ordered by patient & chronologically): ClientID and node ID (1 to n), and 
+    (optionally) the number of patients each row stands for (see unique_pathways())
+    Returns a NumPy array of the pathways (a row per pathway, a column per service in the pathway) and a NumPy array of the
+    number of times each was used, ordered from the most used (the top most used if top is more than 0)"""
+
+    nodeID = np.asarray(nodeID, dtype = np.int64)
+    #The windows with all of their rows for one patient (the first and last rows are for the same patient)
+    nWindows = max(len(nodeID) - length + 1, 0)
+    starts = np.flatnonzero(clientID[:nWindows] == clientID[length - 1:length - 1 + nWindows])
+    if len(starts) == 0:
+        return np.zeros((0, length), dtype = np.int64), np.zeros(0, dtype = np.int64)
+
+    #Pack the node IDs of each window into one integer key, in base n+1
+    base = int(nodeID.max()) + 1
+    key = nodeID[starts]
+    for step in range(1, length):
+        if (int(key.max()) + 1) * base >= 2**62:
+            key = pd.factorize(key)[0] #too large to add another service, so replace by the code of each distinct key
+        key = key * base + nodeID[starts + step]
+
+    #Count the distinct keys (codes in the order they first appear), and find the first window with each key
+    keyCode, keys = pd.factorize(key)
+    if weights is None:
+        counts = np.bincount(keyCode, minlength = len(keys))
+    else:
+        counts = np.bincount(keyCode, weights = weights[starts], minlength = len(keys)).astype(np.int64)
+    first = starts[np.flatnonzero(keyCode > np.concatenate(([-1], np.maximum.accumulate(keyCode)[:-1])))]
+    pathways = nodeID[first[:, None] + np.arange(length)]
+
+    #Most used first, ties in the order of the node IDs
+    order = np.lexsort(tuple(pathways[:, step] for step in range(length - 1, -1, -1)) + (-counts,))
+    if top > 0:
+        order = order[:top]
+    return pathways[order], counts[order]
+
+
+def output_Pathway_file(file_output_info, labels):
+    """Outputs the PATHWAY file (a csv file, next to the Edge file) with the most used pathways of each length in
+    file_output_info['PATHWAYS'] (see count_pathways())
+    The rows are the subgroup rows, or file_output_info['PATHWAY_NODES'] if given (a tuple of NumPy arrays: ClientID and node
+    ID of each row), or file_output_info['UNIQUE_PATHWAYS'] if given (the rows of the distinct pathways, from unique_pathways())
+    labels: the node names, the name of node ID i in position i-1"""
+
+    weights = None
+    if 'UNIQUE_PATHWAYS' in file_output_info:
+        clientID, nodeID, weights = file_output_info['UNIQUE_PATHWAYS']
+    elif 'PATHWAY_NODES' in file_output_info:
+        clientID, nodeID = file_output_info['PATHWAY_NODES']
+    else:
+        clientID = subgroup_values(file_output_info, 'ClientID')
+        nodeID = subgroup_values(file_output_info, 'wardTeamCatCode')
+    if weights is None and file_output_info.get('DEDUPLICATE', 0):
+        #Count each distinct sequence of services once, weighted by the number of patients with it
+        clientID, nodeID, weights = unique_pathways(clientID, nodeID)
+    labels = np.asarray(labels, dtype = object)
+
+    pathwaysdf = []
+    for length in file_output_info['PATHWAYS']:
+        pathways, counts = count_pathways(clientID, nodeID, length, file_output_info.get('PATHWAYS_TOP', 0), weights)
+        pathwaysdf.append(pd.DataFrame({'Length' : length,
+                                        'Rank' : np.arange(1, len(counts) + 1),
+                                        'Pathway' : ['-'.join(map(str, pathway)) for pathway in pathways.tolist()],
+                                        'Labels' : [' > '.join(label) for label in labels[pathways - 1].tolist()],
+                                        'Weight' : counts},
+                                       columns = ['Length', 'Rank', 'Pathway', 'Labels', 'Weight']))
+
+    FileNamePathway = (file_output_info['FILESTART'] + file_output_info['FILEMIDDLE'] +
+                       file_output_info['FILEENDPATHWAY'] + file_output_info['FILEEX'])
+    write_output(file_output_info['FOLDER'] + FileNamePathway, pd.concat(pathwaysdf).to_csv, sep = ',', index = False)
+    return
+
+
+# ## Output formats
+# 
+# The output files of each network are csv files (<em>'CSV'</em>, the SM, SMsparse, Edge and Node files above), which Gephi imports as spreadsheets.  The csv files are large for large networks: the SM file has a value (as text) for every pair of nodes, most of which are 0.  <em>file_output_info['FORMATS']</em> lists the formats to output each network in (one or more):
+# 
+# 'CSV': the SM, SMsparse, Edge and Node csv files
+# 'NPZ': the service movement matrix as a compressed SciPy sparse matrix, only the non-zero elements (read back with <em>scipy.sparse.load_npz()</em>)
+# 'PARQUET': the SMsparse, Edge and Node tables as Parquet files, each column with its type (integers, decimals, text) rather than as text, and without the index column.  Needs pyarrow (or fastparquet) to be installed.
+# 'GEXF': the whole network as one GEXF file that Gephi opens directly, with the node attributes (Label, MeanLoS, MedianLoS, Setting) and the edge weights
+# 'GRAPHML': the same as one GraphML file (written by igraph, from <em>network_graph()</em>)
+# 
+# The filenames are those of the csv files with the extension of the format (the GEXF and GraphML files end with <em>file_output_info['FILEENDGRAPH']</em>).  <em>check_output_formats()</em> is called at the start of the run, so a format that cannot be written stops the run before the networks are created.
+
+# In[ ]:
+
+
+OUTPUT_FORMATS = ['CSV', 'NPZ', 'PARQUET', 'GEXF', 'GRAPHML']
+
+
+def check_output_formats(file_output_info):
+    """Raises an error if file_output_info['FORMATS'] has a format that is not known, or has 'PARQUET' and no library to 
+    write Parquet files is installed, or if the time windows are output as a dynamic graph ('GEXF') and overlap"""
+    if (file_output_info.get('SNAPSHOTS') and file_output_info.get('SNAPSHOT_OUTPUT', 'FILES') == 'GEXF' and 
+        file_output_info.get('SNAPSHOT_WINDOW', 1) > 1):
+        raise ValueError("The windows of a dynamic graph cannot overlap, SNAPSHOT_WINDOW must be 1 for 'GEXF'")
+    formats = file_output_info.get('FORMATS', ['CSV'])
+    unknown = [str(outputFormat) for outputFormat in formats if outputFormat not in OUTPUT_FORMATS]
+    if unknown:
+        raise ValueError('Unknown output format: ' + ', '.join(unknown) + ' (the formats are ' + ', '.join(OUTPUT_FORMATS) + ')')
+    if 'PARQUET' in formats:
+        import importlib.util
+        if importlib.util.find_spec('pyarrow') is None and importlib.util.find_spec('fastparquet') is None:
+            raise ImportError("The 'PARQUET' output format needs pyarrow (or fastparquet) to be installed")
+    return
+
+
+def write_text(filename, text):
+    """Writes the string text to the file filename (UTF-8)"""
+    with open(filename, 'w', encoding = 'utf-8') as textFile:
+        textFile.write(text)
+    return
+
+
+def network_gexf(servMove, nodesdf, edgeStats = None):
+    """Returns the text of a GEXF file for the network: servMove (SciPy sparse matrix) and nodesdf (Pandas dataframe of the 
+    nodes, as in the Node file), with the node attributes and the edge weights (and the edge attributes in edgeStats, see 
+    edge_table())"""
+    
+    from xml.sax.saxutils import quoteattr
+    #MeanLoS, MedianLoS and the statistics of node_stat_columns()
+    statistics = [attribute for attribute in nodesdf.columns if attribute not in ('ID', 'Label', 'Setting')]
+    nodeLines = []
+    for i in range(len(nodesdf)):
+        values = ['<attvalue for="Setting" value=%s/>' % quoteattr(str(nodesdf.Setting.values[i]))]
+        for attribute in statistics:
+            if not pd.isna(nodesdf[attribute].values[i]):
+                value = nodesdf[attribute].values[i]
+                values.append('<attvalue for="%s" value="%s"/>' % (attribute, int(value) if attribute == 'Count' else repr(float(value))))
+        nodeLines.append('      <node id="%d" label=%s>\n        <attvalues>%s</attvalues>\n      </node>' 
+                         % (nodesdf.ID.values[i], quoteattr(str(nodesdf.Label.values[i])), ''.join(values)))
+    edgesdf = edge_table(servMove, edgeStats)
+    edgeStatistics = [attribute for attribute in edgesdf.columns if attribute not in ('Source', 'Target', 'Type', 'Id', 'Weight')]
+    edgeLines = []
+    for i, edge in enumerate(zip(edgesdf.Id.tolist(), edgesdf.Source.tolist(), edgesdf.Target.tolist(), edgesdf.Weight.tolist())):
+        values = ['<attvalue for="%s" value="%s"/>' % (attribute, repr(float(edgesdf[attribute].values[i])))
+                  for attribute in edgeStatistics if not pd.isna(edgesdf[attribute].values[i])]
+        edgeLines.append('      <edge id="%d" source="%d" target="%d" weight="%d"' % edge + 
+                         ('>\n        <attvalues>%s</attvalues>\n      </edge>' % ''.join(values) if edgeStatistics else '/>'))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+            '  <graph mode="static" defaultedgetype="directed">\n'
+            '    <attributes class="node">\n'
+            '      <attribute id="Setting" title="Setting" type="string"/>\n' + 
+            ''.join('      <attribute id="%s" title="%s" type="%s"/>\n' % (attribute, attribute, 'integer' if attribute == 'Count' else 
+                                                                        'double') for attribute in statistics) +
+            '    </attributes>\n' + 
+            ('    <attributes class="edge">\n' + 
+             ''.join('      <attribute id="%s" title="%s" type="double"/>\n' % (attribute, attribute) 
+                     for attribute in edgeStatistics) + 
+             '    </attributes>\n' if edgeStatistics else '') + 
+            '    <nodes>\n' + '\n'.join(nodeLines) + '\n    </nodes>\n'
+            '    <edges>\n' + '\n'.join(edgeLines) + '\n    </edges>\n'
+            '  </graph>\n'
+            '</gexf>\n')
+
+
+def output_Graph_files(servMove, nodesdf, file_output_info):
+    """Outputs the network (servMove, and nodesdf as in the Node file) in each format of file_output_info['FORMATS'] other 
+    than 'CSV' (the csv files are output by write_SM_file(), output_Edge_file() and write_Node_file())"""
+    
+    formats = file_output_info.get('FORMATS', ['CSV'])
+    fileName = file_output_info['FOLDER'] + file_output_info['FILESTART'] + file_output_info['FILEMIDDLE']
+    if 'NPZ' in formats:
+        write_output(fileName + file_output_info['FILEENDSM'] + '.npz', scipy.sparse.save_npz, servMove.tocsr())
+    if not any(outputFormat in formats for outputFormat in ('PARQUET', 'GEXF', 'GRAPHML')):
+        return
+    #The nodes with a type for each column (the Node file from output_Node_file() has a column of objects)
+    nodesdf = nodesdf.astype(dict({'ID' : np.int64, 'Label' : str, 'MeanLoS' : np.float64, 'MedianLoS' : np.float64, 
+                                   'Setting' : str}, 
+                                  **{column : np.int64 if column == 'Count' else np.float64 
+                                     for column in node_stat_columns(file_output_info)}))
+    if 'PARQUET' in formats:
+        smCoo = servMove.tocoo()
+        smSparsedf = pd.DataFrame({'Source' : smCoo.row + 1, 'Target' : smCoo.col + 1, 'Weight' : smCoo.data})
+        write_output(fileName + file_output_info['FILEENDSMSPARSE'] + '.parquet', smSparsedf.to_parquet, index = False)
+        write_output(fileName + file_output_info['FILEENDEDGE'] + '.parquet', 
+                     edge_table(servMove, file_output_info.get('EDGE_WAITS')).to_parquet, index = False)
+        write_output(fileName + file_output_info['FILEENDNODE'] + '.parquet', nodesdf.to_parquet, index = False)
+    if 'GEXF' in formats:
+        write_output(fileName + file_output_info['FILEENDGRAPH'] + '.gexf', write_text, 
+                     network_gexf(servMove, nodesdf, file_output_info.get('EDGE_WAITS')))
+    if 'GRAPHML' in formats:
+        graph = network_graph(servMove, nodesdf)
+        if file_output_info.get('EDGE_WAITS') is not None:
+            #The edges of the graph are in the same order as in the Edge file
+            edgesdf = edge_table(servMove, file_output_info['EDGE_WAITS'])
+            for attribute in edge_stat_columns(file_output_info):
+                graph.es[attribute] = edgesdf[attribute].tolist()
+        write_output(fileName + file_output_info['FILEENDGRAPH'] + '.graphml', graph.write_graphml)
     return
 
 
@@ -267,10 +917,22 @@ def output_Node_file(file_output_info):#DATA_SG, FOLDER, FILESTART, FILEMIDDLE,
 # The function calls the series of three functions to create the three output files.
 # 
 # This function is called for each subset of data going to be represented in a network.  It gets passed a Pandas dataframe of the PD data (<em>DATA_SG</em>) and the variables contining the filename and file location.
+# 
+# A network with no rows (for example the network of a ClientID that is not in the data) is an error, rather than a network without any nodes: <em>check_network_rows()</em> raises a ValueError with the name of the network, in whichever way the networks are created (in memory, in a single pass, as snapshots, streaming, in delta mode or from partitions).  In delta mode a network can have no rows until a later period, so it is only an error if it has none once the new period has been added.
 
 # In[45]:
 
 
+def check_network_rows(name, nRows):
+    """Raises a ValueError if the network name has no rows of the PD data (nRows is 0)"""
+    
+    if nRows == 0:
+        raise ValueError('The network ' + str(name) + ' has no rows in the PD data (is its CLIENTID, ROWS or COLUMN in the '
+                         'input file?)')
+    return
+
+
+
 def create_output_files(file_output_info):#DATA_SG, FOLDER, FILESTART, FILEMIDDLE, FILEENDSM, FILEENDEDGE, FILEENDNODE, FILEEX):
     
     """Called for each subset of data going to be represented in a network. 
@@ -283,16 +945,45 @@ def create_output_files(file_output_info):#DATA_SG, FOLDER, FILESTART, FILEMIDDL
     "FILESTART" : String containing the input file name, and is used as the start of all the output file names 
     "FILEMIDDLE : String containing the subgroup specific part of the output file name (updated for each subgroup of data)
     "FILEENDSM" : String containing the end of the ServMove output file name
+    "FILEENDSMSPARSE" : String containing the end of the sparse (non-zero elements only) ServMove output file name
     "FILEENDEDGE" : String containing the end of the Edge output file name
     "FILEENDNODE" : String containing the end of the Node output file name
+    "FILEENDPATHWAY" : String containing the end of the Pathway output file name
+    "FILEENDGRAPH" : String containing the end of the GEXF and GraphML output file names
     "FILEEX" : String containing the file extension (both input and output)
+    "SINGLES" : NumPy array of the ClientIDs that only have 1 service use (set by output_SM_file)
+    "PATHWAYS" : List of the lengths of the pathways to count (see output_Pathway_file), none if empty
+    "DEDUPLICATE" : 1 to count the SM and Pathway files from the distinct pathways of the patients (see unique_pathways)
+    "FORMATS" : List of the formats to output the network in (see output_Graph_files), ['CSV'] if not given
+    "EDGE_STATS" : List of the statistics of the wait of each link to add to the Edge file (see edge_stats), none if empty
+    "EDGE_WAITS" : Pandas dataframe of the statistics of the wait of each link (set by output_SM_file)
         
-    Calls series of three functions to create the three output files
+    Calls series of three functions to create the three output files (and the Pathway file if PATHWAYS is not empty)
     """
     
-    servMove =output_SM_file(file_output_info)#DATA_SG, FOLDER, FILESTART, FILEMIDDLE, FILEENDSM, FILEEX)
-    output_Edge_file(servMove, file_output_info)#FOLDER, FILESTART, FILEMIDDLE, FILEENDEDGE, FILEEX)
-    output_Node_file(file_output_info)#DATA_SG, FOLDER, FILESTART, FILEMIDDLE, FILEENDNODE, FILEEX)
+    check_network_rows(file_output_info['FILEMIDDLE'], len(subgroup_values(file_output_info, 'ClientID')))
+    #The SM and Pathway files are counted from the same distinct pathways (see unique_pathways())
+    file_output_info.pop('UNIQUE_PATHWAYS', None)
+    if file_output_info.get('PATHWAYS') and file_output_info.get('DEDUPLICATE', 0):
+        file_output_info['UNIQUE_PATHWAYS'] = unique_pathways(subgroup_values(file_output_info, 'ClientID'), 
+                                                              subgroup_values(file_output_info, 'wardTeamCatCode'))
+    with stage('output_SM_file') as record:
+        servMove =output_SM_file(file_output_info)#DATA_SG, FOLDER, FILESTART, FILEMIDDLE, FILEENDSM, FILEEX)
+        record['Nodes'], record['Edges'] = servMove.shape[0], servMove.nnz
+    with stage('output_Edge_file') as record:
+        output_Edge_file(servMove, file_output_info)#FOLDER, FILESTART, FILEMIDDLE, FILEENDEDGE, FILEEX)
+        record['Edges'] = servMove.nnz
+    with stage('output_Node_file') as record:
+        nodesdf = output_Node_file(file_output_info)#DATA_SG, FOLDER, FILESTART, FILEMIDDLE, FILEENDNODE, FILEEX)
+        record['Nodes'] = servMove.shape[0]
+    if file_output_info.get('FORMATS', ['CSV']) != ['CSV']:
+        with stage('output_Graph_files'):
+            output_Graph_files(servMove, nodesdf, file_output_info)
+    if file_output_info.get('PATHWAYS'):
+        with stage('output_Pathway_file'):
+            output_Pathway_file(file_output_info, subgroup_values(file_output_info, 'wardTeamCat').categories)
+    file_output_info.pop('UNIQUE_PATHWAYS', None)
+    file_output_info.pop('EDGE_WAITS', None)
     return
 
 
@@ -310,17 +1001,140 @@ def set_dictionary_for_filenames():
     file_output_info = {"FOLDER" : 'Data/', 
                         "FILESTART" : 'ServUse15To18v6', 
                         "FILEENDSM" : '_SM_jupyter', 
+                        "FILEENDSMSPARSE" : '_SMsparse_jupyter', 
                         "FILEENDEDGE" : '_edgeList_jupyter', 
                         "FILEENDNODE" : '_nodeList_jupyter', 
-                        "FILEEX" : '.csv'}
+                        "FILEENDPATHWAY" : '_pathways_jupyter', 
+                        "FILEENDDYNAMIC" : '_dynamic_jupyter', 
+                        "FILEENDGRAPH" : '_graph_jupyter', 
+                        "FILEEX" : '.csv',
+                        "CACHE" : 1, #1: keep a copy of the prepared PD data in CACHEFOLDER for the next run to use
+                        "CACHEFOLDER" : 'Data/cache/',
+                        "RESULT_CACHE" : 0, #1: do not create again the networks whose output files are unchanged from the same data, settings and code (hashes every output file written)
+                        "WORKERS" : 1, #number of worker processes to create the networks with (1: no parallel processing)
+                        "STREAMING" : 0, #1: create the networks from the input file in chunks, for data too large for memory
+                        "CHUNKSIZE" : 100000, #number of rows of the input file in a chunk (if STREAMING)
+                        "PRESORTED" : 0, #1: the input file is already sorted by ClientID and ReferralDate (if STREAMING)
+                        "SORTPARTITIONS" : 16, #number of partition files to sort the input file on disk with (if STREAMING)
+                        "SHARDS" : 0, #number of partitions to split the patients into, each processed on its own (0: not sharded)
+                        "SHARDFOLDER" : 'Data/shards/', #folder of the partitions and their results (shared by the hosts, if SHARDS)
+                        "SHARD_STEP" : 'ALL', #step to run (if SHARDS): 'PARTITION', 'PROCESS', 'MERGE', or 'ALL' (all three)
+                        "SHARD_HOST" : 0, #number of this host, from 0 (if SHARD_STEP is 'PROCESS')
+                        "SHARD_HOSTS" : 1, #number of hosts processing the partitions (if SHARD_STEP is 'PROCESS')
+                        "DELTA" : 0, #1: keep the state of the networks, and update them with a new period of referrals
+                        "DELTAFILE" : '', #the file of the new period of referrals, in FOLDER without '.csv' (if DELTA)
+                        "PATHWAYS" : [], #lengths of the pathways of services to count (eg [3, 4]), in a Pathway file per network
+                        "PATHWAYS_TOP" : 100, #number of the most used pathways of each length to output (0: all)
+                        "NODE_STATS" : [], #statistics to add to the Node file: 'Count', and percentiles of the LoS (eg [25, 75])
+                        "LOS_SKETCH" : 0, #relative accuracy of the LoS statistics from a mergeable sketch (eg 0.01), 0: exact
+                        "EDGE_STATS" : [], #statistics of the wait (days) between the services of a link to add to the Edge file: 'Mean', 'Median', and percentiles (eg [90])
+                        "DEDUPLICATE" : 1, #1: count the pathways once for each distinct sequence of services, weighted by its patients
+                        "SNAPSHOTS" : '', #'M' or 'Q': create every network for each month or quarter (time windows)
+                        "SNAPSHOT_WINDOW" : 1, #number of months (or quarters) in a window (more than 1: sliding windows)
+                        "SNAPSHOT_OUTPUT" : 'FILES', #'FILES': the output files for each window, 'GEXF': a dynamic graph file
+                        "CUBE_COLUMNS" : ['Locality_Edit', 'Cluster', 'AgeAtRefGroup', 'GenSpecialty_Age', 'Setting', 'ClientID'], 
+                                                       #the columns the transition cube can be filtered on
+                        "CUBE_WARDTEAM" : 'WardTeam', #the column of the node names in the transition cube
+                        "CUBE_QUERIES" : [], #networks from the transition cube, the values to keep for each column of each 
+                                             #(eg {'Cluster' : [7], 'Locality_Edit' : ['North Devon'], 'AgeAtRefGroup' : [2]})
+                        "CUBE_REPRESENT_REMOVED" : 0, #1: represent the rows out of a query by a node for their value
+                        "FORMATS" : ['CSV'], #formats to output each network in: 'CSV', 'NPZ', 'PARQUET', 'GEXF', 'GRAPHML'
+                        "WRITERS" : 2, #number of threads to write the output files in the background with (0: no background writing)
+                        "WRITE_QUEUE" : 8, #most output files waiting to be written (the calculation waits when there are more)
+                        "INSTRUMENT" : 0} #1: record the time, memory, rows, nodes and edges of each stage in a run report
     
     return file_output_info
 
 
-# ### Function clean_data()  
-# Replace "Nan" with "None" in 6 columns
+# ## Function set_dictionary_for_data_schema()
+# 
+# The schema of the PD data, used when the input file is read in (see <em>read_data()</em>):
 # 
-# Replace "Nan" with the date the data was acquired for column ReferralDischarge.  This is due to the admission beign ongoing at the time the data was accessed.
+# "USECOLS" : Only the columns that are used to create the networks are read in (ReferralSource is not used)
+# "DTYPE" : ClientID is read as an integer, and the other columns (which have few different values) are read as categorical columns (a small integer code per row, and the value of each category held once), rather than a Python object per row
+# "DATECOLUMNS", "DATEFORMAT" : The date columns are converted to dates as they are read in, with the known format (much quicker than letting pandas guess the format).  There are only a few thousand different dates, so each is converted once (see <em>parse_dates()</em>)
+# "FILL" : The value for a missing value in each column, replaced in one step in <em>clean_data()</em>
+# "NUMBERS" : The categorical columns whose categories are numbers (Cluster, AgeAtRefGroup).  The categories are converted from text to numbers, as pandas would if the column was not categorical, so that the category names (and so the output filenames) are unchanged
+# "RELABEL" : The rules that change the WardTeam names in <em>clean_data()</em> (see <em>relabel()</em>)
+# "ONE_OOA" : The rules that make the WardTeamOneOOA column from the WardTeam column in <em>add_one_OOA_node_column()</em>
+
+# In[ ]:
+
+
+def set_dictionary_for_data_schema():
+    """Sets the directory that contains the schema of the PD data: the columns to read, their types, and the value to
+    replace a missing value with"""
+    
+    data_schema = {"USECOLS" : ['ClientID', 'ReferralDate', 'ReferralDischarge', 'WardTeam', 'Setting', 'Locality_Edit', 
+                                'Cluster', 'AgeAtRefGroup', 'GenSpecialty_Age'],
+                   "DTYPE" : {'ClientID' : np.int64,
+                              'ReferralDate' : 'category',
+                              'ReferralDischarge' : 'category',
+                              'WardTeam' : 'category',
+                              'Setting' : 'category',
+                              'Locality_Edit' : 'category',
+                              'Cluster' : 'category',
+                              'AgeAtRefGroup' : 'category',
+                              'GenSpecialty_Age' : 'category'},
+                   "DATECOLUMNS" : ['ReferralDate', 'ReferralDischarge'],
+                   "DATEFORMAT" : "%d/%m/%Y",
+                   "FILL" : {'Locality_Edit' : "None",
+                             'Cluster' : "None",
+                             'AgeAtRefGroup' : "None",
+                             'GenSpecialty_Age' : "None",
+                             'ReferralDischarge' : pd.Timestamp(2018, 2, 18)}, #the date the data was acquired
+                   "NUMBERS" : ['Cluster', 'AgeAtRefGroup'],
+                   #Harford has 2 Settings, and so is 2 WardTeams: "Harford Inpatient" and "Harford OOA"
+                   "RELABEL" : [{"RULE" : 'SPLIT', "NODES" : ['Harford'], "COLUMN" : 'Setting', "VALUES" : ['Inpatient', 'OOA']}],
+                   #The WardTeams of the WardTeamOneOOA column, with all of the OOA WardTeams as one node
+                   "ONE_OOA" : [{"RULE" : 'COLLAPSE', "COLUMN" : 'Setting', "VALUES" : ['OOA'], "NODE" : 'All OOA services'}]}
+    return data_schema
+
+
+# ## Function read_data()
+# Reads in the personality disorder admission data (all of it, or in chunks of <em>chunksize</em> rows) with the schema from <em>set_dictionary_for_data_schema()</em>.
+
+# In[ ]:
+
+
+def read_data(file_output_info, chunksize = None, filestart = None):
+    """Reads in the PD data from the input file, with the columns & types in set_dictionary_for_data_schema()
+    The input file is file_output_info['FILESTART'] (or filestart, if given) in file_output_info['FOLDER']
+    Returns the Pandas dataframe, or if chunksize is given, an iterator of Pandas dataframes of chunksize rows"""
+    
+    data_schema = set_dictionary_for_data_schema()
+    if filestart is None:
+        filestart = file_output_info['FILESTART']
+    #All of the types are given, so low_memory = False is not needed (it was needed when pandas guessed the types)
+    reader = pd.read_csv(file_output_info['FOLDER'] + str(filestart) + '.csv', 
+                         usecols = data_schema['USECOLS'], dtype = data_schema['DTYPE'], chunksize = chunksize)
+    if chunksize is None:
+        return parse_columns(reader, data_schema)
+    return (parse_columns(DATA, data_schema) for DATA in reader)
+
+
+def parse_columns(DATA, data_schema):
+    """Converts the date columns of the PD data (DATA) from text to dates, with the known format, and the categories of the
+    number columns from text to numbers
+    The columns are read in as categorical, so each different value is only converted once"""
+    for column in data_schema['DATECOLUMNS']:
+        codes = DATA[column].cat.codes.values
+        dates = pd.to_datetime(DATA[column].cat.categories, format = data_schema['DATEFORMAT']).values
+        DATA[column] = np.where(codes >= 0, dates[codes] if len(dates) else np.datetime64('NaT'), np.datetime64('NaT'))
+    for column in data_schema['NUMBERS']:
+        try:
+            numbers = pd.to_numeric(DATA[column].cat.categories)
+        except (ValueError, TypeError):
+            continue #a column with text values is left as text
+        if pd.api.types.is_integer_dtype(numbers) and DATA[column].isna().any():
+            numbers = numbers.astype(np.float64) #as pandas gives a number column with a missing value
+        if pd.api.types.is_numeric_dtype(numbers) and numbers.is_unique:
+            DATA[column] = DATA[column].cat.rename_categories(numbers)
+    return DATA
+
+
+# ### Function clean_data()  
+# Replace "Nan" with "None" in 4 columns, and with the date the data was acquired for column ReferralDischarge.  This is due to the admission beign ongoing at the time the data was accessed.  This is done in one step, with the values in <em>set_dictionary_for_data_schema()</em>.
 # 
 # Remove rows with no ReferralDate
 # 
@@ -338,45 +1152,36 @@ def clean_data(DATA):
     Cleans the data
     Returns the Pandas dataframe"""
     
-    DATA.ReferralSource.replace(np.nan,"None", inplace = True)
-    DATA.ReferralDate.replace(np.nan,"None", inplace = True)
-    DATA.Locality_Edit.replace(np.nan,"None", inplace = True)
-    DATA.Cluster.replace(np.nan,"None", inplace = True)
-    DATA.AgeAtRefGroup.replace(np.nan,"None", inplace = True)
-    DATA.GenSpecialty_Age.replace(np.nan,"None", inplace = True)
-
-    DATA.ReferralDischarge.replace(np.nan,"18/02/2018", inplace = True)
-
-    DATA = DATA[DATA.ReferralDate != "None"]
-
-#    newWardTeam = DATA.WardTeam.copy(deep = True)
-#    newWardTeam[(DATA.WardTeam == 'Harford') & (DATA.Setting == 'Inpatient')] = 'Harford Inpatient'
-#    newWardTeam[(DATA.WardTeam == 'Harford') & (DATA.Setting == 'OOA')] = 'Harford OOA'
-#    del DATA['WardTeam']
-#    DATA['WardTeam'] = newWardTeam
-    np1 = DATA.WardTeam.values
-    np2 = DATA.Setting.values
-    np1[(np1 == 'Harford') & (np2 == 'Inpatient')] = 'Harford Inpatient'
-    np1[(np1 == 'Harford') & (np2 == 'OOA')] = 'Harford OOA'
+    data_schema = set_dictionary_for_data_schema()
+    #Mark the admissions that were ongoing when the data was acquired, as they may be closed in a later period of data
+    DATA['OpenAdmission'] = DATA.ReferralDischarge.isna().values
+    #A categorical column can only be filled with one of its categories
+    for column, value in data_schema['FILL'].items():
+        if isinstance(DATA[column].dtype, pd.CategoricalDtype) and value not in DATA[column].cat.categories:
+            DATA[column] = DATA[column].cat.add_categories([value])
+    DATA = DATA.fillna(data_schema['FILL'])
+
+    DATA = DATA[DATA.ReferralDate.notna()]
+
+    #Split Harford by its Setting (the "RELABEL" rules of the schema)
+    wardTeam = relabel(DATA, data_schema['RELABEL'])[0]
     del DATA['WardTeam']
-    DATA.loc[:,'WardTeam'] = np1
+    DATA.loc[:,'WardTeam'] = wardTeam
     
     return DATA
 
 
 # ## Function calculate_variables()
-# Calculate Length of Stay - need to convert the format of the date columns to do this calculation
+# Calculate Length of Stay (the date columns were converted to dates when the data was read in)
 
 # In[48]:
 
 
 def calculate_LoS(DATA):
     """"Receives a Pandas dataframe (DATA) containing the PD data.
-    Changes the format of the date columns and calculates the length of stay (LoS).
+    Calculates the length of stay (LoS) from the date columns.
     Returns the Pandas dataframe"""
     
-    DATA['ReferralDate'] = pd.to_datetime(DATA['ReferralDate'], format = "%d/%m/%Y")
-    DATA['ReferralDischarge'] = pd.to_datetime(DATA['ReferralDischarge'], format = "%d/%m/%Y")
     DATA['LoSdays'] = (DATA.ReferralDischarge - DATA.ReferralDate).astype('timedelta64[D]')
     return DATA
 
@@ -410,33 +1215,216 @@ def sort_data(DATA):
     return DATA
 
 
-# ## Function create_DATA_with_one_OOA_node()
+# ## Function add_one_OOA_node_column()
 # 
-# Create another Pandas dataframe that represents all of the OOA nodes as 1 single node (by changing all the OOA nodes WardTeam names to "All OOA Services").
+# Add a column to the PD data (WardTeamOneOOA) that represents all of the OOA nodes as 1 single node (by changing all the OOA nodes WardTeam names to "All OOA Services").  The networks that use one OOA node use this column in place of WardTeam (subgroup_info['WARDTEAM']), so there is no need for a second copy of the PD data.
 # 
 
 # In[51]:
 
 
-def create_DATA_with_one_OOA_node(DATA_OneOOA):
-    """Dupicates the PD data (DATA) and represents all of the OOA nodes as one single node.
-    Changes all of the OOA node WardTeams to "All OOA Services" """
+def add_one_OOA_node_column(DATA):
+    """Adds the column WardTeamOneOOA to the PD data (DATA), which represents all of the OOA nodes as one single node.
+    A copy of WardTeam with all of the OOA node WardTeams changed to "All OOA Services" """
+    
+    DATA['WardTeamOneOOA'] = relabel(DATA, set_dictionary_for_data_schema()['ONE_OOA'])[0]
+    return DATA
+
+
+# ## The relabelling rules
+# 
+# The node of a row is its WardTeam name, which some networks change: the OOA WardTeams can be collapsed into one node, the rows of the subgroups not in focus are given the subgroup's node (if representing the removed data), and Harford is split by its Setting.  These changes are written as a list of rules (dictionaries), applied in turn:
+# 
+# {"RULE" : 'MAP', "MAP" : {name : new name}} : change the names in a mapping table (names not in the table are not changed)
+# {"RULE" : 'COLLAPSE', "COLUMN" : column, "VALUES" : [values], "NODE" : name, "SETTING" : (optional) setting} : the rows with one of the values in the column become the node name (with the setting, if given)
+# {"RULE" : 'SPLIT', "NODES" : [names], "COLUMN" : column, "VALUES" : [values]} : the rows of the named nodes with one of the values in the column become the node "name value"
+# {"RULE" : 'SUBGROUP', "COLUMN" : column, "FOCUS" : category, "NODE_NAME" : string, "SETTING" : (optional, 'Mixture')} : the rows not in the category in focus become the node "NODE_NAME" + their category, with the setting Mixture
+# 
+# Function <em>relabel()</em> does not apply the rules to each row.  Every column the rules use is categorical, so each row is a combination of a few categories (WardTeam, Setting and the rules' columns).  The rules are applied once to each combination found in the rows (<em>apply_relabel_rules()</em>), giving a lookup table from the combination's code to the new node name and Setting, and then each row takes its node and Setting from the table in one step.  The PD data is not changed: the result is new arrays.
+# 
+# The rules are used for the WardTeam column (the "RELABEL" rules of <em>set_dictionary_for_data_schema()</em>), the WardTeamOneOOA column (the "ONE_OOA" rules), the subgroup nodes of <em>create_new_ward_and_setting_columns()</em>, and a network's own rules (<em>subgroup_info['RELABEL']</em>, for example a mapping table to merge WardTeams), see <em>network_nodes()</em>.
+
+# In[ ]:
+
+
+def relabel_codes(DATA, column, rows = None):
+    """Returns a NumPy array of the code of each row's value in the column of the PD data (DATA, for the rows in rows, all
+    rows if None), and a NumPy array of the values of the codes (a missing value has its own code)"""
+    
+    values = DATA[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, categories = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, categories = pd.factorize(values.to_numpy())
+    if rows is not None:
+        codes = codes[rows]
+    categories = np.concatenate((np.asarray(categories, dtype = object), np.array([np.nan], dtype = object)))
+    return np.where(codes < 0, len(categories) - 1, codes).astype(np.int64), categories
+
+
+def apply_relabel_rules(rules, node, values):
+    """Returns the node name and the Setting of a row, after applying the rules in turn to its node name (node)
+    values: dictionary of the row's value in each column the rules use (and its Setting)"""
+    
+    setting = values.get('Setting')
+    for rule in rules:
+        if rule['RULE'] == 'MAP':
+            node = rule['MAP'].get(node, node)
+        elif rule['RULE'] == 'COLLAPSE':
+            if values[rule['COLUMN']] in rule['VALUES']:
+                node = rule['NODE']
+                setting = rule.get('SETTING', setting)
+        elif rule['RULE'] == 'SPLIT':
+            if node in rule['NODES'] and values[rule['COLUMN']] in rule['VALUES']:
+                node = str(node) + ' ' + str(values[rule['COLUMN']])
+        elif rule['RULE'] == 'SUBGROUP':
+            if values[rule['COLUMN']] != rule['FOCUS']:
+                node = str(rule['NODE_NAME'] + str(values[rule['COLUMN']]))
+                setting = rule.get('SETTING', 'Mixture')
+        else:
+            raise ValueError('Unknown relabelling rule: ' + str(rule['RULE']))
+    return node, setting
+
+
+def relabel(DATA, rules, column = 'WardTeam', rows = None):
+    """Applies the rules to the node names in the column of the PD data (DATA), for the rows in rows (all rows if None)
+    Returns a Pandas Categorical of the new node name of each row, and a NumPy array of the new Setting of each row
+    The rules are applied once to each combination of the values they use, not to each row (DATA is not changed)"""
+    
+    keyColumns = list(dict.fromkeys([column, 'Setting'] + [rule['COLUMN'] for rule in rules if 'COLUMN' in rule]))
+    #Code each row's combination of values, from the codes of the values in each column
+    combined = None
+    categories = []
+    for keyColumn in keyColumns:
+        codes, values = relabel_codes(DATA, keyColumn, rows)
+        combined = codes if combined is None else combined * len(values) + codes
+        categories.append(values)
+    combination, combinations = pd.factorize(combined)
+    
+    #Apply the rules to each combination found in the rows
+    nodes = np.empty(len(combinations), dtype = object)
+    settings = np.empty(len(combinations), dtype = object)
+    for c, key in enumerate(combinations):
+        values = {}
+        for keyColumn, keyValues in zip(keyColumns[::-1], categories[::-1]):
+            key, code = divmod(key, len(keyValues))
+            values[keyColumn] = keyValues[code]
+        nodes[c], settings[c] = apply_relabel_rules(rules, values[column], values)
+    
+    #Then each row takes its node name & Setting from its combination
+    nodeCode, nodeNames = pd.factorize(nodes, sort = True)
+    return pd.Categorical.from_codes(nodeCode[combination], nodeNames), settings[combination]
+
+
+def network_nodes(subgroup_info, DATA, rows = None, setting = False):
+    """Returns a Pandas Categorical of the node name of each row of the PD data (DATA) in the network, for the rows in rows
+    (all rows if None): the subgroup_info['WARDTEAM'] column, changed by the rules in subgroup_info['RELABEL'] (if any)
+    If setting, also returns a NumPy array of the Setting of each row (as changed by the rules)"""
+    
+    column = subgroup_info.get('WARDTEAM', 'WardTeam')
+    if subgroup_info.get('RELABEL'):
+        nodes, settings = relabel(DATA, subgroup_info['RELABEL'], column, rows)
+    else:
+        nodes = DATA[column].array
+        if not isinstance(nodes, pd.Categorical):
+            nodes = pd.Categorical(nodes)
+        nodes = nodes if rows is None else nodes.take(rows)
+        if setting:
+            settings = DATA.Setting.to_numpy() if rows is None else DATA.Setting.to_numpy()[rows]
+    return (nodes, settings) if setting else nodes
+
+
+# ## Function prepare_data()
+# 
+# Reads in the personality disorder admission data into a pandas dataframe (see <em>read_data()</em>).  This contains dated admissions to a specific ward team.  
+# 
+# <em>Note: needed to add low_memory=False to remove the error: "DtypeWarning: Columns (11,12) have mixed types. Specify dtype option on import or set low_memory=False."  The types of the columns are now given (see <em>set_dictionary_for_data_schema()</em>), so this is no longer needed.</em>
+# 
+# Then cleans the data, calculates the LoS (and removes negative LoS), sorts the data into blocks for each clientID with chronological ReferralDate (needs to be in format "%d/%m/%Y", else will order by day number first), and adds the column that represents all of the OOA nodes as 1 single node.
+# 
+# ## Function load_prepared_data()
+# 
+# Preparing the data is the same for every run that uses the same input file, so a copy of the prepared data is kept in a cache file (in <em>file_output_info['CACHEFOLDER']</em>) for the next run to load instead.
+# 
+# The cache file is named by a key (<em>prepared_data_key()</em>) made from a hash of the contents of the input file, and a hash of the code of the functions that prepare the data (so including the cleaning rules, such as the date used for an open admission).  If either the input file or the cleaning rules change then the key changes, and so the old cache file is not used: the data is prepared again, and the old cache file for the input file is removed.
+# 
+# The cache file is a pickle of the pandas dataframe.  (Parquet or Feather cannot store a column with a mixture of types, such as Cluster which has both numbers and "None", without changing the values.)
+# 
+# Set <em>file_output_info['CACHE']</em> to 0 to always prepare the data from the input file.
+
+# In[ ]:
+
+
+def prepare_data(file_output_info):
+    """Reads in the PD data, and cleans, calculates LoS, removes negative LoS, sorts and adds the one OOA node column
+    Returns the prepared Pandas dataframe"""
     
-    np1 = DATA_OneOOA.WardTeam.values
-    np2 = DATA_OneOOA.Setting.values
-    np1[np2 == 'OOA'] = str('All OOA services')
-    del DATA_OneOOA['WardTeam']
-    DATA_OneOOA['WardTeam'] = np1
-    return DATA_OneOOA
+    with stage('read_data') as record:
+        DATA = read_data(file_output_info)
+        record['RowsOut'] = len(DATA)
+    for function in (clean_data, calculate_LoS, delete_zero_LoS, sort_data, add_one_OOA_node_column):
+        with stage(function.__name__, rowsIn = len(DATA)) as record:
+            DATA = function(DATA)
+            record['RowsOut'] = len(DATA)
+    return DATA
+
+
+def hash_file(filename):
+    """Returns the SHA-256 hash of the contents of a file (read in blocks, so the file is not held in memory)"""
+    fileHash = hashlib.sha256()
+    with open(filename, 'rb') as dataFile:
+        for block in iter(lambda: dataFile.read(1 << 20), b''):
+            fileHash.update(block)
+    return fileHash.hexdigest()
+
+
+def prepared_data_key(file_output_info):
+    """Returns the key for the cache of the prepared PD data: a hash of the input file and of the code that prepares it"""
+    key = hashlib.sha256()
+    key.update(hash_file(file_output_info['FOLDER'] + str(file_output_info['FILESTART']) + '.csv').encode())
+    for function in (prepare_data, set_dictionary_for_data_schema, read_data, parse_columns, clean_data, calculate_LoS, delete_zero_LoS, sort_data, add_one_OOA_node_column, relabel_codes, apply_relabel_rules, relabel):
+        key.update(inspect.getsource(function).encode())
+    key.update(pd.__version__.encode())
+    return key.hexdigest()[:16]
+
+
+def load_prepared_data(file_output_info):
+    """Returns the prepared PD data, loaded from the cache if the input file and cleaning rules are unchanged,
+    otherwise prepared from the input file (and then stored in the cache)"""
+    
+    if not file_output_info.get('CACHE', 0):
+        return prepare_data(file_output_info)
+    
+    cacheStart = str(file_output_info['FILESTART']) + '_prepared_'
+    cacheFile = file_output_info['CACHEFOLDER'] + cacheStart + prepared_data_key(file_output_info) + '.pkl'
+    if os.path.exists(cacheFile):
+        with stage('load_prepared_data') as record, open(cacheFile, 'rb') as cache:
+            DATA = pickle.load(cache)
+            record['RowsOut'] = len(DATA)
+        return DATA
+    
+    DATA = prepare_data(file_output_info)
+    
+    #Remove the cache files from earlier versions of the input file or cleaning rules, then store this one
+    if not os.path.isdir(file_output_info['CACHEFOLDER']):
+        os.makedirs(file_output_info['CACHEFOLDER'])
+    for oldFile in os.listdir(file_output_info['CACHEFOLDER']):
+        if oldFile.startswith(cacheStart) and oldFile.endswith('.pkl'):
+            os.remove(file_output_info['CACHEFOLDER'] + oldFile)
+    #Write to a temporary file first, so an interrupted run does not leave a partial cache file
+    with open(cacheFile + '.tmp', 'wb') as cache:
+        pickle.dump(DATA, cache, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(cacheFile + '.tmp', cacheFile)
+    return DATA
 
 
 # ## Function create_new_ward_and_setting_columns()
 # 
 # Function is passed a dictionary (subgroup_info), a pandas dataframe (DATA_SG: the PD data to be represented as a network, so either the full dataset, or a subgroup), and the subgroup in focus (group).
 # 
-# Two new columns are added to the dataset DATA_SG: newWardTeam & newSetting.
+# Two new columns are created for the subgroup rows of DATA_SG: newNodeCode (the node registry code of the WardTeam, see <em>node_codes()</em>) & newSetting.  They are held as side arrays (file_output_info['SG_COLUMNS']), and are not added to the dataframe.
 # 
-# Either duplicate WardTeam & Setting (if not representing the excluded instances as a single subgroup node) but these 2 columns need to be present for consistency in the code to use these column names
+# Either duplicate WardTeam (or WardTeamOneOOA, see subgroup_info['WARDTEAM']) & Setting (if not representing the excluded instances as a single subgroup node) but these 2 columns need to be present for consistency in the code to use these column names
 # 
 # Or copy WardTeam & Setting & change the values for the subgroups not in focus (if representing the excluded instances as a single subgroup node)
 
@@ -445,33 +1433,26 @@ def create_DATA_with_one_OOA_node(DATA_OneOOA):
 
 def create_new_ward_and_setting_columns(subgroup_info,file_output_info,group):
     """Passed a dictionary, pandas dataframe and the subgroup in focus.
-    Adds 2 new columns: newWardTeam & Setting
+    Adds 2 new columns: newNodeCode (the node registry code of the WardTeam) & Setting
     Depending on the value of subgroup_info['REPRESENT_REMOVED'] these new columns are either duplicate WardTeam & Setting
     (if not representing the excluded instances as a single subgroup node) but these 2 columns need to be present for 
     consistency in the code to use these column names
     Or copy WardTeam & Setting & change the values for the subgroups not in focus (if representing the excluded 
     instances as a single subgroup node)"""
-#    DATA_SG = file_output_info['DATA_SG'].copy(deep = True)
     if subgroup_info['REPRESENT_REMOVED']:
         #Change required for the other subgroups
-        #Replace WardTeam name with Subgroup name. Replace Setting with the string Mixture
-        npWardTeam = file_output_info['DATA_SG'].WardTeam.values#.copy(deep = True)
-        npSetting = file_output_info['DATA_SG'].Setting.values#.copy(deep = True)#[:]
-        npColumn = file_output_info['DATA_SG'][subgroup_info['COLUMN']].values#.copy(deep = True)#[:]
-        for notgroup in file_output_info['DATA_SG'][subgroup_info['COLUMN']].unique():
-            if group != notgroup:
-                npWardTeam[npColumn == notgroup] = str(subgroup_info['SUBGROUP_NODE_NAME'] + str(notgroup))
-                npSetting[npColumn == notgroup] = str('Mixture')
-            file_output_info['DATA_SG']['newWardTeam'] = npWardTeam
-            file_output_info['DATA_SG']['newSetting'] = npSetting
+        #Replace WardTeam node with Subgroup node. Replace Setting with the string Mixture
+        #Both in one step with a SUBGROUP rule (see relabel()), which gives new arrays so the base dataframe is not changed
+        rules = list(subgroup_info.get('RELABEL', [])) + [{"RULE" : 'SUBGROUP', "COLUMN" : subgroup_info['COLUMN'], 
+                                                            "FOCUS" : group, "NODE_NAME" : subgroup_info['SUBGROUP_NODE_NAME']}]
+        nodes, npSetting = relabel(file_output_info['DATA_SG'], rules, subgroup_info.get('WARDTEAM', 'WardTeam'), 
+                                   file_output_info.get('ROWS'))
     else:
-        #No change required as removed the other subgroups.  Duplicate existing columns: WardTeam & Setting
-        #Duplicates WardTeam and Setting columns.
-        #For subgroups that do not require the contents of these columns to be changed.
-        #So other functions can still use 'newWardTeam' and 'newSetting' regardless of being changed or not"""
-        file_output_info['DATA_SG']['newWardTeam'] = file_output_info['DATA_SG']['WardTeam']
-        file_output_info['DATA_SG']['newSetting'] = file_output_info['DATA_SG']['Setting']
-#    file_output_info['DATA_SG'] = DATA_SG
+        #Otherwise no change required as removed the other subgroups, newNodeCode and newSetting are the existing columns
+        #So other functions can still use 'newNodeCode' and 'newSetting' regardless of being changed or not
+        nodes, npSetting = network_nodes(subgroup_info, file_output_info['DATA_SG'], file_output_info.get('ROWS'), setting = True)
+    npNodeCode = node_codes(file_output_info, nodes)
+    file_output_info['SG_COLUMNS'] = {'newNodeCode' : npNodeCode, 'newSetting' : npSetting}
     return file_output_info
 
 
@@ -483,31 +1464,38 @@ def create_new_ward_and_setting_columns(subgroup_info,file_output_info,group):
 # 
 # Dictionary 1: subgroup_info
 # 
-# 'DATA_COMPLETE': the complete PD data set (either with OOA services as individual nodes, or as a single node)
+# 'DATA': the complete PD data set (not a copy, it is not changed)
+# 'ROWS': (optional, if 'COLUMN' is '') only use these rows (positions in DATA)
+# 'CLIENTID': (optional, if 'COLUMN' is '') only use the rows of this patient
+# 'WARDTEAM': (optional) the column with the WardTeam names, either with OOA services as individual nodes ('WardTeam', the default), or as a single node ('WardTeamOneOOA')
+# 'RELABEL': (optional) a list of rules that change the WardTeam names for this network, for example a mapping table to merge WardTeams (see <em>relabel()</em>)
 # 'COLUMN': the column that contains the subgroup categories.  A set of output files will be created for each category in this column.
 # 'REPRESENT_REMOVED': how to deal with the excluded data (the other subgroups).  
 #     0: Do no represent the removed data
 #     1: Represent the removed data by replacing the WardTeam name with the subgroup name (see 'SUBGROUP_WARDTEAM')
 # 'SUBGROUP_FILENAME' : The string to state which column of data is used to divide the data into subgroups
 # 'SUBGROUP_WARDTEAM' : The string to replace the WardTeam name for the excluded subgroups, the specific subgroup will to tagged onto the WARDTEAM name.
+# 'SINGLE_PASS' : (optional) 1: calculate all of the categories together in <em>create_network_data_for_subgroup_single_pass()</em>. 0 (default): loop through the categories.
 # 
 # Dictionary 2: file_output_info
 # 
-# These 6 are constant throughout the program and unchanged here
+# These 7 are constant throughout the program and unchanged here
 # "FOLDER" : The subfolder where the input and output data are located
 # "FILESTART" : The filename of the input data, this is used for the start of the output filenames
 # "FILEENDSM" : End of the output filename for the <em>Service movement</em> data
+# "FILEENDSMSPARSE" : End of the output filename for the non-zero elements of the <em>Service movement</em> data
 # "FILEENDEDGE" : End of the output filename for the <em>Edge</em> data
 # "FILEENDNODE" : End of the output filename for the <em>Node</em> data
 # "FILEEX" : File extension for the input and output files
 # 
 # These 2 change for each definition of data group, and have their value defined in this function
 # "FILEMIDDLE" : Middle of the output filename to specify the subgroup
-# "DATA_SG" : Prepared PD dataset in terms of the subgroup, for the create_output_files function
+# "DATA_SG" : The complete PD dataset, for the create_output_files function
+# "ROWS" : The positions of the rows in DATA_SG that are in the subgroup
 # 
-# If the dataset is not going to represent the removed subgroups then the data is filtered by the subgroup in focus.
+# If the dataset is not going to represent the removed subgroups then ROWS is the rows for the subgroup in focus, otherwise it is all the rows with a value for the column.  The data is not copied.
 # 
-# Four new columns are added to the dataset (two in <em>create_new_ward_and_setting_columns()</em>, two in <em>add_columns_wardteamcatecode()</em>).
+# Four new columns are created for the subgroup rows (two in <em>create_new_ward_and_setting_columns()</em>, two in <em>add_columns_wardteamcatecode()</em>), and held in file_output_info['SG_COLUMNS'].
 # 
 # The updated directory <em>file_output_info</em> is passed to <em>function create_output_files()</em>.
 
@@ -517,18 +1505,12 @@ def create_new_ward_and_setting_columns(subgroup_info,file_output_info,group):
 def create_network_data_for_subgroup(subgroup_info,file_output_info):
     """If looking at a subset of data for the network, loop through the categories within the column and create output file for each
     If not represent the removed data then just take the filtered rows
+    If subgroup_info['SINGLE_PASS'] is 1, all of the categories are calculated together (see create_network_data_for_subgroup_single_pass())
+    The categories are run in parallel if file_output_info['WORKERS'] is more than 1 (see run_network_jobs())
+    Returns the memory report for the categories
     """
-    subgroup_info['DATA'] = subgroup_info['DATA'][subgroup_info['DATA'][subgroup_info['COLUMN']] != "None"] #Remove rows without a GenSpecialty_Age value
-    for group in subgroup_info['DATA'][subgroup_info['COLUMN']].unique():
-        if group != "None":
-            filename = make_filename(group)
-            if subgroup_info['REPRESENT_REMOVED']==0:
-                file_output_info['DATA_SG'] = subgroup_info['DATA'][subgroup_info['DATA'][subgroup_info['COLUMN']] == group].copy(deep = True) #Deep copy.
-            else:
-                file_output_info['DATA_SG'] = subgroup_info['DATA'].copy(deep = True) #Deep copy.
-            file_output_info=update_dictionary(subgroup_info,file_output_info,group,filename)
-            create_output_files(file_output_info)
-    return
+    jobs = list_network_jobs(subgroup_info,file_output_info)
+    return run_network_jobs(jobs, subgroup_info['DATA'], file_output_info.get('WORKERS', 1))
 
 
 def update_dictionary(subgroup_info,file_output_info,group,filename):
@@ -536,65 +1518,2137 @@ def update_dictionary(subgroup_info,file_output_info,group,filename):
     1. Add 2 columns to the pandas dataframe
     2. Add the numerical representation of WardTeams present in the pandas dataframe
     3. Update a dictionary"""
-    file_output_info = create_new_ward_and_setting_columns(subgroup_info,file_output_info,group)
-    file_output_info = categorise_columns(file_output_info)
+    rows = file_output_info.get('ROWS')
+    with stage('update_dictionary', rowsIn = len(rows) if rows is not None else len(file_output_info['DATA_SG'])):
+        file_output_info = create_new_ward_and_setting_columns(subgroup_info,file_output_info,group)
+        file_output_info = categorise_columns(file_output_info)
     #Update the 2 objects in the directory
     file_output_info ['FILEMIDDLE'] = str(subgroup_info['SUBGROUP_FILENAME']) + str(filename)
     #Call the function that calls the 3 functions in turn to output the files fo Gephi for this subgroup.
     return(file_output_info)
     
 
-# In[54]:
+# ## Running the networks as jobs, in parallel
+# 
+# Each network (and each category of a subgroup column) is independent of the others, so they can be created at the same time in separate worker processes.
+# 
+# Function <em>list_network_jobs()</em> turns a <em>subgroup_info</em> dictionary into a list of jobs, a job for each network to create.  A job is a dictionary that contains everything needed to create the network except the PD data: the <em>subgroup_info</em> and <em>file_output_info</em> settings, the category in focus (GROUP, FILENAME) and the rows of the PD data in the subgroup (ROWS).  If <em>subgroup_info['SINGLE_PASS']</em> is 1 then all of the categories are one job.
+# 
+# Function <em>run_network_jobs()</em> runs the jobs, one after the other if <em>workers</em> is 1, otherwise in a pool of <em>workers</em> processes.  The PD data is not sent to the workers with each job.  Where the operating system can fork a process (Linux, macOS) the workers share the PD data of the main process; otherwise it is sent once to each worker when the worker starts.  Each job writes its own output files, so the files are the same whichever way the jobs are run.
+# 
+# Function <em>run_network_job()</em> creates the output files for one job (in the worker), and returns its row of the memory report.
 
-if __name__ == '__main__':      
-    
-    file_output_info=set_dictionary_for_filenames()
-    
-    
-    # ### Read in the data
-    # Read in the personality disorder admission data into a pandas dataframe.  This contains dated admissions to a specific ward team.  
-    # 
-    # <em>Note: needed to add low_memory=False to remove the error: "DtypeWarning: Columns (11,12) have mixed types. Specify dtype option on import or set low_memory=False."</em>
-    
-    # In[55]:
-    
-    
-    DATA = pd.read_csv(file_output_info['FOLDER'] + str(file_output_info['FILESTART']) + '.csv', low_memory = False)
-    
-    
-    # ### Clean the data.  
-    
-    # In[56]:
-    
-    
-    DATA = clean_data(DATA)
+# In[ ]:
+
+
+#The PD data used by run_network_job(), set by set_worker_data() before the jobs are run
+WORKER_DATA = None
+
+
+def set_worker_data(DATA):
+    """Stores the PD data (DATA) for run_network_job() to use, in this process or in a worker process"""
+    global WORKER_DATA
+    WORKER_DATA = DATA
+    return
+
+
+def list_network_jobs(subgroup_info,file_output_info):
+    """Returns a list of jobs (dictionaries), a job for each network to be created for subgroup_info.
+    The jobs do not contain the PD data, so they are small to send to a worker process.
+    If subgroup_info['COLUMN'] is '' there is one job, for the rows in subgroup_info['ROWS'] (all rows if not given), or for
+    the rows of the patient subgroup_info['CLIENTID']
+    If subgroup_info['SINGLE_PASS'] is 1 there is one job for all of the categories within the column
+    Otherwise there is a job for each category within the column"""
+    
+    #Add the nodes of the network to the node registry here, so that every job (and worker process) has the same registry
+    register_nodes(file_output_info, np.asarray(network_nodes(subgroup_info, subgroup_info['DATA']).categories, dtype = object))
+    if subgroup_info['COLUMN'] != '' and subgroup_info['REPRESENT_REMOVED']:
+        register_nodes(file_output_info, [str(subgroup_info['SUBGROUP_NODE_NAME'] + str(group)) 
+                                          for group in pd.unique(subgroup_info['DATA'][subgroup_info['COLUMN']].to_numpy())
+                                          if group != "None"])
+    save_node_registry(file_output_info)
+    
+    settings = {'SUBGROUP_INFO' : {key : value for key, value in subgroup_info.items() if key not in ('DATA', 'ROWS')},
+                'FILE_OUTPUT_INFO' : {key : value for key, value in file_output_info.items() 
+                                      if key not in ('DATA_SG', 'ROWS', 'SG_COLUMNS', 'SINGLES', 'UNIQUE_PATHWAYS')},
+                'INSTRUMENT' : INSTRUMENTATION['START'] if INSTRUMENTATION is not None else None,
+                'WRITER' : OUTPUT_WRITER['SETTINGS'] if OUTPUT_WRITER is not None else None}
+    if subgroup_info['COLUMN'] == '':
+        rows = subgroup_info.get('ROWS')
+        if 'CLIENTID' in subgroup_info:
+            rows = np.flatnonzero(subgroup_info['DATA'].ClientID.values == subgroup_info['CLIENTID'])
+        return [dict(settings, NAME = str(subgroup_info['SUBGROUP_FILENAME']), SINGLE_PASS = 0, 
+                     ROWS = rows, GROUP = "", FILENAME = "")]
+    if subgroup_info.get('SINGLE_PASS', 0):
+        return [dict(settings, NAME = str(subgroup_info['SUBGROUP_FILENAME']), SINGLE_PASS = 1)]
+    
+    jobs = []
+    npColumn = subgroup_info['DATA'][subgroup_info['COLUMN']].to_numpy()
+    hasValue = npColumn != "None" #Remove rows without a value for the column
+    check_network_rows(subgroup_info['SUBGROUP_FILENAME'], np.count_nonzero(hasValue))
+    for group in pd.unique(npColumn[hasValue]):
+        if group != "None":
+            filename = make_filename(group)
+            if subgroup_info['REPRESENT_REMOVED']==0:
+                rows = np.flatnonzero(hasValue & (npColumn == group))
+            else:
+                rows = np.flatnonzero(hasValue)
+            jobs.append(dict(settings, NAME = str(subgroup_info['SUBGROUP_FILENAME']) + str(filename), SINGLE_PASS = 0, 
+                             ROWS = rows, GROUP = group, FILENAME = filename))
+    return jobs
+
+
+def run_network_job(job):
+    """Creates the output files for one job from list_network_jobs(), using the PD data stored by set_worker_data()
+    Returns the job's row of the memory report (with the output files the job wrote, in 'FILES', and the job's rows of the 
+    run report, in 'STAGES', and of the manifest, in 'MANIFEST', if run in a worker process)"""
+    
+    #In a worker process, the stages of the job are recorded here and returned to the main process
+    inWorker = job.get('INSTRUMENT') is not None and (INSTRUMENTATION is None or INSTRUMENTATION['WORKER'] or 
+                                                      INSTRUMENTATION['PID'] != os.getpid())
+    if inWorker:
+        start_instrumentation(worker = True)
+        INSTRUMENTATION['START'] = job['INSTRUMENT'] #the times are from the start of the main process's report
+    #In a worker process, the output files are written by the worker's own output writer
+    writerInWorker = job.get('WRITER') is not None and (OUTPUT_WRITER is None or OUTPUT_WRITER['PID'] != os.getpid())
+    if writerInWorker:
+        start_output_writer(job['WRITER'])
+    firstFile = len(OUTPUT_WRITER['FILES']) if OUTPUT_WRITER is not None else 0
+    memory_report = start_memory_report([], job['NAME'])
+    subgroup_info = dict(job['SUBGROUP_INFO'], DATA = WORKER_DATA)
+    file_output_info = dict(job['FILE_OUTPUT_INFO'], DATA_SG = WORKER_DATA) #Not a copy, the subgroup is the rows in ROWS
+    with stage('network_job', network = job['NAME'], rowsIn = len(job['ROWS']) if job.get('ROWS') is not None else None):
+        if job['SINGLE_PASS']:
+            create_network_data_for_subgroup_single_pass(subgroup_info,file_output_info)
+        else:
+            file_output_info['ROWS'] = job['ROWS']
+            file_output_info = update_dictionary(subgroup_info,file_output_info,job['GROUP'],job['FILENAME'])
+            create_output_files(file_output_info)
+    memory_report = end_memory_report(memory_report)[0]
+    if OUTPUT_WRITER is not None:
+        memory_report['FILES'] = OUTPUT_WRITER['FILES'][firstFile:]
+    if inWorker:
+        memory_report['STAGES'] = stop_instrumentation()
+    if writerInWorker:
+        memory_report['MANIFEST'] = stop_output_writer()
+    return memory_report
+
+
+def run_network_jobs(jobs, DATA, workers, run = run_network_job):
+    """Runs the jobs from list_network_jobs() on the PD data (DATA), in a pool of worker processes if workers is more than 1
+    run: (optional) the function that runs a job (run_shard_job() for the jobs of create_networks_sharded())
+    Returns the memory report, a row per job in the order of the jobs"""
+    
+    set_worker_data(DATA)
+    if workers <= 1 or len(jobs) <= 1:
+        return [run(job) for job in jobs]
+    
+    import multiprocessing
+    flush_output_writer() #no file is being written when the workers are forked
+    if 'fork' in multiprocessing.get_all_start_methods():
+        #The workers are forked from this process, and so already have the PD data
+        pool = multiprocessing.get_context('fork').Pool(workers)
+    else:
+        #Each worker is sent the PD data once, when it starts
+        pool = multiprocessing.get_context('spawn').Pool(workers, initializer = set_worker_data, initargs = (DATA,))
+    try:
+        memory_report = pool.map(run, jobs, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+    #Add the stages recorded in the workers to the run report, and the files they wrote to the manifest
+    for row in memory_report:
+        for record in row.pop('STAGES', []):
+            if INSTRUMENTATION is not None:
+                record_stage(record)
+        manifest = row.pop('MANIFEST', [])
+        if OUTPUT_WRITER is not None:
+            OUTPUT_WRITER['MANIFEST'].extend(manifest)
+    return memory_report
+
+
+def create_networks(networks, file_output_info, DATA):
+    """Creates the output files for a list of networks (a subgroup_info dictionary for each), running all of their jobs 
+    together so that they can share a pool of file_output_info['WORKERS'] worker processes
+    If file_output_info['RESULT_CACHE'] is 1, the jobs whose output files are there unchanged from the same data, settings
+    and code are not run (see job_fingerprint())
+    Returns the memory report, a row per job (the jobs not run have Reused 1, and no RSS)"""
+    
+    jobs = []
+    for subgroup_info in networks:
+        jobs += list_network_jobs(subgroup_info,file_output_info)
+    names = [job['NAME'] for job in jobs]
+    results = {}
+    if file_output_info.get('RESULT_CACHE', 0):
+        with stage('check_result_cache'):
+            dataKey, codeKey = prepared_data_key(file_output_info), code_version()
+            cached = load_result_cache(file_output_info)
+            fingerprints = {job['NAME'] : job_fingerprint(job, dataKey, codeKey) for job in jobs}
+            for job in jobs:
+                entry = cached.get(job['NAME'])
+                if entry is not None and entry['FINGERPRINT'] == fingerprints[job['NAME']] and outputs_unchanged(entry):
+                    results[job['NAME']] = entry
+            jobs = [job for job in jobs if job['NAME'] not in results]
+    reused = dict(results)
+    with stage('create_networks', rowsIn = len(DATA)):
+        memory_report = run_network_jobs(jobs, DATA, file_output_info.get('WORKERS', 1))
+    
+    files = [row.pop('FILES', None) for row in memory_report]
+    #The jobs not run are in the memory report, and their output files in the manifest, as reused
+    if reused:
+        for entry in reused.values():
+            if OUTPUT_WRITER is not None:
+                OUTPUT_WRITER['MANIFEST'].extend({'File' : output['File'], 'Bytes' : output['Bytes'], 'Seconds' : 0., 
+                                                  'Reused' : 1} for output in entry['FILES'])
+        rows = {row['Network'] : row for row in memory_report}
+        memory_report = [rows.get(name, {'Network' : name, 'Reused' : 1}) for name in names]
+    if file_output_info.get('RESULT_CACHE', 0):
+        #Record the output files of the jobs that were run, once they have all been written
+        flush_output_writer()
+        for job, jobFiles in zip(jobs, files):
+            if jobFiles is not None:
+                results[job['NAME']] = {'FINGERPRINT' : fingerprints[job['NAME']], 
+                                        'FILES' : [{'File' : filename, 'Bytes' : os.path.getsize(filename), 
+                                                    'MTime' : os.stat(filename).st_mtime_ns, 'SHA256' : hash_file(filename)} 
+                                                   for filename in dict.fromkeys(jobFiles)]}
+        save_result_cache(file_output_info, results)
+    return memory_report
+
+
+# ## Skipping the networks that have not changed (the result cache)
+# 
+# A network job only needs to be run again if its output files would be different: if the input file, the settings of the job or the code have changed.  When <em>file_output_info['RESULT_CACHE']</em> is 1, <em>create_networks()</em> gives each job a fingerprint (<em>job_fingerprint()</em>), a hash of:
+# 
+# 1. The key of the prepared PD data: a hash of the input file and of the code that prepares it (see <em>prepared_data_key()</em>)
+# 2. The settings of the job: its subgroup_info (COLUMN, REPRESENT_REMOVED, SUBGROUP_NODE_NAME, WARDTEAM (so whether the OOA WardTeams are one node), CLIENTID, RELABEL...), its category, its rows (the positions of the rows of the network in the prepared data, which can be given in subgroup_info['ROWS'] and are not in the settings), and the file_output_info settings except those that do not change the output files (<em>RESULT_CACHE_IGNORE</em>, such as WORKERS)
+# 3. The version of the code (<em>code_version()</em>): a hash of the code of the functions.  The main code is not included, so adding a network to the main code does not change the fingerprints of the other networks
+# 
+# The result cache (a json file in <em>file_output_info['CACHEFOLDER']</em>) keeps the fingerprint of each job that was run, and the name, size, modification time and SHA-256 hash of each output file it wrote (the output writer keeps the list of the files each job writes, see <em>write_output()</em>).  A job whose fingerprint is in the cache is not run if its output files are all there unchanged (<em>outputs_unchanged()</em>).  The cache is then written again with only the jobs of this run, so the entries of the networks no longer created, and the old fingerprints of the jobs that were run again, are removed.
+# 
+# The memory report has a row for each job, with Reused 1 (and no RSS) for the jobs that were skipped, and the manifest has the output files of the skipped jobs (from their entries in the cache) with Reused 1.
+# 
+# The result cache is off by default, as the SHA-256 hash of every output file written is found for the cache.
+
+# In[ ]:
+
+
+#The file_output_info settings that do not change the output files of a job, and so are not in its fingerprint
+RESULT_CACHE_IGNORE = ('NODE_REGISTRY', 'CACHE', 'CACHEFOLDER', 'RESULT_CACHE', 'WORKERS', 'WRITERS', 'WRITE_QUEUE', 'INSTRUMENT')
+
+
+def code_version():
+    """Returns a hash of the code of the functions (not of the main code, or of set_dictionary_for_filenames(), whose 
+    settings are in the fingerprint of each job)"""
+    version = hashlib.sha256()
+    for name, function in sorted(globals().items()):
+        if inspect.isfunction(function) and function.__module__ == __name__ and function is not set_dictionary_for_filenames:
+            version.update(inspect.getsource(function).encode())
+    version.update(pd.__version__.encode())
+    return version.hexdigest()[:16]
+
+
+def job_fingerprint(job, dataKey, codeKey):
+    """Returns the fingerprint of a job from list_network_jobs(): a hash of the key of the prepared PD data (dataKey), the 
+    settings and rows of the job and the version of the code (codeKey)"""
+    fingerprint = hashlib.sha256()
+    fingerprint.update(dataKey.encode())
+    fingerprint.update(codeKey.encode())
+    fingerprint.update(repr(sorted(job['SUBGROUP_INFO'].items())).encode())
+    fingerprint.update(repr([job.get(key) for key in ('NAME', 'SINGLE_PASS', 'GROUP', 'FILENAME')]).encode())
+    #The rows of the job (subgroup_info['ROWS'], or the rows of its category or patient) are not in its settings
+    rows = job.get('ROWS')
+    fingerprint.update(np.ascontiguousarray(rows, dtype = np.int64).tobytes() if rows is not None else b'None')
+    fingerprint.update(repr(sorted((key, value) for key, value in job['FILE_OUTPUT_INFO'].items() 
+                                   if key not in RESULT_CACHE_IGNORE)).encode())
+    return fingerprint.hexdigest()
+
+
+def load_result_cache(file_output_info):
+    """Returns the result cache (a dictionary keyed on the name of each job: FINGERPRINT, and FILES, a row per output file), 
+    empty if there is no result cache file"""
+    cacheFile = file_output_info['CACHEFOLDER'] + str(file_output_info['FILESTART']) + '_results.json'
+    if not os.path.exists(cacheFile):
+        return {}
+    with open(cacheFile) as cache:
+        return json.load(cache)
+
+
+def outputs_unchanged(entry):
+    """Returns True if the output files of a job in the result cache (entry) are all there unchanged: the same size, and the
+    same modification time (or, if the file has been touched, the same SHA-256 hash)"""
+    for output in entry['FILES']:
+        if not os.path.exists(output['File']) or os.path.getsize(output['File']) != output['Bytes']:
+            return False
+        if os.stat(output['File']).st_mtime_ns != output['MTime'] and hash_file(output['File']) != output['SHA256']:
+            return False
+    return True
+
+
+def save_result_cache(file_output_info, results):
+    """Writes the result cache (results, see load_result_cache()) to its file in file_output_info['CACHEFOLDER']"""
+    if not os.path.isdir(file_output_info['CACHEFOLDER']):
+        os.makedirs(file_output_info['CACHEFOLDER'])
+    #Write to a temporary file first, so an interrupted run does not leave a partial cache file
+    cacheFile = file_output_info['CACHEFOLDER'] + str(file_output_info['FILESTART']) + '_results.json'
+    write_text(cacheFile + '.tmp', json.dumps(results, indent = 1))
+    os.replace(cacheFile + '.tmp', cacheFile)
+    return
+
+
+# ## Function create_network_data_for_subgroup_single_pass()
+# 
+# Looping through the categories in <em>create_network_data_for_subgroup()</em> copies and re-scans the whole dataset once per category.  When <em>subgroup_info['SINGLE_PASS']</em> is 1, this function is used instead and creates the same output files for every category from one pass of the data.
+# 
+# Every row is tagged with the code of its category (its subgroup key), and every WardTeam (and every subgroup node name, "SUBGROUP_NODE_NAME" + category) is given a code from one sorted list of names.
+# 
+# If not representing the removed data (<em>REPRESENT_REMOVED</em> = 0), the rows are ordered by category (keeping the patient & chronological order within a category), and a transition is a row followed by a row for the same patient in the same category.
+# 
+# If representing the removed data (<em>REPRESENT_REMOVED</em> = 1), every transition in the whole dataset is used by every category's network.  For the category in focus, the Source (and Target) is the WardTeam if the row is in that category, otherwise the subgroup node for the row's category.  So a transition between two rows of the same category gives one WardTeam to WardTeam link for that category; a transition between two different categories gives a WardTeam to subgroup node link for each of the two categories; and all of the other categories get a subgroup node to subgroup node link, which are counted once and then added to each of them.
+# 
+# The transitions are counted for all categories at once, and the mean and median LoS are calculated for all (category, WardTeam) pairs (and for each subgroup node) in one groupby.  The results for each category are then given node IDs that run from 1 to n (in the sorted order of the node names, as in <em>categorise_columns()</em>) and written out with <em>write_SM_file()</em>, <em>output_Edge_file()</em> and <em>write_Node_file()</em>.
+
+# In[ ]:
+
+
+def create_network_data_for_subgroup_single_pass(subgroup_info,file_output_info,sink = None):
+    """Creates the output files for every category within the column from one pass of the data
+    Gives the same output files as looping through the categories in create_network_data_for_subgroup(), for both
+    values of subgroup_info['REPRESENT_REMOVED']
+    If subgroup_info['COLUMN'] is '' there is one network, for the rows in subgroup_info['ROWS'] (or of the patient
+    subgroup_info['CLIENTID']) if given
+    The network of each category is passed to sink (see write_subgroup_networks()), which outputs the files by default
+    """
+    #Take the columns needed for the rows with a value for the column (not a copy of the whole dataset)
+    rows, npColumn = network_rows(subgroup_info, subgroup_info['DATA'])
+    check_network_rows(subgroup_info['SUBGROUP_FILENAME'], len(rows))
+    clientID = subgroup_info['DATA'].ClientID.values[rows]
+    nodes, npSetting = network_nodes(subgroup_info, subgroup_info['DATA'], rows, setting = True)
+    npNodeCode = node_codes(file_output_info, nodes)
+    
+    #Tag each row with the code of its category (in the order the categories first appear)
+    groupCode, groups = pd.factorize(npColumn[rows])
+    
+    #Code every WardTeam and every subgroup node name from one sorted list of names
+    with stage('count_subgroup_links', rowsIn = len(rows)):
+        names, wardCode, subgroupCode = code_subgroup_nodes(subgroup_info, file_output_info, groups, npNodeCode)
+        transitions, singles, singlesGroup = subgroup_transitions(subgroup_info, clientID, groupCode, wardCode)
+        links, groupMove = transition_links(subgroup_info, transitions, subgroupCode, len(groups))
+        links = add_group_moves(links, groupMove, subgroupCode)
+    
+    #Statistics of the wait of every (category, Source, Target) link, from the rows of the same transitions
+    linkStats = None
+    if file_output_info.get('EDGE_STATS'):
+        with stage('edge_stats', rowsIn = len(rows)):
+            wait = transition_waits(subgroup_info['DATA'].ReferralDate.values[rows], 
+                                    subgroup_info['DATA'].ReferralDischarge.values[rows], transitions[5], transitions[4])
+            linkStats = subgroup_edge_stats(subgroup_info, file_output_info, transitions, wait, subgroupCode, len(groups))
+
+    #Mean & median LoS (and the Setting) for every (category, WardTeam) in one grouped pass
+    with stage('node_stats', rowsIn = len(rows)):
+        nodeStats = pd.DataFrame({'group' : groupCode, 'ward' : wardCode, 'LoSdays' : subgroup_info['DATA'].LoSdays.values[rows], 
+                                  'Setting' : npSetting})
+        wardStats = node_stats(nodeStats, ['group', 'ward'], file_output_info, first = ['Setting']).reset_index()
+        subgroupStats = None
+        if subgroup_info['REPRESENT_REMOVED']:
+            #A subgroup node has the LoS of all of the rows in its category, the same for every other category's network
+            subgroupStats = node_stats(nodeStats, ['group'], file_output_info)
+    
+    pathways = (clientID, groupCode, wardCode) if file_output_info.get('PATHWAYS') else None
+    write_subgroup_networks(subgroup_info, file_output_info, groups, names, subgroupCode, links, wardStats, subgroupStats,
+                            singles, singlesGroup, sink = sink, pathways = pathways, linkStats = linkStats)
+    return
+
+
+def code_subgroup_names(subgroup_info, groups, npWardTeam):
+    """Codes every WardTeam (in npWardTeam) and every subgroup node name ("SUBGROUP_NODE_NAME" + category, if representing
+    the removed data) from one sorted list of names
+    Returns the sorted NumPy array of names, the code of each value in npWardTeam, and the code of each category's subgroup node"""
     
+    wardCode, wardNames = pd.factorize(npWardTeam, sort = True)
+    if subgroup_info['REPRESENT_REMOVED']:
+        subgroupNames = np.array([str(subgroup_info['SUBGROUP_NODE_NAME'] + str(group)) for group in groups], dtype = object)
+    else:
+        subgroupNames = np.array([], dtype = object)
+    names = np.unique(np.concatenate((np.asarray(wardNames, dtype = object), subgroupNames)))
+    wardCode = np.searchsorted(names, np.asarray(wardNames, dtype = object))[wardCode]
+    subgroupCode = np.searchsorted(names, subgroupNames)
+    return names, wardCode, subgroupCode
+
+
+def code_subgroup_nodes(subgroup_info, file_output_info, groups, npNodeCode):
+    """As code_subgroup_names(), for the node registry codes of the WardTeams (npNodeCode, see node_codes()) rather than 
+    their names, so no names are compared
+    Returns the sorted NumPy array of names, the code of each value in npNodeCode, and the code of each category's subgroup node"""
     
-    # ### Calculate new variables
+    registry = file_output_info['NODE_REGISTRY']
+    subgroupNodes = np.zeros(0, dtype = np.int64)
+    if subgroup_info['REPRESENT_REMOVED']:
+        subgroupNodes = register_nodes(file_output_info, [str(subgroup_info['SUBGROUP_NODE_NAME'] + str(group)) 
+                                                          for group in groups])
+        registry = file_output_info['NODE_REGISTRY']
+    #The nodes used, in the sorted order of their names, coded from 0
+    used = np.bincount(npNodeCode, minlength = len(registry['NAMES'])) > 0
+    used[subgroupNodes] = True
+    used = np.flatnonzero(used)
+    used = used[np.argsort(registry['RANK'][used])]
+    localCode = np.zeros(len(registry['NAMES']), dtype = np.int64)
+    localCode[used] = np.arange(len(used))
+    return registry['NAMES'][used], localCode[npNodeCode], localCode[subgroupNodes]
+
+
+def count_subgroup_links(subgroup_info, clientID, groupCode, wardCode, subgroupCode, nGroups):
+    """Finds the transitions for every category's network at once
+    Recieves NumPy arrays for the rows (ordered by patient & chronologically): ClientID, category code and WardTeam code, 
+    and the code of each category's subgroup node (from code_subgroup_names())
+    Returns the links as a tuple of NumPy arrays (category, Source, Target, count), the number of transitions between each
+    pair of categories (groupMove, None if not representing the removed data, see add_group_moves()), and the ClientIDs of 
+    the patients that only have 1 service use with the category of each (None if the same for every category)"""
+
+    transitions, singles, singlesGroup = subgroup_transitions(subgroup_info, clientID, groupCode, wardCode)
+    links, groupMove = transition_links(subgroup_info, transitions, subgroupCode, nGroups)
+    return links, groupMove, singles, singlesGroup
+
+
+def subgroup_transitions(subgroup_info, clientID, groupCode, wardCode):
+    """Finds every transition (a row followed by a row for the same patient) for every category's network at once
+    Recieves NumPy arrays for the rows (ordered by patient & chronologically): ClientID, category code and WardTeam code
+    Returns the transitions as a tuple of NumPy arrays (Source category, Target category, Source WardTeam, Target WardTeam, 
+    position of the Target row, position of the Source row), and the ClientIDs of the patients that only have 1 service use with the category of each 
+    (None if the same for every category)"""
+
+    if subgroup_info['REPRESENT_REMOVED']:
+        #Each transition in the whole dataset
+        sameClient = clientID[:-1] == clientID[1:]
+        targetRow = np.flatnonzero(sameClient) + 1
+        sourceRow = targetRow - 1
+
+        #Patients that only have 1 service use, the same for every category (no rows if there are none)
+        startsBlock = np.concatenate(([True], ~sameClient))[:len(clientID)]
+        endsBlock = np.concatenate((~sameClient, [True]))[:len(clientID)]
+        singlesGroup = None
+        singles = clientID[startsBlock & endsBlock]
+    else:
+        #Order the rows by category, keeping the patient & chronological order within each category
+        order = np.argsort(groupCode, kind = 'stable')
+        orderedClientID = clientID[order]
+        orderedGroup = groupCode[order]
+        sameClient = (orderedClientID[:-1] == orderedClientID[1:]) & (orderedGroup[:-1] == orderedGroup[1:])
+        sourceRow = order[:-1][sameClient]
+        targetRow = order[1:][sameClient]
+
+        #Patients that only have 1 service use within a category
+        startsBlock = np.concatenate(([True], ~sameClient))[:len(clientID)]
+        endsBlock = np.concatenate((~sameClient, [True]))[:len(clientID)]
+        singlesGroup = orderedGroup[startsBlock & endsBlock]
+        singles = orderedClientID[startsBlock & endsBlock]
+    transitions = (groupCode[sourceRow], groupCode[targetRow], wardCode[sourceRow], wardCode[targetRow], targetRow, sourceRow)
+    return transitions, singles, singlesGroup
+
+
+def transition_links(subgroup_info, transitions, subgroupCode, nGroups, count = None):
+    """Turns the transitions from subgroup_transitions() into the links of every category's network
+    count: (optional) NumPy array of the number of times each transition is used (1 if None)
+    Returns the links as a tuple of NumPy arrays (category, Source, Target, count), and the number of transitions between 
+    each pair of categories (groupMove, None if not representing the removed data, see add_group_moves())"""
+
+    sourceGroup, targetGroup, sourceWard, targetWard = transitions[:4]
+    if count is None:
+        count = np.ones(len(sourceGroup), dtype = np.int64)
+    if not subgroup_info['REPRESENT_REMOVED']:
+        #Both rows of a transition are in the same category
+        return (sourceGroup, sourceWard, targetWard, count), None
+
+    sameGroup = sourceGroup == targetGroup
+    #The subgroup node to subgroup node links, counted once for each pair of categories
+    groupMove = np.bincount(sourceGroup * nGroups + targetGroup, weights = count, 
+                            minlength = nGroups * nGroups).astype(np.int64).reshape((nGroups, nGroups))
+    
+    #(category, Source, Target, count) for three of the four types of link (the fourth is added by add_group_moves())
+    linkGroup = np.concatenate((sourceGroup[sameGroup], sourceGroup[~sameGroup], targetGroup[~sameGroup]))
+    linkSource = np.concatenate((sourceWard[sameGroup], sourceWard[~sameGroup], subgroupCode[sourceGroup[~sameGroup]]))
+    linkTarget = np.concatenate((targetWard[sameGroup], subgroupCode[targetGroup[~sameGroup]], targetWard[~sameGroup]))
+    linkCount = np.concatenate((count[sameGroup], count[~sameGroup], count[~sameGroup]))
+    return (linkGroup, linkSource, linkTarget, linkCount), groupMove
+
+
+def add_group_moves(links, groupMove, subgroupCode):
+    """Adds the subgroup node to subgroup node links to the links from count_subgroup_links()
+    A transition from category i to category j (groupMove[i, j] of them) is a link between their subgroup nodes in the 
+    network of every other category
+    Returns the links as a tuple of NumPy arrays (category, Source, Target, count)"""
+    
+    if groupMove is None:
+        return links
+    nGroups = len(groupMove)
+    fromGroup, toGroup = np.nonzero(groupMove)
+    otherGroups = [np.setdiff1d(np.arange(nGroups), [fromGroup[i], toGroup[i]]) for i in range(len(fromGroup))]
+    otherCount = np.array([len(other) for other in otherGroups], dtype = np.int64)
+    linkGroup, linkSource, linkTarget, linkCount = links
+    return (np.concatenate((linkGroup, np.concatenate(otherGroups + [np.array([], dtype = np.int64)]))),
+            np.concatenate((linkSource, np.repeat(subgroupCode[fromGroup], otherCount))),
+            np.concatenate((linkTarget, np.repeat(subgroupCode[toGroup], otherCount))),
+            np.concatenate((linkCount, np.repeat(groupMove[fromGroup, toGroup], otherCount))))
+
+
+def subgroup_edge_stats(subgroup_info, file_output_info, transitions, wait, subgroupCode, nGroups):
+    """Calculates the statistics of the waits of the links of every category's network at once (see edge_stats())
+    transitions: as returned by subgroup_transitions(); wait: NumPy array of the wait of each transition
+    Returns a Pandas dataframe indexed by (category, Source, Target) codes (as the links from transition_links()), with a 
+    column for each statistic in file_output_info['EDGE_STATS']"""
+    
+    #The wait of each transition in place of its count, so each link has the waits of its transitions
+    (linkGroup, linkSource, linkTarget, linkWait), groupMove = transition_links(subgroup_info, transitions, subgroupCode, 
+                                                                                 nGroups, wait)
+    linkStats = edge_stats((linkGroup, linkSource, linkTarget), linkWait, file_output_info)
+    if not subgroup_info['REPRESENT_REMOVED'] or len(wait) == 0:
+        return linkStats
+    
+    #The subgroup node to subgroup node links (see add_group_moves()): the statistics are found once for each pair of 
+    #categories, and are the same in the network of every other category
+    pairStats = edge_stats(transitions[:2], wait, file_output_info)
+    fromGroup, toGroup = (pairStats.index.get_level_values(level).values for level in range(2))
+    otherGroups = [np.setdiff1d(np.arange(nGroups), [fromGroup[i], toGroup[i]]) for i in range(len(fromGroup))]
+    otherCount = np.array([len(other) for other in otherGroups], dtype = np.int64)
+    moveStats = pairStats.iloc[np.repeat(np.arange(len(pairStats)), otherCount)]
+    moveStats.index = pd.MultiIndex.from_arrays((np.concatenate(otherGroups + [np.array([], dtype = np.int64)]),
+                                                 np.repeat(subgroupCode[fromGroup], otherCount), 
+                                                 np.repeat(subgroupCode[toGroup], otherCount)))
+    return pd.concat((linkStats, moveStats)).sort_index()
+
+
+def write_subgroup_networks(subgroup_info, file_output_info, groups, names, subgroupCode, links, wardStats, subgroupStats,
+                            singles, singlesGroup, groupsToWrite = None, sink = None, pathways = None, linkStats = None):
+    """Outputs the SM, Edge and Node files for every category, from results calculated for all of the categories together
+    links: tuple of NumPy arrays (category, Source, Target, count), the codes are positions in groups and names
+    wardStats: Pandas dataframe with a row per (category, WardTeam): group, ward, MeanLoS, MedianLoS, Setting (and the 
+    statistics of node_stat_columns())
+    subgroupStats: Pandas dataframe indexed by category code: MeanLoS, MedianLoS (and the statistics of node_stat_columns()), 
+    None if not representing the removed data
+    singles, singlesGroup: as returned by count_subgroup_links() (singles can be None if not known)
+    groupsToWrite: (optional) the codes of the categories to output the files for (all categories if None)
+    sink: (optional) the function that is passed the network of each category: sink(group, servMove, nodesdf, file_output_info)
+    (write_network_files() if None, which outputs the files)
+    pathways: (optional) tuple of NumPy arrays for the rows (ordered by patient & chronologically): ClientID, category code and
+    WardTeam code, to count the pathways of each category's network from (see output_Pathway_file())
+    linkStats: (optional) Pandas dataframe indexed by (category, Source, Target) codes, the statistics of the waits of the links
+    to add to the Edge file (see subgroup_edge_stats())"""
+    
+    if sink is None:
+        sink = write_network_files
+    
+    nGroups = len(groups)
+    nNames = len(names)
+    
+    #Count the transitions for all categories at once, keyed on (category, Source, Target)
+    linkGroup, linkSource, linkTarget, linkCount = links
+    linkKey = (linkGroup.astype(np.int64) * nNames + linkSource) * nNames + linkTarget
+    linkKey, linkIndex = np.unique(linkKey, return_inverse = True)
+    linkCount = np.bincount(linkIndex, weights = linkCount).astype(np.int64)
+    linkGroup = linkKey // (nNames * nNames)
+    linkSource = (linkKey // nNames) % nNames
+    linkTarget = linkKey % nNames
+    groupStart = np.searchsorted(linkGroup, np.arange(nGroups + 1))
+
+    wardStats = wardStats.sort_values(['group', 'ward'])
+    wardStart = np.searchsorted(wardStats.group.values, np.arange(nGroups + 1))
+    if subgroupStats is not None:
+        subgroupStats = subgroupStats.copy()
+        subgroupStats['ward'] = subgroupCode[subgroupStats.index.values]
+        subgroupStats['Setting'] = 'Mixture'
+    if pathways is not None:
+        pathClientID, pathGroup, pathWard = pathways
+        if not subgroup_info['REPRESENT_REMOVED']:
+            #The rows of each category together, keeping the patient & chronological order within each category
+            order = np.argsort(pathGroup, kind = 'stable')
+            pathClientID, pathWard = pathClientID[order], pathWard[order]
+            pathStart = np.searchsorted(pathGroup[order], np.arange(nGroups + 1))
+    if linkStats is not None:
+        statsGroup, statsSource, statsTarget = (linkStats.index.get_level_values(level).values for level in range(3))
+        statsStart = np.searchsorted(statsGroup, np.arange(nGroups + 1))
+
+    for g in range(nGroups):
+        if groupsToWrite is not None and g not in groupsToWrite:
+            continue
+        group = groups[g]
+        nodes = wardStats.iloc[wardStart[g]:wardStart[g + 1]]
+        if subgroupStats is not None:
+            nodes = pd.concat((nodes, subgroupStats[subgroupStats.index != g]))
+        nodes = nodes.sort_values('ward')
+        
+        #Node IDs run from 1 to n in the sorted order of the node names
+        nodeID = np.zeros(nNames, dtype = np.int64)
+        nodeID[nodes.ward.values] = np.arange(1, len(nodes) + 1)
+        n = len(nodes)
+        
+        links = slice(groupStart[g], groupStart[g + 1])
+        servMove = scipy.sparse.coo_matrix((linkCount[links], (nodeID[linkSource[links]] - 1, nodeID[linkTarget[links]] - 1)),
+                                           shape = (n, n)).tocsr()
+        nodesdf = pd.DataFrame({'ID' : np.arange(1, n + 1),
+                                'Label' : names[nodes.ward.values],
+                                'MeanLoS' : nodes.MeanLoS.values,
+                                'MedianLoS' : nodes.MedianLoS.values,
+                                'Setting' : nodes.Setting.values},
+                               columns = ['ID', 'Label', 'MeanLoS', 'MedianLoS', 'Setting'])
+        for column in node_stat_columns(file_output_info):
+            nodesdf[column] = nodes[column].values
+
+        #Update the 2 objects in the directory and output the files for this category
+        file_output_info['FILEMIDDLE'] = str(subgroup_info['SUBGROUP_FILENAME']) + str(make_filename(group))
+        if singles is not None:
+            file_output_info['SINGLES'] = singles if singlesGroup is None else singles[singlesGroup == g]
+        if pathways is not None:
+            if subgroup_info['REPRESENT_REMOVED']:
+                #Every row, with the subgroup node for the rows of the other categories
+                file_output_info['PATHWAY_NODES'] = (pathClientID, nodeID[np.where(pathGroup == g, pathWard, 
+                                                                                   subgroupCode[pathGroup])])
+            else:
+                rows = slice(pathStart[g], pathStart[g + 1])
+                file_output_info['PATHWAY_NODES'] = (pathClientID[rows], nodeID[pathWard[rows]])
+        if linkStats is not None:
+            #The statistics of the category's links, indexed by (Source, Target) node IDs
+            links = slice(statsStart[g], statsStart[g + 1])
+            file_output_info['EDGE_WAITS'] = linkStats.iloc[links].set_axis(
+                pd.MultiIndex.from_arrays((nodeID[statsSource[links]], nodeID[statsTarget[links]])), axis = 0)
+        with stage('write_network', network = file_output_info['FILEMIDDLE']) as record:
+            sink(group, servMove, nodesdf, file_output_info)
+            record['Nodes'], record['Edges'] = n, servMove.nnz
+    file_output_info.pop('EDGE_WAITS', None)
+    return
+
+
+def write_network_files(group, servMove, nodesdf, file_output_info):
+    """Outputs the SM, Edge and Node files for the network of one category (the default sink of write_subgroup_networks())"""
+    write_SM_file(servMove, file_output_info)
+    output_Edge_file(servMove, file_output_info)
+    write_Node_file(nodesdf, file_output_info)
+    output_Graph_files(servMove, nodesdf, file_output_info)
+    if 'PATHWAY_NODES' in file_output_info:
+        output_Pathway_file(file_output_info, nodesdf.Label.values)
+    return
+
+
+# ## Function create_network_graphs()
+# 
+# Returns the networks for a network definition (<em>subgroup_info</em>, as used in the main code, with DATA) as igraph graphs, so that they can be analysed (for example centrality, or community detection) straight away, without writing the files and reading them back in.
+# 
+# The graphs are built from the transition counts by <em>create_network_data_for_subgroup_single_pass()</em>, with <em>network_graph()</em> as the sink for each category's network instead of writing the files.  The result is a dictionary with a graph for each category of <em>subgroup_info['COLUMN']</em> (one graph, with the key '', if there is no column).
+# 
+# Each graph is directed.  Vertex i is the node with ID i+1 in the Node file, with the attributes Label, MeanLoS, MedianLoS and Setting (and name, the same as Label, so a vertex can be found by its WardTeam name).  Each edge has the attribute weight, the number of times patients moved from the Source to the Target.  The edges are in the same order as in the Edge file.
+# 
+# If <em>file_output_info</em> is given, the output files are also written.
+
+# In[ ]:
+
+
+def network_graph(servMove, nodesdf):
+    """Returns a directed, weighted igraph Graph for a network: servMove (SciPy sparse matrix) and nodesdf (Pandas dataframe
+    of the nodes, as in the Node file)"""
     
-    # In[57]:
+    import igraph #only imported when a graph is made, as the files are written without it
+    smCoo = servMove.tocoo()
+    order = np.lexsort((smCoo.row, smCoo.col)) #as in output_Edge_file()
+    graph = igraph.Graph(n = len(nodesdf), edges = np.column_stack((smCoo.row[order], smCoo.col[order])).tolist(), 
+                         directed = True)
+    graph.es['weight'] = smCoo.data[order].tolist()
+    for attribute in nodesdf.columns.drop('ID'): #Label, MeanLoS, MedianLoS, Setting and the statistics of node_stat_columns()
+        graph.vs[attribute] = nodesdf[attribute].tolist()
+    graph.vs['name'] = nodesdf['Label'].tolist()
+    return graph
+
+
+def create_network_graphs(subgroup_info, file_output_info = None):
+    """Returns a dictionary of igraph Graphs, a graph for each category within subgroup_info['COLUMN'] (with the key '' if
+    the column is ''), built from the transition counts without writing any files
+    If file_output_info is given, the output files are also written"""
     
+    graphs = {}
+    def graph_sink(group, servMove, nodesdf, sink_file_output_info):
+        graphs[group] = network_graph(servMove, nodesdf)
+        if file_output_info is not None:
+            write_network_files(group, servMove, nodesdf, sink_file_output_info)
     
-    DATA = calculate_LoS(DATA)
-    DATA = delete_zero_LoS(DATA)
+    create_network_data_for_subgroup_single_pass(subgroup_info, dict(file_output_info or {}), sink = graph_sink)
+    return graphs
+
+
+# ## Time-sliced networks (snapshots)
+# 
+# To see how the pathways change over time, every network can be created for each month or quarter (set <em>file_output_info['SNAPSHOTS']</em> to 'M' or 'Q').  A window is <em>file_output_info['SNAPSHOT_WINDOW']</em> months (or quarters): 1 gives a window for each month, more than 1 gives sliding windows that move on by one month at a time.  A transition is in a window if the admission it leads to (its Target row) has its ReferralDate in the window.
+# 
+# Rather than selecting the rows of each window and creating the networks again, the transitions of a network (for all of its categories, see <em>subgroup_transitions()</em>) are found once, in one table ordered by date.  Each distinct transition (category, Source, Target) is given a code, and the table is cut at the start and end of every window by binary search (<em>np.searchsorted()</em>).  The number of times each transition is used is counted for each piece between two cuts, and added up (a cumulative count) from the first piece, so the count for any window is the cumulative count at its end less the cumulative count at its start.  The links of each category's network are then found from these counts (<em>transition_links()</em>), as in the single pass.
+# 
+# The rows are also ordered by date, so the rows of a window (for the mean and median LoS of its nodes) are a slice of them found by binary search.  Every window has all of the nodes of the whole period (with the same IDs, so the windows can be compared), and a node with no admissions in a window has no mean or median LoS.
+# 
+# The windows are output either as the Node, Edge and Service movement files for each window (<em>file_output_info['SNAPSHOT_OUTPUT']</em> is 'FILES', with the window at the start of the filename), or as one dynamic graph file (GEXF) for each network (<em>'GEXF'</em>), in which each edge and node has the windows it is used in, and the weight and LoS of each window, for Gephi's timeline.  The windows of a dynamic graph cannot overlap, so it needs a window of 1 month (or quarter) (checked by <em>check_output_formats()</em> at the start of the run).
+
+# In[ ]:
+
+
+def snapshot_windows(file_output_info, dates):
+    """Returns the time windows from the first to the last of dates (NumPy array), a list of (name, start, end) tuples
+    Each window starts at the start of a month (file_output_info['SNAPSHOTS'] is 'M') or quarter ('Q'), and is 
+    file_output_info['SNAPSHOT_WINDOW'] of them long (the end is not in the window)"""
     
+    dates = dates[~np.isnat(dates)]
+    if len(dates) == 0:
+        return []
+    periods = pd.period_range(pd.Timestamp(dates.min()), pd.Timestamp(dates.max()), freq = file_output_info['SNAPSHOTS'])
+    length = file_output_info.get('SNAPSHOT_WINDOW', 1)
+    windows = []
+    for first in range(max(len(periods) - length + 1, 1)):
+        last = periods[min(first + length, len(periods)) - 1]
+        name = str(periods[first]) if length == 1 else str(periods[first]) + '_' + str(last)
+        windows.append((name, periods[first].start_time, (last + 1).start_time))
+    return windows
+
+
+def create_network_snapshots(networks, file_output_info):
+    """Creates the networks for each time window (see snapshot_windows()), for a list of networks (a subgroup_info dictionary
+    for each, with DATA)"""
     
-    # ### Sort the data
-    # Sort the data into blocks for each clientID with chronological ReferralDate (needs to be in format "%d/%m/%Y", else will order by day number first)
+    with stage('create_network_snapshots'):
+        for subgroup_info in networks:
+            with stage('network_snapshots', network = subgroup_info['SUBGROUP_FILENAME']):
+                create_subgroup_snapshots(subgroup_info, dict(file_output_info))
+    return
+
+
+def create_subgroup_snapshots(subgroup_info, file_output_info):
+    """Creates the network of every category within the column for each time window, from one table of the transitions
+    ordered by date
+    Outputs the SM, Edge and Node files for each window, or a dynamic graph file for each category (see 
+    write_dynamic_network())"""
+    
+    #Code the rows, categories and nodes as in the single pass
+    DATA = subgroup_info['DATA']
+    rows, npColumn = network_rows(subgroup_info, DATA)
+    check_network_rows(subgroup_info['SUBGROUP_FILENAME'], len(rows))
+    clientID = DATA.ClientID.values[rows]
+    dates = DATA.ReferralDate.values[rows]
+    nodes, npSetting = network_nodes(subgroup_info, DATA, rows, setting = True)
+    npNodeCode = node_codes(file_output_info, nodes)
+    groupCode, groups = pd.factorize(npColumn[rows])
+    nGroups = len(groups)
+    names, wardCode, subgroupCode = code_subgroup_nodes(subgroup_info, file_output_info, groups, npNodeCode)
+    nNames = len(names)
+    windows = snapshot_windows(file_output_info, dates)
+    if len(windows) == 0:
+        return
+    
+    #The transitions in order of the date of their Target row, and a code for each distinct (categories, Source, Target)
+    transitions, singles, singlesGroup = subgroup_transitions(subgroup_info, clientID, groupCode, wardCode)
+    sourceGroup, targetGroup, sourceWard, targetWard, targetRow = transitions[:5]
+    order = np.argsort(dates[targetRow], kind = 'stable')
+    transitionDates = dates[targetRow][order]
+    key = ((sourceGroup[order].astype(np.int64) * nGroups + targetGroup[order]) * nNames + sourceWard[order]) * nNames + \
+          targetWard[order]
+    keyCode, keys = pd.factorize(key)
+    keys = np.asarray(keys, dtype = np.int64)
+    
+    #Cut the transitions at the start and end of every window, and count each transition cumulatively over the pieces
+    cutDates = np.unique(np.array([[start, end] for name, start, end in windows], dtype = 'datetime64[ns]'))
+    cuts = np.searchsorted(transitionDates, cutDates)
+    piece = np.repeat(np.arange(len(cuts) - 1), np.diff(cuts))
+    pieceCount = np.bincount(piece * len(keys) + keyCode[cuts[0]:cuts[-1]], 
+                             minlength = (len(cuts) - 1) * len(keys)).reshape((len(cuts) - 1, len(keys)))
+    cumulativeCount = np.vstack((np.zeros((1, len(keys)), dtype = np.int64), np.cumsum(pieceCount, axis = 0)))
+    
+    #The rows in order of date, for the LoS of the nodes in each window
+    rowOrder = np.argsort(dates, kind = 'stable')
+    rowDates = dates[rowOrder]
+    nodeStats = pd.DataFrame({'group' : groupCode, 'ward' : wardCode, 'LoSdays' : DATA.LoSdays.values[rows], 
+                              'Setting' : npSetting})
+    #Every node of the whole period is in every window (with the Setting of its first row)
+    allNodes = nodeStats.groupby(['group', 'ward']).agg(Setting = ('Setting', 'first')).reset_index()
+    
+    snapshots = {}
+    def snapshot_sink(group, servMove, nodesdf, sink_file_output_info):
+        snapshots.setdefault(group, []).append((window, servMove, nodesdf))
+    sink = snapshot_sink if file_output_info.get('SNAPSHOT_OUTPUT', 'FILES') == 'GEXF' else None
+    fileStart = file_output_info['FILESTART']
+    
+    for window in windows:
+        name, start, end = window
+        #The transitions used in the window, and the number of times
+        cutStart, cutEnd = np.searchsorted(cutDates, np.array([start, end], dtype = 'datetime64[ns]'))
+        count = cumulativeCount[cutEnd] - cumulativeCount[cutStart]
+        used = np.flatnonzero(count)
+        usedKey = keys[used]
+        windowTransitions = ((usedKey // nNames // nNames) // nGroups, (usedKey // nNames // nNames) % nGroups, 
+                             (usedKey // nNames) % nNames, usedKey % nNames)
+        links, groupMove = transition_links(subgroup_info, windowTransitions, subgroupCode, nGroups, count[used])
+        links = add_group_moves(links, groupMove, subgroupCode)
+        
+        #Mean & median LoS of the rows in the window
+        windowRows = rowOrder[np.searchsorted(rowDates, np.datetime64(start)):np.searchsorted(rowDates, np.datetime64(end))]
+        windowStats = nodeStats.iloc[windowRows]
+        wardStats = allNodes.merge(node_stats(windowStats, ['group', 'ward'], file_output_info).reset_index(),
+                                   on = ['group', 'ward'], how = 'left')
+        subgroupStats = None
+        if subgroup_info['REPRESENT_REMOVED']:
+            subgroupStats = node_stats(windowStats, ['group'], file_output_info).reindex(np.arange(nGroups))
+        if 'Count' in file_output_info.get('NODE_STATS', []):
+            #A node with no rows in the window has no admissions (its LoS statistics are left empty)
+            wardStats['Count'] = wardStats['Count'].fillna(0).astype(np.int64)
+            if subgroupStats is not None:
+                subgroupStats['Count'] = subgroupStats['Count'].fillna(0).astype(np.int64)
+        
+        file_output_info['FILESTART'] = fileStart + '_' + make_filename(name)
+        write_subgroup_networks(subgroup_info, file_output_info, groups, names, subgroupCode, links, wardStats, 
+                                subgroupStats, None, None, sink = sink)
+    
+    file_output_info['FILESTART'] = fileStart
+    for group, groupSnapshots in snapshots.items():
+        file_output_info['FILEMIDDLE'] = str(subgroup_info['SUBGROUP_FILENAME']) + str(make_filename(group))
+        write_dynamic_network(groupSnapshots, file_output_info)
+    return
+
+
+def write_dynamic_network(snapshots, file_output_info):
+    """Outputs the network of each time window (snapshots: a list of ((name, start, end), servMove, nodesdf), with the same 
+    nodes in each) as one dynamic graph file (GEXF) for Gephi's timeline
+    Each edge has the windows it is used in (its spells) and its weight in each, each node its mean & median LoS in each 
+    window it has admissions in"""
+    
+    from xml.sax.saxutils import quoteattr
+    def interval(window):
+        return 'start="%s" endopen="%s"' % (window[1].strftime('%Y-%m-%d'), window[2].strftime('%Y-%m-%d'))
+    
+    nodeLines = []
+    nodesdf = snapshots[0][2]
+    for i in range(len(nodesdf)):
+        values = ['<attvalue for="Setting" value=%s/>' % quoteattr(str(nodesdf.Setting.values[i]))]
+        spells = []
+        for window, servMove, windowNodes in snapshots:
+            if not pd.isna(windowNodes.MeanLoS.values[i]):
+                values.append('<attvalue for="MeanLoS" value="%r" %s/>' % (float(windowNodes.MeanLoS.values[i]), 
+                                                                           interval(window)))
+                values.append('<attvalue for="MedianLoS" value="%r" %s/>' % (float(windowNodes.MedianLoS.values[i]), 
+                                                                             interval(window)))
+                spells.append('<spell %s/>' % interval(window))
+        nodeLines.append('      <node id="%d" label=%s>\n        <attvalues>%s</attvalues>\n        <spells>%s</spells>\n'
+                         '      </node>' % (nodesdf.ID.values[i], quoteattr(str(nodesdf.Label.values[i])), ''.join(values), 
+                                            ''.join(spells)))
+    
+    #The weight of each edge (Source, Target) in each window
+    edges = {}
+    for window, servMove, windowNodes in snapshots:
+        smCoo = servMove.tocoo()
+        for source, target, weight in zip(smCoo.row.tolist(), smCoo.col.tolist(), smCoo.data.tolist()):
+            if weight > 0:
+                edges.setdefault((target, source), []).append((window, weight))
+    edgeLines = []
+    for edgeID, (target, source) in enumerate(sorted(edges)): #ordered by Target, then by Source, as in the Edge file
+        windows = edges[(target, source)]
+        values = ''.join('<attvalue for="weight" value="%d" %s/>' % (weight, interval(window)) for window, weight in windows)
+        spells = ''.join('<spell %s/>' % interval(window) for window, weight in windows)
+        edgeLines.append('      <edge id="%d" source="%d" target="%d">\n        <attvalues>%s</attvalues>\n'
+                         '        <spells>%s</spells>\n      </edge>' % (edgeID, source + 1, target + 1, values, spells))
+    
+    FileNameDynamic = (file_output_info['FILESTART'] + file_output_info['FILEMIDDLE'] + 
+                       file_output_info['FILEENDDYNAMIC'] + '.gexf')
+    write_output(file_output_info['FOLDER'] + FileNameDynamic, write_text,
+                 '<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+                 '  <graph mode="dynamic" defaultedgetype="directed" timeformat="date">\n'
+                 '    <attributes class="node" mode="static">\n'
+                 '      <attribute id="Setting" title="Setting" type="string"/>\n'
+                 '    </attributes>\n'
+                 '    <attributes class="node" mode="dynamic">\n'
+                 '      <attribute id="MeanLoS" title="MeanLoS" type="double"/>\n'
+                 '      <attribute id="MedianLoS" title="MedianLoS" type="double"/>\n'
+                 '    </attributes>\n'
+                 '    <attributes class="edge" mode="dynamic">\n'
+                 '      <attribute id="weight" title="Weight" type="float"/>\n'
+                 '    </attributes>\n'
+                 '    <nodes>\n' + '\n'.join(nodeLines) + '\n    </nodes>\n'
+                 '    <edges>\n' + '\n'.join(edgeLines) + '\n    </edges>\n'
+                 '  </graph>\n'
+                 '</gexf>\n')
+    return
+
+
+# ## The transition cube
+# 
+# Each subgroup network is defined by one column, and a new question (for example the patients in Cluster 7, in North Devon, in age group 2) would need a new pass of the data.  Instead, the transitions can be found once and kept in a transition "cube" (<em>create_transition_cube()</em>), from which the network for any combination of filters is found in milliseconds (<em>query_transition_cube()</em>).
+# 
+# The cube is a dictionary that contains:
+# 
+# "WARDTEAM" : The column of the node names (WardTeam or WardTeamOneOOA)
+# "NAMES" : NumPy array of the node names, in the order of their node registry codes
+# "ROW_NODE", "ROW_LOS", "ROW_SETTING" : NumPy arrays of the node registry code, LoS and Setting of each row of the PD data
+# "ROW_PATIENT" : NumPy array of the number of the patient of each row (0 to the number of patients - 1, in the order of the rows)
+# "SOURCE_ROW", "TARGET_ROW" : NumPy arrays of the rows of each transition (a row followed by a row for the same patient)
+# "COLUMNS" : A dictionary, for each column that can be filtered on (<em>file_output_info['CUBE_COLUMNS']</em>): "CATEGORIES" (a Pandas index of its values), the code of the value of each row ("ROWS"), and of the Source and Target row of each transition ("SOURCE", "TARGET").  The codes are the smallest integer type that holds them.
+# "INDEX" : A dictionary, for each column and each of "ROWS", "SOURCE" and "TARGET": the positions ordered by code, and the position in that order where each code starts.  The positions with a value are one slice of the order.
+# 
+# A filter is a dictionary of the values to keep for each column, for example {'Cluster' : [7], 'Locality_Edit' : ['North Devon'], 'AgeAtRefGroup' : [2]}.  The rows with the values are found from the index of each column (<em>cube_positions()</em>) and intersected, starting with the smallest, and the nodes and their LoS are found from these rows.  As for the subgroup networks with REPRESENT_REMOVED 0, the rows out of the filter are removed and each row in the filter is linked to the patient's next row in the filter (the rows either side of the removed rows are linked), so a filter on a column that changes between a patient's rows (Locality_Edit, GenSpecialty_Age) gives the same network as the subgroup network.
+# 
+# If <em>represent_removed</em> is 1, the rows that are not in the filter are represented by a node for the value of the first column in the filter that they do not have (named column + value, for example "Locality_Edit South Devon"), as for REPRESENT_REMOVED.  The links are then every transition: the transitions with the values on their Source side are found from the index of each column in the same way, and the same for their Target side; the transitions in both are links between the nodes of the filter, a transition from a row in the filter to a row out of it is a link to that row's node, and a transition between two rows out of the filter is a link between their nodes.
+# 
+# Unlike the subgroup networks, the rows with no value for a column ("None") are kept, and are out of any filter on the column that does not include "None".
+# 
+# The cube is kept in <em>file_output_info['CACHEFOLDER']</em> with the prepared data (see <em>load_transition_cube()</em>), and <em>output_cube_network()</em> writes the SM, Edge and Node files for the network of a filter.
+
+# In[ ]:
+
+
+def create_transition_cube(file_output_info, DATA, wardteam = 'WardTeam'):
+    """Returns the transition cube (a dictionary) of the PD data (DATA): every transition, with the codes of the values of its
+    Source and Target rows in each column of file_output_info['CUBE_COLUMNS'], and an index on each column"""
+    
+    with stage('create_transition_cube', rowsIn = len(DATA)):
+        nodes, npSetting = network_nodes({"WARDTEAM" : wardteam}, DATA, setting = True)
+        rowNode = node_codes(file_output_info, nodes)
+        clientID = DATA.ClientID.values
+        targetRow = np.flatnonzero(clientID[:-1] == clientID[1:]) + 1
+        positionType = np.int32 if len(DATA) < 2**31 else np.int64
+        #Each row that is not the Target of a transition starts the rows of a new patient
+        startsPatient = np.ones(len(DATA), dtype = positionType)
+        startsPatient[targetRow] = 0
+        cube = {'WARDTEAM' : wardteam,
+                'NAMES' : file_output_info['NODE_REGISTRY']['NAMES'],
+                'ROW_NODE' : rowNode,
+                'ROW_LOS' : DATA.LoSdays.values,
+                'ROW_SETTING' : np.asarray(npSetting, dtype = object),
+                'ROW_PATIENT' : np.cumsum(startsPatient, dtype = positionType) - 1,
+                'SOURCE_ROW' : (targetRow - 1).astype(positionType),
+                'TARGET_ROW' : targetRow.astype(positionType),
+                'COLUMNS' : {},
+                'INDEX' : {}}
+        for column in file_output_info['CUBE_COLUMNS']:
+            codes, categories = pd.factorize(DATA[column].to_numpy(), use_na_sentinel = False)
+            codes = codes.astype(np.min_scalar_type(max(len(categories) - 1, 0)))
+            cube['COLUMNS'][column] = {'CATEGORIES' : pd.Index(categories, dtype = categories.dtype),
+                                       'ROWS' : codes,
+                                       'SOURCE' : codes[cube['SOURCE_ROW']],
+                                       'TARGET' : codes[cube['TARGET_ROW']]}
+            cube['INDEX'][column] = {}
+            for side in ('ROWS', 'SOURCE', 'TARGET'):
+                sideCodes = cube['COLUMNS'][column][side]
+                cube['INDEX'][column][side] = (np.argsort(sideCodes, kind = 'stable').astype(positionType),
+                                               np.concatenate(([0], np.cumsum(np.bincount(sideCodes, minlength = len(categories))))))
+    return cube
+
+
+def load_transition_cube(file_output_info, DATA, wardteam = 'WardTeam'):
+    """Returns the transition cube of the prepared PD data (DATA), loaded from the cache if the input file and the code that 
+    prepares the data and creates the cube are unchanged, otherwise created (and then stored in the cache)"""
+    
+    if not file_output_info.get('CACHE', 0):
+        return create_transition_cube(file_output_info, DATA, wardteam)
+    
+    key = hashlib.sha256((prepared_data_key(file_output_info) + inspect.getsource(create_transition_cube) + 
+                          str(file_output_info['CUBE_COLUMNS'])).encode()).hexdigest()[:16]
+    cacheStart = str(file_output_info['FILESTART']) + '_cube_' + wardteam + '_'
+    cacheFile = file_output_info['CACHEFOLDER'] + cacheStart + key + '.pkl'
+    if os.path.exists(cacheFile):
+        with stage('load_transition_cube'), open(cacheFile, 'rb') as cache:
+            return pickle.load(cache)
+    
+    cube = create_transition_cube(file_output_info, DATA, wardteam)
+    if not os.path.isdir(file_output_info['CACHEFOLDER']):
+        os.makedirs(file_output_info['CACHEFOLDER'])
+    for oldFile in os.listdir(file_output_info['CACHEFOLDER']):
+        if oldFile.startswith(cacheStart) and oldFile.endswith('.pkl'):
+            os.remove(file_output_info['CACHEFOLDER'] + oldFile)
+    with open(cacheFile + '.tmp', 'wb') as cache:
+        pickle.dump(cube, cache, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(cacheFile + '.tmp', cacheFile)
+    return cube
+
+
+def cube_positions(cube, side, filters):
+    """Returns the sorted NumPy array of the positions (of the rows if side is 'ROWS', otherwise of the transitions, with their
+    'SOURCE' or 'TARGET' row) that have one of the values in filters (a dictionary: column, list of values) for every column"""
+    
+    if len(filters) == 0:
+        return np.arange(len(cube['ROW_NODE']) if side == 'ROWS' else len(cube['SOURCE_ROW']))
+    postings = []
+    for column, values in filters.items():
+        order, starts = cube['INDEX'][column][side]
+        codes = cube['COLUMNS'][column]['CATEGORIES'].get_indexer(list(np.atleast_1d(np.asarray(values, dtype = object))))
+        codes = np.unique(codes[codes >= 0])
+        #The positions of each value are a slice of the order, already sorted
+        positions = [order[starts[code]:starts[code + 1]] for code in codes]
+        postings.append(positions[0] if len(positions) == 1 else np.sort(np.concatenate(positions + [order[:0]])))
+    #Intersect, starting with the fewest positions
+    postings.sort(key = len)
+    positions = postings[0]
+    for posting in postings[1:]:
+        positions = positions[np.isin(positions, posting, assume_unique = True)]
+    return positions
+
+
+def query_transition_cube(cube, filters, represent_removed = 0, file_output_info = None):
+    """Returns the network of the rows in filters (a dictionary: column, list of values) from the transition cube: a SciPy 
+    sparse matrix of the links (servMove) and a Pandas dataframe of the nodes (as in the Node file)
+    If represent_removed is 1 the rows out of the filter are represented by a node for the value of the first column in the 
+    filter that they do not have
+    file_output_info: (optional) for the statistics of the nodes (see node_stats())"""
+    
+    with stage('query_transition_cube') as record:
+        filters = {column : np.atleast_1d(np.asarray(values, dtype = object)) for column, values in filters.items()}
+        nNames = len(cube['NAMES'])
+        
+        #The rows in the filter, each linked to the patient's next row in the filter (the rows out of the filter are removed)
+        rows = cube_positions(cube, 'ROWS', filters)
+        samePatient = cube['ROW_PATIENT'][rows[:-1]] == cube['ROW_PATIENT'][rows[1:]]
+        linkSource = cube['ROW_NODE'][rows[:-1][samePatient]]
+        linkTarget = cube['ROW_NODE'][rows[1:][samePatient]]
+        nodeCode = cube['ROW_NODE'][rows]
+        removedColumns = []
+        offset = nNames
+        if represent_removed and len(filters):
+            #Every transition is a link, the transitions with both rows in the filter between the nodes of their rows
+            source = cube_positions(cube, 'SOURCE', filters)
+            target = cube_positions(cube, 'TARGET', filters)
+            both = source[np.isin(source, target, assume_unique = True)]
+            linkSource = cube['ROW_NODE'][cube['SOURCE_ROW'][both]]
+            linkTarget = cube['ROW_NODE'][cube['TARGET_ROW'][both]]
+            #The node of a row out of the filter: its value in the first column of the filter that it does not have, with 
+            #codes after the node registry codes
+            removedNode = np.full(len(cube['ROW_NODE']), -1, dtype = np.int64)
+            for column, values in filters.items():
+                categories = cube['COLUMNS'][column]['CATEGORIES']
+                rowCodes = cube['COLUMNS'][column]['ROWS']
+                out = (removedNode < 0) & ~np.isin(rowCodes, categories.get_indexer(list(values)))
+                removedNode[out] = offset + rowCodes[out]
+                removedColumns.append((offset, column, categories))
+                offset += len(categories)
+            #The transitions with one or both rows out of the filter
+            other = np.ones(len(cube['SOURCE_ROW']), dtype = bool)
+            other[both] = False
+            otherSource = cube['SOURCE_ROW'][other]
+            otherTarget = cube['TARGET_ROW'][other]
+            linkSource = np.concatenate((linkSource, np.where(removedNode[otherSource] < 0, cube['ROW_NODE'][otherSource], 
+                                                              removedNode[otherSource])))
+            linkTarget = np.concatenate((linkTarget, np.where(removedNode[otherTarget] < 0, cube['ROW_NODE'][otherTarget], 
+                                                              removedNode[otherTarget])))
+            outRows = np.flatnonzero(removedNode >= 0)
+            rows = np.concatenate((rows, outRows))
+            nodeCode = np.concatenate((nodeCode, removedNode[outRows]))
+        
+        #Mean & median LoS (and the Setting of the first row) of each node, with the node IDs in the sorted order of the names
+        setting = np.where(nodeCode < nNames, cube['ROW_SETTING'][rows], 'Mixture')
+        nodeStats = node_stats(pd.DataFrame({'node' : nodeCode, 'LoSdays' : cube['ROW_LOS'][rows], 'Setting' : setting}), ['node'],
+                               file_output_info or {}, first = ['Setting'])
+        #The names of the nodes used (only these of the removed nodes are named)
+        nodes = nodeStats.index.values
+        labels = np.empty(len(nodes), dtype = object)
+        labels[nodes < nNames] = cube['NAMES'][nodes[nodes < nNames]]
+        for columnOffset, column, categories in removedColumns:
+            inColumn = (nodes >= columnOffset) & (nodes < columnOffset + len(categories))
+            labels[inColumn] = [str(column) + ' ' + str(value) for value in categories[nodes[inColumn] - columnOffset]]
+        order = np.argsort(labels, kind = 'stable')
+        nodeID = np.zeros(offset, dtype = np.int64)
+        nodeID[nodes[order]] = np.arange(1, len(order) + 1)
+        n = len(order)
+        servMove = scipy.sparse.coo_matrix((np.ones(len(linkSource), dtype = np.int64), 
+                                            (nodeID[linkSource] - 1, nodeID[linkTarget] - 1)), shape = (n, n)).tocsr()
+        nodesdf = pd.DataFrame({'ID' : np.arange(1, n + 1),
+                                'Label' : labels[order],
+                                'MeanLoS' : nodeStats.MeanLoS.values[order],
+                                'MedianLoS' : nodeStats.MedianLoS.values[order],
+                                'Setting' : nodeStats.Setting.values[order]},
+                               columns = ['ID', 'Label', 'MeanLoS', 'MedianLoS', 'Setting'])
+        for column in node_stat_columns(file_output_info or {}):
+            nodesdf[column] = nodeStats[column].values[order]
+        record['Nodes'], record['Edges'] = n, servMove.nnz
+    return servMove, nodesdf
+
+
+def output_cube_network(cube, filters, file_output_info, represent_removed = 0):
+    """Outputs the SM, Edge and Node files for the network of the rows in filters (a dictionary: column, list of values), 
+    from the transition cube (see query_transition_cube())
+    The filters are in the output filenames, after '_Cube'"""
+    
+    servMove, nodesdf = query_transition_cube(cube, filters, represent_removed, file_output_info)
+    file_output_info = dict(file_output_info)
+    file_output_info['FILEMIDDLE'] = '_Cube_' + cube['WARDTEAM'] + ''.join(
+        '_' + str(column) + '_' + '_'.join(str(make_filename(value)) for value in np.atleast_1d(values)) 
+        for column, values in filters.items())
+    write_network_files(None, servMove, nodesdf, file_output_info)
+    return
+
+
+# ## Creating the networks from the PD data in chunks (streaming)
+# 
+# For a dataset that is too large to hold in memory, the networks can be created from the input file in chunks of <em>file_output_info['CHUNKSIZE']</em> rows, so that only one chunk is held in memory at a time (set <em>file_output_info['STREAMING']</em> to 1).  Each chunk is prepared as in <em>prepare_data()</em>.
+# 
+# A transition is a row followed by the next row for the same patient, so a patient's rows must all be in the same chunk, in chronological order.  Function <em>stream_client_blocks()</em> gives the chunks in this form:
+# 
+# 1. If the input file is already sorted by ClientID and ReferralDate (<em>file_output_info['PRESORTED']</em> is 1), the rows of the last patient in a chunk may continue in the next chunk, so they are held back (carried over) and put at the start of the next chunk.  Each chunk (with the rows carried over) is checked to be in this order, and a file that is not is an error rather than giving wrong output files.
+# 2. Otherwise the file is sorted on disk (<em>external_sort_by_client()</em>): each chunk is split by a hash of ClientID into <em>file_output_info['SORTPARTITIONS']</em> partition files (so all of a patient's rows are in the same partition), and then each partition is read back in turn and sorted with <em>sort_data()</em>.  The rows are added to a partition in the order of the input file, and the sort is stable, so the rows are in the same order as in the sorted complete dataset.
+# 
+# For each chunk, and each network, <em>accumulate_network()</em> counts the links (with <em>count_subgroup_links()</em>, as in the single pass) and adds them to the network's running totals, keyed on (category, Source name, Target name).  The LoS is a whole number of days, so the mean and median LoS are calculated exactly from a running count of each LoS value for each (category, WardTeam).
+# 
+# Once all of the chunks have been read, <em>write_accumulated_networks()</em> converts the running totals into the same form as the single pass uses, and writes the output files with <em>write_subgroup_networks()</em>.  The output files are the same as those from the complete dataset.
+# 
+# A network for a single patient is given by subgroup_info['CLIENTID'].  The ClientIDs of the patients that only have 1 service use (file_output_info['SINGLES']) are not found when streaming.
+
+# In[ ]:
+
+
+def read_prepared_chunks(file_output_info):
+    """Reads the PD data in chunks of file_output_info['CHUNKSIZE'] rows
+    Yields each chunk as a Pandas dataframe, cleaned, with LoS calculated, negative LoS removed and the one OOA node column 
+    added (as in prepare_data(), but not sorted)"""
+    
+    for DATA in read_data(file_output_info, chunksize = file_output_info['CHUNKSIZE']):
+        DATA = clean_data(DATA)
+        DATA = calculate_LoS(DATA)
+        DATA = delete_zero_LoS(DATA)
+        DATA = add_one_OOA_node_column(DATA)
+        yield DATA
+
+
+def stream_client_blocks(file_output_info):
+    """Yields the prepared PD data as Pandas dataframes that each contain all of the rows of their patients, ordered by 
+    patient and chronologically (together they are the same rows in the same order as prepare_data())"""
+    
+    if not file_output_info.get('PRESORTED', 0):
+        for DATA in external_sort_by_client(file_output_info):
+            yield DATA
+        return
+    
+    carry = None
+    for DATA in read_prepared_chunks(file_output_info):
+        if carry is not None:
+            DATA = pd.concat((carry, DATA))
+        #The rows carried over are the last patient of the chunk before, so this also checks the order across the chunks
+        clientID = DATA.ClientID.values
+        dates = DATA.ReferralDate.values
+        outOfOrder = (clientID[1:] < clientID[:-1]) | ((clientID[1:] == clientID[:-1]) & (dates[1:] < dates[:-1]))
+        if np.any(outOfOrder):
+            raise ValueError('The input file is not sorted by ClientID and ReferralDate (row ' + str(DATA.index[1:][outOfOrder][0]) + 
+                             ' of the data is out of order), set PRESORTED to 0 to sort it on disk')
+        #Hold back the last patient's rows, as they may continue in the next chunk
+        lastClient = DATA.ClientID.values == DATA.ClientID.values[-1] if len(DATA) else np.zeros(0, dtype = bool)
+        carry = DATA[lastClient]
+        yield DATA[~lastClient]
+    if carry is not None:
+        yield carry
+
+
+def external_sort_by_client(file_output_info):
+    """Sorts the prepared PD data on disk, using partition files in a temporary folder in file_output_info['CACHEFOLDER']
+    Yields a Pandas dataframe per partition, containing all of the rows of its patients, sorted with sort_data()"""
+    
+    import shutil
+    import tempfile
+    
+    if not os.path.isdir(file_output_info['CACHEFOLDER']):
+        os.makedirs(file_output_info['CACHEFOLDER'])
+    sortFolder = tempfile.mkdtemp(prefix = str(file_output_info['FILESTART']) + '_sort_', dir = file_output_info['CACHEFOLDER'])
+    partitionNames = [os.path.join(sortFolder, str(p) + '.zip') for p in range(file_output_info.get('SORTPARTITIONS', 16))]
+    try:
+        write_partitions(file_output_info, partitionNames)
+        for partitionName in partitionNames:
+            DATA = read_partition(partitionName)
+            if len(DATA):
+                yield sort_data(DATA)
+    finally:
+        shutil.rmtree(sortFolder, ignore_errors = True)
+
+
+def write_frame(zipFile, name, frame):
+    """Adds a Pandas dataframe (or series) to an open zip file (zipFile) without pickling it: name + '.json' has its index, 
+    its columns and their types, and name/<n>.npy a NumPy array for each column (the codes of the values of a categorical or
+    text column, whose values are in the json file), so it can be read back by read_frame() with any version of Pandas"""
+    
+    description = {'INDEX' : list(frame.index.names), 'SERIES' : isinstance(frame, pd.Series), 'COLUMNS' : []}
+    if description['SERIES']:
+        description['NAME'] = frame.name
+        frame = frame.rename('values')
+    frame = frame.reset_index()
+    for n, column in enumerate(frame.columns):
+        values = frame[column]
+        entry = {'NAME' : column, 'TYPE' : 'ARRAY'}
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.cat.categories
+            entry.update(TYPE = 'CATEGORY', DTYPE = str(categories.dtype))
+            values = values.cat.codes.to_numpy()
+        elif values.dtype == object:
+            values, categories = pd.factorize(values.to_numpy(), use_na_sentinel = False)
+            entry['TYPE'] = 'OBJECT'
+        else:
+            values = values.to_numpy()
+        if entry['TYPE'] != 'ARRAY':
+            #The values as Python numbers and strings, for the json file
+            entry['VALUES'] = [value.item() if isinstance(value, np.generic) else value for value in categories]
+        with zipFile.open(name + '/' + str(n) + '.npy', 'w') as arrayFile:
+            np.lib.format.write_array(arrayFile, values, allow_pickle = False)
+        description['COLUMNS'].append(entry)
+    zipFile.writestr(name + '.json', json.dumps(description))
+    return
+
+
+def read_frame(zipFile, name):
+    """Returns the Pandas dataframe (or series) stored as name in an open zip file (zipFile) by write_frame()"""
+    
+    description = json.loads(zipFile.read(name + '.json'))
+    columns = {}
+    for n, entry in enumerate(description['COLUMNS']):
+        with zipFile.open(name + '/' + str(n) + '.npy') as arrayFile:
+            values = np.lib.format.read_array(arrayFile, allow_pickle = False)
+        if entry['TYPE'] == 'CATEGORY':
+            values = pd.Categorical.from_codes(values, categories = pd.Index(entry['VALUES'], dtype = entry['DTYPE']))
+        elif entry['TYPE'] == 'OBJECT':
+            categories = np.empty(len(entry['VALUES']), dtype = object)
+            categories[:] = entry['VALUES']
+            values = categories[values]
+        columns[entry['NAME']] = values
+    frame = pd.DataFrame(columns, columns = [entry['NAME'] for entry in description['COLUMNS']])
+    frame = frame.set_index(list(frame.columns[:len(description['INDEX'])]))
+    frame.index.names = description['INDEX']
+    if description['SERIES']:
+        return frame['values'].rename(description['NAME'])
+    return frame
+
+
+def write_partitions(file_output_info, partitionNames):
+    """Splits the prepared PD data by a hash of ClientID into a partition file for each name in partitionNames, so all of a 
+    patient's rows are in the same partition (in the order of the input file)
+    Each partition file is a zip file with the partition's rows of each chunk (see write_frame()), not pickled, so a 
+    partition can be read on any host whatever its versions of Python and Pandas"""
+    
+    nPartitions = len(partitionNames)
+    partitionFiles = [zipfile.ZipFile(partitionName, 'w') for partitionName in partitionNames]
+    try:
+        for c, DATA in enumerate(read_prepared_chunks(file_output_info)):
+            partition = pd.util.hash_array(DATA.ClientID.values) % nPartitions
+            for p in np.unique(partition):
+                write_frame(partitionFiles[p], 'chunk' + str(c), DATA[partition == p])
+    finally:
+        for partitionFile in partitionFiles:
+            partitionFile.close()
+    return
+
+
+def read_partition(partitionName):
+    """Returns the rows of a partition file from write_partitions() as a Pandas dataframe (with no rows if it is empty)"""
+    
+    with zipfile.ZipFile(partitionName) as partitionFile:
+        #The chunks, in the order they were written
+        pieces = [read_frame(partitionFile, entry[:-len('.json')]) for entry in partitionFile.namelist() 
+                  if entry.endswith('.json')]
+    return pd.concat(pieces) if pieces else pd.DataFrame()
+
+
+def create_networks_streaming(networks, file_output_info, state = None):
+    """Creates the output files for a list of networks (a subgroup_info dictionary for each, without DATA) from the input 
+    file in chunks, holding one chunk of the PD data in memory at a time
+    If state is given (a dictionary, see update_networks()), the running totals of each network, the last rows of each 
+    patient and the open admissions are kept in it"""
+    
+    with stage('create_networks_streaming'):
+        accumulators = [new_network_accumulator(state is not None, file_output_info.get('LOS_SKETCH', 0)) 
+                        for subgroup_info in networks]
+        for DATA in stream_client_blocks(file_output_info):
+            for subgroup_info, accumulator in zip(networks, accumulators):
+                with stage('accumulate_network', network = subgroup_info['SUBGROUP_FILENAME'], rowsIn = len(DATA)):
+                    accumulate_network(subgroup_info, DATA, accumulator)
+            if state is not None:
+                state['OPEN'].append(DATA[DATA.OpenAdmission.values])
+                state['LASTDATE'].append(DATA.groupby('ClientID').ReferralDate.max())
+                state['ROWS'] = max(state['ROWS'], int(DATA.index.max()) + 1 if len(DATA) else 0)
+        for subgroup_info, accumulator in zip(networks, accumulators):
+            with stage('write_accumulated_networks', network = subgroup_info['SUBGROUP_FILENAME']):
+                write_accumulated_networks(subgroup_info, file_output_info, accumulator)
+    if state is not None:
+        state['OPEN'] = pd.concat(state['OPEN'])
+        state['LASTDATE'] = pd.concat(state['LASTDATE']).groupby(level = 0).max()
+        state['NETWORKS'] = {network_name(subgroup_info) : accumulator for subgroup_info, accumulator in zip(networks, accumulators)}
+    return
+
+
+def new_network_accumulator(keepTails = False, sketch = 0):
+    """Returns the running totals for a network, before any data is added
+    If keepTails, the last row of each patient (in each category, if not representing the removed data) is also kept, for 
+    the transitions to the patient's next rows (see apply_delta())
+    If sketch is more than 0, the LoS values are counted in the buckets of a quantile sketch with that accuracy (see 
+    sketch_los())"""
+    accumulator = {'GROUPS' : [], 'LINKS' : None, 'GROUP_MOVES' : None, 'LOS' : None, 'SETTING' : None, 'LOS_SKETCH' : sketch}
+    if keepTails:
+        accumulator.update({'TAIL' : None, 'CHANGED' : set()})
+    return accumulator
+
+
+def network_rows(subgroup_info, DATA):
+    """Returns the positions of the rows of the PD data (DATA) that are in the network, and the value of the subgroup 
+    column for every row of DATA ('' if the network does not have a subgroup column)"""
+    
+    keep = np.ones(len(DATA), dtype = bool)
+    if subgroup_info.get('ROWS') is not None:
+        keep[:] = False
+        keep[subgroup_info['ROWS']] = True
+    if 'CLIENTID' in subgroup_info:
+        keep &= DATA.ClientID.values == subgroup_info['CLIENTID']
+    if subgroup_info['COLUMN'] == '':
+        npColumn = np.full(len(DATA), '', dtype = object)
+    else:
+        npColumn = DATA[subgroup_info['COLUMN']].to_numpy()
+        keep &= npColumn != "None"
+    return np.flatnonzero(keep), npColumn
+
+
+def accumulate_network(subgroup_info, DATA, accumulator, counted = None):
+    """Adds the links, and the count of each LoS value for each node, for one chunk of the PD data (DATA, containing all of
+    the rows of its patients) to the running totals for the network (accumulator)
+    If counted is given (a boolean NumPy array, a value per row of DATA), only those rows are added to the node counts (the
+    other rows have been added before, and are only here for their transitions to the counted rows)"""
+    
+    accumulate_nodes(subgroup_info, DATA if counted is None else DATA[counted], accumulator)
+    rows, npColumn = network_rows(subgroup_info, DATA)
+    if len(rows) == 0:
+        return
+    
+    groupCode, groups = pd.factorize(npColumn[rows])
+    groups = np.asarray(groups, dtype = object)
+    npWardTeam = np.asarray(network_nodes(subgroup_info, DATA, rows), dtype = object)
+    names, wardCode, subgroupCode = code_subgroup_names(subgroup_info, groups, npWardTeam)
+    (linkGroup, linkSource, linkTarget, linkCount), groupMove, singles, singlesGroup = count_subgroup_links(
+        subgroup_info, DATA.ClientID.values[rows], groupCode, wardCode, subgroupCode, len(groups))
+    
+    #Add to the running totals, keyed on names (the codes are only for this chunk)
+    links = pd.DataFrame({'group' : groups[linkGroup], 'source' : names[linkSource], 'target' : names[linkTarget],
+                          'count' : linkCount}).groupby(['group', 'source', 'target'])['count'].sum()
+    #The transitions between each pair of categories are kept apart, as the other categories are only known at the end
+    groupMoves = None
+    if groupMove is not None:
+        fromGroup, toGroup = np.nonzero(groupMove)
+        groupMoves = pd.Series(groupMove[fromGroup, toGroup], index = pd.MultiIndex.from_arrays((groups[fromGroup], 
+                                                                                                  groups[toGroup])))
+    if accumulator['LINKS'] is None:
+        accumulator['LINKS'], accumulator['GROUP_MOVES'] = links, groupMoves
+    else:
+        accumulator['LINKS'] = accumulator['LINKS'].add(links, fill_value = 0)
+        if groupMoves is not None:
+            accumulator['GROUP_MOVES'] = accumulator['GROUP_MOVES'].add(groupMoves, fill_value = 0)
+    
+    if 'TAIL' in accumulator:
+        accumulator['CHANGED'].update(groups[linkGroup])
+        #The last row of each patient (in each category, if the transitions are within a category)
+        keys = ['ClientID'] if subgroup_info['REPRESENT_REMOVED'] or subgroup_info['COLUMN'] == '' else ['ClientID', 'group']
+        #Only the columns needed for the transitions are kept
+        columns = ['ClientID', 'ReferralDate', subgroup_info.get('WARDTEAM', 'WardTeam')] + \
+                  ([subgroup_info['COLUMN']] if subgroup_info['COLUMN'] != '' else [])
+        if subgroup_info.get('RELABEL'):
+            #and the columns used by the network's relabelling rules
+            columns = list(dict.fromkeys(columns + ['Setting'] + [rule['COLUMN'] for rule in subgroup_info['RELABEL'] 
+                                                                   if 'COLUMN' in rule]))
+        tail = DATA[columns].iloc[rows].assign(group = npColumn[rows])
+        tail = pd.concat((accumulator['TAIL'], tail)) if accumulator['TAIL'] is not None else tail
+        accumulator['TAIL'] = tail.drop_duplicates(keys, keep = 'last')
+    return
+
+
+def accumulate_nodes(subgroup_info, DATA, accumulator, sign = 1):
+    """Adds (or if sign is -1, removes) the count of each LoS value for each node, and the Setting of each node, for the rows 
+    of the PD data (DATA) to the running totals for the network (accumulator)"""
+    
+    rows, npColumn = network_rows(subgroup_info, DATA)
+    if len(rows) == 0:
+        return
+    for group in pd.unique(npColumn[rows]):
+        if group not in accumulator['GROUPS']:
+            accumulator['GROUPS'].append(group)
+    
+    npWardTeam, npSetting = network_nodes(subgroup_info, DATA, rows, setting = True)
+    nodes = pd.DataFrame({'group' : npColumn[rows], 'ward' : np.asarray(npWardTeam, dtype = object), 
+                          'LoSdays' : sketch_los(DATA.LoSdays.values[rows], accumulator.get('LOS_SKETCH', 0)), 
+                          'Setting' : npSetting, 'ClientID' : DATA.ClientID.values[rows], 
+                          'ReferralDate' : DATA.ReferralDate.values[rows], 'row' : DATA.index.values[rows]})
+    los = nodes.groupby(['group', 'ward', 'LoSdays']).size() * sign
+    #The Setting of the first row for each node, with its position in the sorted data (ClientID, ReferralDate, row of the file)
+    setting = nodes.groupby(['group', 'ward'])[['Setting', 'ClientID', 'ReferralDate', 'row']].first()
+    if accumulator['LOS'] is None:
+        accumulator['LOS'], accumulator['SETTING'] = los, setting
+    else:
+        accumulator['LOS'] = accumulator['LOS'].add(los, fill_value = 0)
+        accumulator['LOS'] = accumulator['LOS'][accumulator['LOS'] != 0]
+        #Keep the Setting of the first row for each node in the sorted data, as in the complete dataset
+        setting = pd.concat((accumulator['SETTING'], setting)).reset_index()
+        setting = setting.sort_values(['ClientID', 'ReferralDate', 'row'], kind = 'mergesort')
+        accumulator['SETTING'] = setting.groupby(['group', 'ward'])[['Setting', 'ClientID', 'ReferralDate', 'row']].first()
+    if 'CHANGED' in accumulator:
+        accumulator['CHANGED'].update(pd.unique(npColumn[rows]))
+    return
+
+
+def los_stats(los, keys, file_output_info = None):
+    """Calculates the mean and median LoS (and the statistics in file_output_info['NODE_STATS'], see node_stats()) from a 
+    count of each LoS value
+    Recieves a Pandas dataframe (los) with the columns in keys, LoSdays and count (the number of rows with the LoS)
+    Returns a Pandas dataframe with a row per value of keys: the keys, MeanLoS, MedianLoS (and the statistics)"""
+    
+    los = los.sort_values(keys + ['LoSdays'])
+    total = los.groupby(keys)['count'].transform('sum').values
+    cumulative = los.groupby(keys)['count'].cumsum().values
+    def value_at(position):
+        #The LoS of the row at position (a value per row of los) in the sorted LoS of each node
+        return los[cumulative > position].groupby(keys)['LoSdays'].first()
+    #The median is the mean of the two middle values (the same value if the number of rows is odd)
+    lower = value_at((total - 1) // 2)
+    upper = value_at(total // 2)
+    los = los.assign(sumLoS = los.LoSdays * los['count'])
+    stats = los.groupby(keys)[['sumLoS', 'count']].sum()
+    stats['MeanLoS'] = stats.sumLoS / stats['count']
+    stats['MedianLoS'] = (lower + upper) / 2
+    columns = ['MeanLoS', 'MedianLoS']
+    file_output_info = file_output_info or {}
+    for stat, column in zip(file_output_info.get('NODE_STATS', []), node_stat_columns(file_output_info)):
+        if stat == 'Count':
+            stats[column] = stats['count'].astype(np.int64)
+        else:
+            #Linear interpolation between the rows either side of the position, as in node_stats()
+            position = (total - 1) * (stat / 100.)
+            lower = value_at(np.floor(position))
+            upper = value_at(np.minimum(np.floor(position) + 1, total - 1))
+            fraction = (stats['count'] - 1) * (stat / 100.)
+            stats[column] = lower + (upper - lower) * (fraction - np.floor(fraction))
+        columns.append(column)
+    return stats[columns].reset_index()
+
+
+def write_accumulated_networks(subgroup_info, file_output_info, accumulator, changedOnly = False):
+    """Outputs the SM, Edge and Node files for every category of the network, from the running totals of 
+    accumulate_network() (the same output files as from the complete dataset)
+    If changedOnly, only the files for the categories changed since they were last written are output (see apply_delta())"""
+    
+    if accumulator['LOS'] is None:
+        #No rows of the data are in the network.  In delta mode (the last rows of each patient are kept) its rows can come 
+        #in a later period, so it is checked once the new period has been added (see update_networks())
+        if 'TAIL' not in accumulator:
+            check_network_rows(subgroup_info['SUBGROUP_FILENAME'], 0)
+        return
+    groups = np.array(accumulator['GROUPS'], dtype = object)
+    groupIndex = {group : g for g, group in enumerate(groups)}
+    
+    los = accumulator['LOS'].rename('count').reset_index()
+    names, wardCode, subgroupCode = code_subgroup_names(subgroup_info, groups, los.ward.values)
+    los['group'] = los.group.map(groupIndex)
+    los['ward'] = wardCode
+    wardStats = los_stats(los, ['group', 'ward'], file_output_info)
+    setting = accumulator['SETTING'][['Setting']].reset_index()
+    setting['group'] = setting.group.map(groupIndex)
+    setting['ward'] = np.searchsorted(names, setting.ward.values.astype(object))
+    wardStats = wardStats.merge(setting, on = ['group', 'ward'], how = 'left')
+    subgroupStats = None
+    if subgroup_info['REPRESENT_REMOVED']:
+        subgroupStats = los_stats(los, ['group'], file_output_info).set_index('group')
+    
+    links = accumulator['LINKS'].reset_index() if accumulator['LINKS'] is not None else pd.DataFrame(
+        {'group' : [], 'source' : [], 'target' : [], 'count' : []})
+    links = (links.group.map(groupIndex).values.astype(np.int64), np.searchsorted(names, links.source.values.astype(object)),
+             np.searchsorted(names, links.target.values.astype(object)), links['count'].values.astype(np.int64))
+    if accumulator['GROUP_MOVES'] is not None:
+        groupMove = np.zeros((len(groups), len(groups)), dtype = np.int64)
+        for (fromGroup, toGroup), count in accumulator['GROUP_MOVES'].items():
+            groupMove[groupIndex[fromGroup], groupIndex[toGroup]] += int(count)
+        links = add_group_moves(links, groupMove, subgroupCode)
+    
+    groupsToWrite = None
+    if changedOnly:
+        #A change to any category changes the subgroup nodes in the networks of the other categories
+        groupsToWrite = set(range(len(groups))) if subgroup_info['REPRESENT_REMOVED'] and accumulator['CHANGED'] else \
+                        {groupIndex[group] for group in accumulator['CHANGED']}
+    if 'CHANGED' in accumulator:
+        accumulator['CHANGED'] = set()
+    write_subgroup_networks(subgroup_info, file_output_info, groups, names, subgroupCode, links, wardStats, subgroupStats,
+                            None, None, groupsToWrite)
+    return
+
+
+# ## Updating the networks with a new period of referrals (delta mode)
+# 
+# When a new period of referrals arrives (for example, a new month), the networks can be updated with only the new rows, instead of being created again from the whole history (set <em>file_output_info['DELTA']</em> to 1).
+# 
+# The running totals of each network (from <em>create_networks_streaming()</em>) are kept in a state file in <em>file_output_info['CACHEFOLDER']</em>, together with the last row of each patient (in each category, for a network that does not represent the removed data), the last ReferralDate of each patient and the admissions that were open (had no ReferralDischarge) when the data was acquired.  The first run creates the state from the input file (<em>file_output_info['FILESTART']</em>) and writes all of the output files.
+# 
+# A later run with <em>file_output_info['DELTAFILE']</em> set to the new period's file (in the same format, in <em>file_output_info['FOLDER']</em>) applies it to the state with <em>apply_delta()</em>:
+# 
+# 1. A new row for an open admission (the same ClientID, ReferralDate and WardTeam) closes it (if more than one open admission has the same ClientID, ReferralDate and WardTeam, they are closed by the new rows with that key in the order they were read): its LoS is removed from the node counts and the LoS with the new ReferralDischarge added instead.  An admission that is still open has its LoS calculated again to the date in <em>set_dictionary_for_data_schema()</em> (which should be changed to the date the new data was acquired).
+# 2. The other new rows are new referrals.  Each patient's last row is put before their new rows, so the transition from a patient's previous last service to their new first service is counted, then the links and node counts are added as in <em>accumulate_network()</em>.  The new referrals must not be earlier than the patient's last ReferralDate in the history (otherwise the transitions already counted would change): create the networks again from the whole history instead.
+# 3. Only the output files for the categories that have changed are written again (all of the categories of a network that represents the removed data, as the other categories' subgroup nodes are in every network).
+# 
+# The time to apply a period of data depends on the size of the new period (and of the state), not on the size of the history.  A delta file that has already been applied is not applied again.
+
+# In[ ]:
+
+
+def network_name(subgroup_info):
+    """Returns the name of the network (the settings in subgroup_info, without the data), used to find it in the state"""
+    return repr(sorted((key, value) for key, value in subgroup_info.items() if key not in ('DATA', 'ROWS')))
+
+
+def update_networks(networks, file_output_info):
+    """Updates the output files for a list of networks (a subgroup_info dictionary for each, without DATA) with the new
+    period of referrals in file_output_info['DELTAFILE'], using the state file of the networks (which is created from the 
+    input file, and all of the output files written, if there is no state file)"""
     
-    # In[58]:
+    stateFile = file_output_info['CACHEFOLDER'] + str(file_output_info['FILESTART']) + '_network_state.pkl'
+    if os.path.exists(stateFile):
+        with open(stateFile, 'rb') as stateData:
+            state = pickle.load(stateData)
+        missing = [network for network in networks if network_name(network) not in state['NETWORKS']]
+        if missing:
+            raise ValueError('The networks have changed since the state file was created, remove ' + stateFile + 
+                             ' to create it again from the input file')
+    else:
+        state = {'NETWORKS' : {}, 'OPEN' : [], 'LASTDATE' : [], 'ROWS' : 0, 'DELTAS' : []}
+        create_networks_streaming(networks, file_output_info, state)
+    
+    if file_output_info.get('DELTAFILE', ''):
+        deltaHash = hash_file(file_output_info['FOLDER'] + str(file_output_info['DELTAFILE']) + '.csv')
+        if deltaHash not in state['DELTAS']:
+            with stage('apply_delta'):
+                apply_delta(networks, file_output_info, state)
+            state['DELTAS'].append(deltaHash)
+    
+    #Store the text columns of the last rows as categorical (they become Python strings when chunks are put together)
+    for accumulator in state['NETWORKS'].values():
+        if accumulator['TAIL'] is not None:
+            TAIL = accumulator['TAIL']
+            accumulator['TAIL'] = TAIL.astype({column : 'category' for column in TAIL.columns if TAIL[column].dtype == object})
+    
+    #Write to a temporary file first, so an interrupted run does not leave a partial state file
+    if not os.path.isdir(file_output_info['CACHEFOLDER']):
+        os.makedirs(file_output_info['CACHEFOLDER'])
+    with open(stateFile + '.tmp', 'wb') as stateData:
+        pickle.dump(state, stateData, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(stateFile + '.tmp', stateFile)
+    
+    #A network with no rows in any period is an error (once the state is saved, so the next period can still be added)
+    for subgroup_info in networks:
+        if state['NETWORKS'][network_name(subgroup_info)]['LOS'] is None:
+            check_network_rows(subgroup_info['SUBGROUP_FILENAME'], 0)
+    return
+
+
+def apply_delta(networks, file_output_info, state):
+    """Applies the new period of referrals (file_output_info['DELTAFILE']) to the state of the networks, and outputs the 
+    files for the categories that have changed"""
+    
+    NEW = read_data(file_output_info, filestart = file_output_info['DELTAFILE'])
+    NEW = clean_data(NEW)
+    NEW = calculate_LoS(NEW)
+    NEW = delete_zero_LoS(NEW)
+    NEW = add_one_OOA_node_column(NEW)
+    #Number the new rows after the rows already read, so they come after them when sorted
+    NEW.index = NEW.index + state['ROWS']
+    if len(NEW):
+        state['ROWS'] = int(NEW.index.max()) + 1
+    
+    #1. Close the open admissions (or calculate their LoS again, if still open)
+    #Open admissions can have the same (ClientID, ReferralDate, WardTeam), so the rows with the same key are paired in order:
+    #the key also has the number of the row among the rows with that key (the open admissions in the order they were read)
+    OPEN = state['OPEN'].sort_index()
+    keys = []
+    for ADMISSIONS in (OPEN, NEW):
+        KEYS = pd.DataFrame({'ClientID' : ADMISSIONS.ClientID.values, 'ReferralDate' : ADMISSIONS.ReferralDate.values,
+                             'WardTeam' : ADMISSIONS.WardTeam.to_numpy(dtype = object)})
+        KEYS['Occurrence'] = KEYS.groupby(['ClientID', 'ReferralDate', 'WardTeam'], sort = False, dropna = False).cumcount().values
+        keys.append(pd.MultiIndex.from_frame(KEYS))
+    openKey, newKey = keys
+    closing = openKey.get_indexer(newKey)
+    isClosing = closing >= 0
+    closing = closing[isClosing] #the open admission closed by each closing row
+    discharge = np.full(len(OPEN), np.datetime64(set_dictionary_for_data_schema()['FILL']['ReferralDischarge']), 
+                        dtype = 'datetime64[ns]')
+    discharge[closing] = NEW.ReferralDischarge.values[isClosing]
+    stillOpen = np.ones(len(OPEN), dtype = bool)
+    stillOpen[closing] = NEW.OpenAdmission.values[isClosing]
+    UPDATED = calculate_LoS(OPEN.assign(ReferralDischarge = discharge, OpenAdmission = stillOpen))
+    #A negative LoS (a ReferralDischarge before the ReferralDate) is not used, the admission keeps its previous LoS
+    valid = UPDATED.LoSdays.values >= 0
+    changed = valid & (UPDATED.LoSdays.values != OPEN.LoSdays.values)
+    for subgroup_info in networks:
+        accumulator = state['NETWORKS'][network_name(subgroup_info)]
+        accumulate_nodes(subgroup_info, OPEN[changed], accumulator, sign = -1)
+        accumulate_nodes(subgroup_info, UPDATED[changed], accumulator)
+    UPDATED = pd.concat((UPDATED[valid], OPEN[~valid]))
+    NEW = NEW[~isClosing]
+    state['OPEN'] = pd.concat((UPDATED[UPDATED.OpenAdmission.values], NEW[NEW.OpenAdmission.values]))
+    
+    #2. Add the new referrals, after each patient's last row
+    lastDate = state['LASTDATE'].reindex(NEW.ClientID.values).values
+    if np.any(NEW.ReferralDate.values < lastDate):
+        raise ValueError('The new referrals include referrals before a patient\'s last referral, create the networks again '
+                         'from the whole history instead')
+    NEW = sort_data(NEW)
+    newClients = pd.unique(NEW.ClientID.values)
+    for subgroup_info in networks:
+        accumulator = state['NETWORKS'][network_name(subgroup_info)]
+        TAIL = accumulator['TAIL']
+        if TAIL is not None:
+            TAIL = TAIL[TAIL.ClientID.isin(newClients)].drop(columns = 'group')
+            DATA = sort_data(pd.concat((TAIL, NEW)))
+        else:
+            DATA = NEW
+        accumulate_network(subgroup_info, DATA, accumulator, counted = DATA.index.isin(NEW.index))
+    state['LASTDATE'] = pd.concat((state['LASTDATE'], NEW.groupby('ClientID').ReferralDate.max())).groupby(level = 0).max()
+    
+    #3. Output the files for the categories that have changed
+    for subgroup_info in networks:
+        write_accumulated_networks(subgroup_info, file_output_info, state['NETWORKS'][network_name(subgroup_info)], 
+                                   changedOnly = True)
+    return
+
+
+# ## Creating the networks from partitions of the patients (sharded)
+# 
+# A transition is between two rows of the same patient, so the PD data can be split into partitions of whole patients and each partition processed on its own: by the worker processes of one computer, or by several computers (hosts) that share a folder.  The partial results are then added together, and the output files are the same as those from the complete dataset.  Set <em>file_output_info['SHARDS']</em> to the number of partitions.
+# 
+# The steps (<em>file_output_info['SHARD_STEP']</em>) are:
+# 
+# 1. 'PARTITION': <em>partition_by_client()</em> reads the input file in chunks (as when streaming) and splits the prepared rows by a hash of ClientID into the partition files, in <em>file_output_info['SHARDFOLDER']</em>.  The description of the partitions (the number of partitions, and the key of the input file and of the code that prepares it, see <em>prepared_data_key()</em>) is written last, so the partitions are only used once they are all complete.  Partitions of the same input file that are already in the folder are not written again.
+# 2. 'PROCESS': <em>process_shard()</em> sorts each partition and adds it to new running totals for each network (as in <em>accumulate_network()</em>), which are stored as the partition's partial result.  The partitions are processed in a pool of <em>file_output_info['WORKERS']</em> processes (see <em>run_network_jobs()</em>).  When there are several hosts, each runs this step with its number in <em>file_output_info['SHARD_HOST']</em> (from 0) and the number of hosts in <em>file_output_info['SHARD_HOSTS']</em>, and processes the partitions whose number divided by SHARD_HOSTS leaves SHARD_HOST.
+# 3. 'MERGE': <em>merge_shard_results()</em> adds the partial results of the partitions together in turn (with <em>merge_accumulators()</em>), and <em>write_accumulated_networks()</em> outputs the files.  A partition without a partial result for every network (or with one from other partitions, or another LOS_SKETCH) is an error that names the partitions still to process.
+# 
+# The partitions and the partial results are zip files of NumPy arrays and json (see <em>write_frame()</em>), not pickles, so loading a file from the shared folder does not run any code, and the hosts do not need the same versions of Python and Pandas.
+# 
+# 'ALL' runs the three steps one after the other.  Each worker process only holds one partition in memory, and the partial results have a row per link and per LoS value of each node, so the number of partitions can be raised until a partition fits in memory.  As when streaming, the ClientIDs of the patients that only have 1 service use are not found.
+
+# In[ ]:
+
+
+def shard_filename(file_output_info, name):
+    """Returns the filename of a file of the partitions (name: the end of the filename) in file_output_info['SHARDFOLDER']"""
+    return file_output_info['SHARDFOLDER'] + str(file_output_info['FILESTART']) + name
+
+
+def load_partition_description(file_output_info):
+    """Returns the description of the partitions in file_output_info['SHARDFOLDER'] (a dictionary: KEY, SHARDS), or None if 
+    there are no complete partitions"""
+    
+    descriptionFile = shard_filename(file_output_info, '_partitions.json')
+    if not os.path.exists(descriptionFile):
+        return None
+    with open(descriptionFile) as description:
+        return json.load(description)
+
+
+def partition_by_client(file_output_info):
+    """Splits the prepared PD data by a hash of ClientID into file_output_info['SHARDS'] partition files, unless the partitions 
+    of the same input file are already in file_output_info['SHARDFOLDER']
+    Returns the description of the partitions (a dictionary: KEY, SHARDS)"""
+    
+    description = {'KEY' : prepared_data_key(file_output_info), 'SHARDS' : file_output_info['SHARDS']}
+    partitionNames = [shard_filename(file_output_info, '_partition_' + str(p) + '.zip') for p in range(description['SHARDS'])]
+    if load_partition_description(file_output_info) == description and all(os.path.exists(name) for name in partitionNames):
+        return description
+    
+    with stage('partition_by_client'):
+        if not os.path.isdir(file_output_info['SHARDFOLDER']):
+            os.makedirs(file_output_info['SHARDFOLDER'])
+        #Remove the partitions, and their partial results, of an earlier input file
+        for oldFile in os.listdir(file_output_info['SHARDFOLDER']):
+            if oldFile.startswith((str(file_output_info['FILESTART']) + '_partition', str(file_output_info['FILESTART']) + '_shard_')):
+                os.remove(file_output_info['SHARDFOLDER'] + oldFile)
+        #Write to temporary files first, and the description last, so an interrupted run does not leave partial partitions
+        write_partitions(file_output_info, [name + '.tmp' for name in partitionNames])
+        for name in partitionNames:
+            os.replace(name + '.tmp', name)
+        descriptionFile = shard_filename(file_output_info, '_partitions.json')
+        write_text(descriptionFile + '.tmp', json.dumps(description))
+        os.replace(descriptionFile + '.tmp', descriptionFile)
+    return description
+
+
+def process_shard(networks, file_output_info, shard, key):
+    """Adds the rows of one partition (shard) to new running totals for each network (a subgroup_info dictionary for each, 
+    without DATA), and stores them as the partition's partial result, with the key of the partitions (key)"""
+    
+    DATA = read_partition(shard_filename(file_output_info, '_partition_' + str(shard) + '.zip'))
+    if len(DATA):
+        DATA = sort_data(DATA)
+    accumulators = {}
+    for subgroup_info in networks:
+        accumulator = new_network_accumulator(sketch = file_output_info.get('LOS_SKETCH', 0))
+        if len(DATA):
+            with stage('accumulate_network', network = subgroup_info['SUBGROUP_FILENAME'], rowsIn = len(DATA)):
+                accumulate_network(subgroup_info, DATA, accumulator)
+        accumulators[network_name(subgroup_info)] = accumulator
+    
+    #Write to a temporary file first, so an interrupted run does not leave a partial result.  The running totals are stored
+    #as tables (see write_frame()), with the rest of the result in RESULT.json
+    resultFile = shard_filename(file_output_info, '_shard_' + str(shard) + '.zip')
+    result = {'KEY' : key, 'SHARD' : shard, 'NETWORKS' : []}
+    with zipfile.ZipFile(resultFile + '.tmp', 'w') as resultData:
+        for n, (name, accumulator) in enumerate(accumulators.items()):
+            tables = [table for table in ('LINKS', 'GROUP_MOVES', 'LOS', 'SETTING') if accumulator[table] is not None]
+            result['NETWORKS'].append({'NAME' : name, 'LOS_SKETCH' : accumulator['LOS_SKETCH'], 'TABLES' : tables})
+            write_frame(resultData, 'network' + str(n) + '_GROUPS', pd.Series(accumulator['GROUPS'], dtype = object))
+            for table in tables:
+                write_frame(resultData, 'network' + str(n) + '_' + table, accumulator[table])
+        resultData.writestr('RESULT.json', json.dumps(result))
+    os.replace(resultFile + '.tmp', resultFile)
+    return
+
+
+def run_shard_job(job):
+    """Processes the partition of one job from create_networks_sharded() with process_shard(), in this process or in a 
+    worker process
+    Returns the job's row of the memory report (with the job's rows of the run report, in 'STAGES', if run in a worker 
+    process)"""
+    
+    inWorker = job.get('INSTRUMENT') is not None and (INSTRUMENTATION is None or INSTRUMENTATION['WORKER'] or 
+                                                      INSTRUMENTATION['PID'] != os.getpid())
+    if inWorker:
+        start_instrumentation(worker = True)
+        INSTRUMENTATION['START'] = job['INSTRUMENT']
+    memory_report = start_memory_report([], job['NAME'])
+    with stage('process_shard', network = job['NAME']):
+        process_shard(job['NETWORKS'], job['FILE_OUTPUT_INFO'], job['SHARD'], job['KEY'])
+    memory_report = end_memory_report(memory_report)[0]
+    if inWorker:
+        memory_report['STAGES'] = stop_instrumentation()
+    return memory_report
+
+
+def merge_accumulators(accumulator, other):
+    """Adds the running totals of a network for other patients (other, from new_network_accumulator()) to accumulator
+    Returns accumulator"""
+    
+    for group in other['GROUPS']:
+        if group not in accumulator['GROUPS']:
+            accumulator['GROUPS'].append(group)
+    for key in ('LINKS', 'GROUP_MOVES', 'LOS'):
+        if other[key] is not None:
+            accumulator[key] = other[key] if accumulator[key] is None else accumulator[key].add(other[key], fill_value = 0)
+    if other['SETTING'] is not None:
+        setting = other['SETTING']
+        if accumulator['SETTING'] is not None:
+            #Keep the Setting of the first row for each node in the sorted data, as in accumulate_nodes()
+            setting = pd.concat((accumulator['SETTING'], setting)).reset_index()
+            setting = setting.sort_values(['ClientID', 'ReferralDate', 'row'], kind = 'mergesort')
+            setting = setting.groupby(['group', 'ward'])[['Setting', 'ClientID', 'ReferralDate', 'row']].first()
+        accumulator['SETTING'] = setting
+    return accumulator
+
+
+def merge_shard_results(networks, file_output_info, description):
+    """Adds together the partial results of every partition (see process_shard()) for each network
+    Returns a dictionary of the running totals of each network, keyed on network_name()"""
+    
+    sketch = file_output_info.get('LOS_SKETCH', 0)
+    accumulators = {network_name(subgroup_info) : new_network_accumulator(sketch = sketch) for subgroup_info in networks}
+    missing = []
+    with stage('merge_shard_results'):
+        for shard in range(description['SHARDS']):
+            resultFile = shard_filename(file_output_info, '_shard_' + str(shard) + '.zip')
+            result = None
+            if os.path.exists(resultFile):
+                with zipfile.ZipFile(resultFile) as resultData:
+                    result = json.loads(resultData.read('RESULT.json'))
+                    shardNetworks = {}
+                    for n, network in enumerate(result['NETWORKS']):
+                        accumulator = new_network_accumulator(sketch = network['LOS_SKETCH'])
+                        accumulator['GROUPS'] = read_frame(resultData, 'network' + str(n) + '_GROUPS').tolist()
+                        for table in network['TABLES']:
+                            accumulator[table] = read_frame(resultData, 'network' + str(n) + '_' + table)
+                        shardNetworks[network['NAME']] = accumulator
+                    result['NETWORKS'] = shardNetworks
+            if result is None or result['KEY'] != description['KEY'] or any(
+                    name not in result['NETWORKS'] or result['NETWORKS'][name]['LOS_SKETCH'] != sketch for name in accumulators):
+                missing.append(shard)
+                continue
+            for name, accumulator in accumulators.items():
+                merge_accumulators(accumulator, result['NETWORKS'][name])
+    if missing:
+        raise ValueError('The partitions ' + ', '.join(str(shard) for shard in missing) + ' in ' + 
+                         file_output_info['SHARDFOLDER'] + ' have not been processed for these networks, run the \'PROCESS\' '
+                         'step for them first')
+    return accumulators
+
+
+def create_networks_sharded(networks, file_output_info):
+    """Creates the output files for a list of networks (a subgroup_info dictionary for each, without DATA) from partitions of 
+    the patients, running the steps in file_output_info['SHARD_STEP']: 'PARTITION', 'PROCESS', 'MERGE' or 'ALL' (all three)
+    Returns the memory report, a row per partition processed"""
+    
+    step = file_output_info.get('SHARD_STEP', 'ALL')
+    if step not in ('ALL', 'PARTITION', 'PROCESS', 'MERGE'):
+        raise ValueError('SHARD_STEP must be \'ALL\', \'PARTITION\', \'PROCESS\' or \'MERGE\', not ' + repr(step))
+    memory_report = []
+    with stage('create_networks_sharded'):
+        if step in ('ALL', 'PARTITION'):
+            description = partition_by_client(file_output_info)
+        else:
+            description = load_partition_description(file_output_info)
+            if description is None:
+                raise ValueError('There are no partitions in ' + file_output_info['SHARDFOLDER'] + ', run the \'PARTITION\' '
+                                 'step first')
+        
+        if step in ('ALL', 'PROCESS'):
+            shards = range(description['SHARDS'])
+            if step == 'PROCESS':
+                shards = [shard for shard in shards 
+                          if shard % file_output_info.get('SHARD_HOSTS', 1) == file_output_info.get('SHARD_HOST', 0)]
+            settings = {'NETWORKS' : [{key : value for key, value in subgroup_info.items() if key not in ('DATA', 'ROWS')} 
+                                      for subgroup_info in networks],
+                        'FILE_OUTPUT_INFO' : {key : value for key, value in file_output_info.items() 
+                                              if key not in ('DATA_SG', 'ROWS', 'SG_COLUMNS', 'SINGLES', 'UNIQUE_PATHWAYS')},
+                        'KEY' : description['KEY'],
+                        'INSTRUMENT' : INSTRUMENTATION['START'] if INSTRUMENTATION is not None else None}
+            jobs = [dict(settings, NAME = 'Partition ' + str(shard), SHARD = shard) for shard in shards]
+            memory_report = run_network_jobs(jobs, None, file_output_info.get('WORKERS', 1), run = run_shard_job)
+        
+        if step in ('ALL', 'MERGE'):
+            accumulators = merge_shard_results(networks, file_output_info, description)
+            for subgroup_info in networks:
+                with stage('write_accumulated_networks', network = subgroup_info['SUBGROUP_FILENAME']):
+                    write_accumulated_networks(subgroup_info, file_output_info, accumulators[network_name(subgroup_info)])
+    return memory_report
+
+
+# ## Function run_networks()
+# 
+# Creates the output files for a list of networks in the way set in <em>file_output_info</em> (in memory from the prepared data, in chunks, in partitions, in delta mode, or for each time window), then the networks of the cube queries.  Used by the main code, and by <em>Run_PD_networks.py</em> for the networks of a spec file (which prepares the data once for all of the spec files of the same input file).
+
+# In[ ]:
+
+
+def run_networks(networks, file_output_info, DATA = None, memory_report = None):
+    """Creates the output files for a list of networks (a subgroup_info dictionary for each, with DATA): updated with the 
+    new period of referrals if file_output_info['DELTA'] is 1, from partitions of the patients if file_output_info['SHARDS'] 
+    is more than 0, from the input file in chunks if file_output_info['STREAMING'] is 1, for each time window if 
+    file_output_info['SNAPSHOTS'] is set, otherwise from the prepared PD data (DATA).  Then the networks for 
+    file_output_info['CUBE_QUERIES'], from the transition cube of DATA
+    Returns the memory report (memory_report, with the rows of these networks added)"""
+    
+    memory_report = [] if memory_report is None else memory_report
+    if file_output_info['DELTA']:
+        start_memory_report(memory_report, 'Update the networks with the new period of referrals')
+        update_networks(networks, file_output_info)
+        end_memory_report(memory_report)
+    elif file_output_info['SHARDS']:
+        memory_report += create_networks_sharded(networks, file_output_info)
+    elif file_output_info['STREAMING']:
+        start_memory_report(memory_report, 'Create the networks from the input file in chunks')
+        create_networks_streaming(networks, file_output_info)
+        end_memory_report(memory_report)
+    elif file_output_info['SNAPSHOTS']:
+        start_memory_report(memory_report, 'Create the networks for each time window')
+        create_network_snapshots(networks, file_output_info)
+        end_memory_report(memory_report)
+    else:
+        memory_report += create_networks(networks, file_output_info, DATA)
     
+    if file_output_info['CUBE_QUERIES'] and DATA is not None:
+        start_memory_report(memory_report, 'Create the networks from the transition cube')
+        cube = load_transition_cube(file_output_info, DATA, file_output_info['CUBE_WARDTEAM'])
+        for filters in file_output_info['CUBE_QUERIES']:
+            output_cube_network(cube, filters, file_output_info, file_output_info['CUBE_REPRESENT_REMOVED'])
+        end_memory_report(memory_report)
+    return memory_report
+
+
+# ## Memory report functions
+# 
+# To check the memory used to create each network, function <em>start_memory_report()</em> is called before the network is created, and <em>end_memory_report()</em> after.  Between the two calls the peak resident set size (RSS: the memory the process holds) is recorded.  On Linux the peak is reset at the start of each network, so it is the peak for that network; on other systems it is the peak since the program started.
+# 
+# The report is a list with a dictionary per network.
+
+# In[ ]:
+
+
+def read_memory():
+    """Returns the current and the peak resident set size (RSS) of this process, in MB"""
+    try:
+        with open('/proc/self/status') as statusFile:
+            status = dict(line.split(':', 1) for line in statusFile if ':' in line)
+        return int(status['VmRSS'].split()[0]) / 1024., int(status['VmHWM'].split()[0]) / 1024.
+    except (IOError, KeyError):
+        #Not Linux: only the peak is available (ru_maxrss is in KB on Linux, but bytes on macOS)
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024. * 1024. if sys.platform == 'darwin' else 1024.)
+        return peak, peak
+
+
+def reset_peak_memory():
+    """Resets the peak RSS of this process to the current RSS (Linux only, otherwise the peak is not changed)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clearRefs:
+            clearRefs.write('5')
+    except IOError:
+        pass
+    return
+
+
+def start_memory_report(memory_report, network):
+    """Resets the peak RSS (Linux only) and adds a row to memory_report for the network about to be created"""
+    reset_peak_memory()
+    rss, peak = read_memory()
+    memory_report.append({'Network' : network, 'StartRSS_MB' : rss, 'Reused' : 0})
+    return memory_report
+
+
+def end_memory_report(memory_report):
+    """Records the current and peak RSS in memory_report for the network that has just been created"""
+    rss, peak = read_memory()
+    memory_report[-1].update({'EndRSS_MB' : rss, 'PeakRSS_MB' : peak})
+    return memory_report
+
+
+def write_memory_report(file_output_info, memory_report):
+    """Outputs the memory report (a row per network, or job) to the data folder"""
+    pd.DataFrame(memory_report, columns = ['Network', 'StartRSS_MB', 'EndRSS_MB', 'PeakRSS_MB', 'Reused']).to_csv(
+        file_output_info['FOLDER'] + str(file_output_info['FILESTART']) + '_memory_report' + file_output_info['FILEEX'], 
+        sep = ',', index = False)
+    return
+
+
+# ## Instrumentation (the run report)
+# 
+# To find which stage (or which network) of a run is slow, or uses the most memory, the run can be instrumented: set <em>file_output_info['INSTRUMENT']</em> to 1 (or call <em>start_instrumentation()</em> before using the functions from other code).
+# 
+# Each stage of the pipeline is run inside <em>with stage(name):</em>, which records a row in the run report when the stage ends:
+# 
+# "Stage" : the name of the stage (for example 'read_data', 'update_dictionary', 'output_SM_file')
+# "Network" : the network (or category of a subgroup) the stage is for, as in the memory report.  A stage inside another stage has the network of the outer stage, unless it is given its own
+# "Status" : 'ok', or the type of the error if the stage failed
+# "StartSeconds", "Seconds", "CPUSeconds" : when the stage started (seconds since the instrumentation was started), its wall time and its CPU time (of the process that ran it)
+# "StartRSS_MB", "EndRSS_MB", "PeakRSS_MB", "PeakDelta_MB" : the RSS at the start and end of the stage, the peak RSS during the stage, and the peak less the start (the extra memory the stage needed)
+# "RowsIn", "RowsOut", "Nodes", "Edges" : the number of rows of PD data the stage was given and returned, and the number of nodes and edges of the network it created (where they apply, otherwise empty)
+# 
+# Stages can be inside other stages (for example each network job contains its <em>update_dictionary()</em> and output stages), and the peak RSS of an outer stage includes the peaks of the stages inside it.  The rows are in the order the stages ended.  The stages run in worker processes are returned to the main process with the job's memory report, and added to the run report there.
+# 
+# <em>stage()</em> returns the row (a dictionary), so the code inside the stage can add the counts it knows (for example <em>record['Nodes'] = n</em>).  It can also be used to time other code.  Each function in <em>start_instrumentation(hooks)</em> is called with each row of the report as it is recorded, for example to log the stages as they finish.
+# 
+# The report is written by <em>write_run_report()</em> as a csv file and a json file in the data folder.  When the instrumentation is not started, <em>stage()</em> only checks that it is off, so it adds no measurable time to the run.
+
+# In[ ]:
+
+
+#The run report and hooks used by stage(), set by start_instrumentation() (None: not instrumented)
+INSTRUMENTATION = None
+
+RUN_REPORT_COLUMNS = ['Stage', 'Network', 'Status', 'StartSeconds', 'Seconds', 'CPUSeconds', 'StartRSS_MB', 'EndRSS_MB', 
+                      'PeakRSS_MB', 'PeakDelta_MB', 'RowsIn', 'RowsOut', 'Nodes', 'Edges']
+
+
+def start_instrumentation(hooks = None, worker = False):
+    """Starts recording a row in the run report for each stage (see stage())
+    hooks: (optional) a list of functions, each is called with each row as it is recorded
+    worker: True in a worker process, whose rows are returned to the main process (see run_network_job())"""
+    global INSTRUMENTATION
+    INSTRUMENTATION = {'REPORT' : [], 'HOOKS' : list(hooks or []), 'STACK' : [], 'NETWORK' : '', 
+                       'START' : time.perf_counter(), 'PID' : os.getpid(), 'WORKER' : worker}
+    return
+
+
+def stop_instrumentation():
+    """Stops recording the stages, and returns the run report (a list of dictionaries, a row per stage)"""
+    global INSTRUMENTATION
+    report = INSTRUMENTATION['REPORT'] if INSTRUMENTATION is not None else []
+    INSTRUMENTATION = None
+    return report
+
+
+@contextlib.contextmanager
+def stage(name, network = None, rowsIn = None):
+    """Records the time, memory and counts of the code run inside 'with stage(name):' as a row in the run report
+    network: (optional) the network the stage is for (the network of the outer stage if not given)
+    rowsIn: (optional) the number of rows of PD data the stage is given
+    Gives the row (a dictionary), for the stage to add RowsOut, Nodes and Edges to (a dictionary that is not kept if the
+    instrumentation is not started)"""
+    
+    if INSTRUMENTATION is None:
+        yield {}
+        return
+    
+    #The peak since the last reset belongs to all of the stages still open, then reset it for this stage
+    rss, peak = read_memory()
+    for record in INSTRUMENTATION['STACK']:
+        record['PeakRSS_MB'] = max(record['PeakRSS_MB'], peak)
+    reset_peak_memory()
+    record = {'Stage' : name, 'Network' : INSTRUMENTATION['NETWORK'] if network is None else str(network), 'Status' : 'ok',
+              'StartSeconds' : time.perf_counter() - INSTRUMENTATION['START'], 'StartRSS_MB' : rss, 'PeakRSS_MB' : rss,
+              'RowsIn' : rowsIn}
+    outerNetwork = INSTRUMENTATION['NETWORK']
+    INSTRUMENTATION['NETWORK'] = record['Network']
+    INSTRUMENTATION['STACK'].append(record)
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+        yield record
+    except BaseException as error:
+        record['Status'] = type(error).__name__
+        raise
+    finally:
+        record['Seconds'] = time.perf_counter() - wallStart
+        record['CPUSeconds'] = time.process_time() - cpuStart
+        INSTRUMENTATION['STACK'].pop()
+        INSTRUMENTATION['NETWORK'] = outerNetwork
+        rss, peak = read_memory()
+        for openRecord in INSTRUMENTATION['STACK'] + [record]:
+            openRecord['PeakRSS_MB'] = max(openRecord['PeakRSS_MB'], peak)
+        record['EndRSS_MB'] = rss
+        record['PeakDelta_MB'] = record['PeakRSS_MB'] - record['StartRSS_MB']
+        record_stage(record)
+
+
+def record_stage(record):
+    """Adds a row to the run report, and calls the hooks with it (the hooks are called in the main process)"""
+    INSTRUMENTATION['REPORT'].append(record)
+    for hook in INSTRUMENTATION['HOOKS']:
+        hook(record)
+    return
+
+
+def write_run_report(file_output_info, report = None):
+    """Outputs the run report (report, or the report being recorded if not given) as a csv file and a json file"""
+    
+    if report is None:
+        report = INSTRUMENTATION['REPORT'] if INSTRUMENTATION is not None else []
+    fileName = file_output_info['FOLDER'] + str(file_output_info['FILESTART']) + '_run_report'
+    REPORT = pd.DataFrame(report, columns = RUN_REPORT_COLUMNS).astype({column : 'Int64' for column in RUN_REPORT_COLUMNS[-4:]})
+    REPORT.to_csv(fileName + file_output_info['FILEEX'], sep = ',', index = False)
+    run = {'FILESTART' : str(file_output_info['FILESTART']), 
+           'Date' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+           'Pandas' : pd.__version__,
+           'Stages' : [{column : record.get(column) for column in RUN_REPORT_COLUMNS} for record in report]}
+    with open(fileName + '.json', 'w') as reportFile:
+        json.dump(run, reportFile, indent = 1, default = float)
+    return
+
+
+# ## Writing the output files (in the background)
+# 
+# Every output file is written by <em>write_output()</em>, which is passed the filename and the function that writes it (for example <em>edgesdf.to_csv</em>).  The file is written to a temporary name (the filename with '.tmp_' in front) in the same folder and then renamed, so an interrupted run never leaves a part-written output file: each file is either the complete new file, or the file from before.
+# 
+# When the output writer is started (<em>start_output_writer()</em>, with <em>file_output_info['WRITERS']</em> threads) the files are written in the background, so the next network (or category) is calculated while the files of the last one are written.  At most <em>file_output_info['WRITE_QUEUE']</em> files can be waiting to be written; when the queue is full the calculation waits for a space, so the results waiting to be written do not fill the memory.  With 0 WRITERS each file is written before the calculation goes on.
+# 
+# The writer keeps a manifest: a row for each file written (File, Bytes, the seconds it took to write, and Reused: 1 for the files of a job that was not run again as they were unchanged, see <em>create_networks()</em>).  <em>stop_output_writer()</em> waits for the files still in the queue, raises the first error of any of them, and outputs the manifest to the data folder (<em>FILESTART</em> + '_manifest'), so the end of a run has a list of what it produced.  A worker process (see <em>run_network_job()</em>) has its own writer, and its rows of the manifest are returned to the main process with the job's memory report.  The writer is waited for before the pool of worker processes is started, so no file is being written when a worker process is forked.
+
+# In[ ]:
+
+
+#The background writer used by write_output(), set by start_output_writer() (None: each file is written straight away)
+OUTPUT_WRITER = None
+
+MANIFEST_COLUMNS = ['File', 'Bytes', 'Seconds', 'Reused']
+
+
+def start_output_writer(file_output_info):
+    """Starts writing the output files in the background, in file_output_info['WRITERS'] threads, with at most 
+    file_output_info['WRITE_QUEUE'] files waiting to be written"""
+    global OUTPUT_WRITER
+    import concurrent.futures
+    import threading
+    writers = file_output_info.get('WRITERS', 0)
+    OUTPUT_WRITER = {'POOL' : concurrent.futures.ThreadPoolExecutor(writers) if writers > 0 else None, 
+                     'QUEUE' : threading.BoundedSemaphore(max(file_output_info.get('WRITE_QUEUE', 1), 1)),
+                     'PENDING' : set(), 'MANIFEST' : [], 'FILES' : [], 'ERRORS' : [], 'PID' : os.getpid(), 
+                     'SETTINGS' : {'WRITERS' : writers, 'WRITE_QUEUE' : file_output_info.get('WRITE_QUEUE', 1)}}
+    return
+
+
+def write_output(filename, write, *args, **kwargs):
+    """Writes an output file: write(temporary filename, *args, **kwargs) writes it to a temporary name, which is then renamed
+    to filename.  In the background if the output writer is started (see start_output_writer())"""
+    
+    writer = OUTPUT_WRITER
+    #The temporary name keeps the extension, so to_csv() still infers any compression from it
+    folder, name = os.path.split(filename)
+    tmpFile = os.path.join(folder, '.tmp_' + name)
+    def write_file():
+        writeStart = time.perf_counter()
+        try:
+            write(tmpFile, *args, **kwargs)
+            os.replace(tmpFile, filename)
+        except BaseException:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            raise
+        if writer is not None:
+            writer['MANIFEST'].append({'File' : filename, 'Bytes' : os.path.getsize(filename), 
+                                       'Seconds' : time.perf_counter() - writeStart, 'Reused' : 0})
+    
+    if writer is not None:
+        writer['FILES'].append(filename) #in the order they are written, for the result cache (see create_networks())
+    if writer is None or writer['POOL'] is None:
+        write_file()
+        return
+    #Wait for a space in the queue, then write in the background
+    writer['QUEUE'].acquire()
+    future = writer['POOL'].submit(write_file)
+    writer['PENDING'].add(future)
+    def written(future):
+        writer['QUEUE'].release()
+        if future.exception() is not None:
+            writer['ERRORS'].append(future.exception())
+        writer['PENDING'].discard(future)
+    future.add_done_callback(written)
+    return
+
+
+def flush_output_writer():
+    """Waits until the files waiting to be written have been written, and raises the first error of any of them"""
+    if OUTPUT_WRITER is None:
+        return
+    import concurrent.futures
+    pending = list(OUTPUT_WRITER['PENDING'])
+    concurrent.futures.wait(pending)
+    errors = OUTPUT_WRITER['ERRORS'] + [future.exception() for future in pending if future.exception() is not None]
+    if errors:
+        raise errors[0]
+    return
+
+
+def stop_output_writer(file_output_info = None):
+    """Waits for the files waiting to be written, stops the output writer, and returns the manifest (a list of dictionaries,
+    a row per file written).  If file_output_info is given, the manifest is also output to the data folder"""
+    global OUTPUT_WRITER
+    if OUTPUT_WRITER is None:
+        return []
+    try:
+        flush_output_writer()
+    finally:
+        if OUTPUT_WRITER['POOL'] is not None:
+            OUTPUT_WRITER['POOL'].shutdown() #waits for the files still being written
+        manifest = OUTPUT_WRITER['MANIFEST']
+        OUTPUT_WRITER = None
+    if file_output_info is not None:
+        MANIFEST = pd.DataFrame(manifest, columns = MANIFEST_COLUMNS).sort_values('File')
+        write_output(file_output_info['FOLDER'] + str(file_output_info['FILESTART']) + '_manifest' + file_output_info['FILEEX'],
+                     MANIFEST.to_csv, sep = ',', index = False)
+    return manifest
+
+
+# In[54]:
+
+if __name__ == '__main__':      
     
-    DATA = sort_data(DATA)
+    file_output_info=set_dictionary_for_filenames()
+    check_output_formats(file_output_info)
+    if file_output_info['INSTRUMENT']:
+        start_instrumentation()
+    start_output_writer(file_output_info)
     
     
-    # Create another Pandas dataframe that represents all of the OOA nodes as 1 single node (by changing all the OOA nodes WardTeam names to "All OOA Services").
+    # ### Read in and prepare the data
+    # Read in the personality disorder admission data, clean the data, calculate the LoS, sort the data and add a column that represents all of the OOA nodes as 1 single node (see <em>prepare_data()</em>).  If the input file and the cleaning rules have not changed since the last run, the prepared data is loaded from the cache instead (see <em>load_prepared_data()</em>).
+    # 
+    # Every WardTeam name is then given its code in the node registry (see <em>create_node_registry()</em>).
+    # 
+    # DATA is not changed after this point: each network uses the rows and columns it needs from DATA, rather than a copy of it.
     
-    # In[59]:
+    # In[55]:
     
     
-    DATA_OneOOA = DATA.copy(deep = True)
-    DATA_OneOOA = create_DATA_with_one_OOA_node(DATA_OneOOA)
+    memory_report = []
+    if file_output_info['STREAMING'] or file_output_info['DELTA'] or file_output_info['SHARDS']:
+        DATA = None #The data is read in chunks (or only the new period, or a partition) when the networks are created
+    else:
+        start_memory_report(memory_report, 'Read and prepare the data')
+        DATA = load_prepared_data(file_output_info)
+        file_output_info = create_node_registry(file_output_info, DATA)
+        end_memory_report(memory_report)
     
     
     # ### Create the data for the networks
@@ -648,7 +3702,12 @@ if __name__ == '__main__':
     # Choice 2. n/a as not removing subgroups
     
     # In[60]:
-    subgroup_info={"DATA" : DATA_OneOOA.copy(deep = True), #Deep copy. Changing DATA_SG does not change DATA
+    
+    
+    #The networks are listed here, and all created together at the end (in parallel if file_output_info['WORKERS'] > 1)
+    networks = []
+    subgroup_info={"DATA" : DATA, #Not a copy. Creating the network does not change DATA
+                   "WARDTEAM" : 'WardTeamOneOOA',
                    "COLUMN" : '',
                    "REPRESENT_REMOVED" : 0,
                    "SUBGROUP_NODE_NAME" : '',
@@ -656,10 +3715,7 @@ if __name__ == '__main__':
     #KP need to find a way to set this in update_data
     
     
-    file_output_info["DATA_SG"] = DATA_OneOOA.copy(deep = True) #Deep copy. Changing DATA_SG does not change DATA
-    
-    (file_output_info)=update_dictionary(subgroup_info,file_output_info,"","")
-    create_output_files(file_output_info)
+    networks.append(subgroup_info)
      #           DATA_SG = create_new_ward_and_setting_columns(subgroup_info,DATA_SG,group)
      #           DATA_SG = add_columns_wardteamcatcode(DATA_SG)
      #           #Update the 2 objects in the directory
@@ -673,11 +3729,11 @@ if __name__ == '__main__':
     # Choice 1. Option B. Keep OOA nodes separate
     # Choice 2. n/a [Extracting the full patient data]
     # 
-    # For each subgroup (ClientID), filter the DATA for just those admissions for the clientID and pass a deep copy of the filtered DATA to DATA_SG (otherwise changes to the columns remain for the rest of the program).  Using DATA and not DATA_OneOOA as having the OOA nodes separate.
+    # For each subgroup (ClientID, given as CLIENTID), the rows of DATA for just those admissions for the clientID are found when the jobs are listed and passed as ROWS, with DATA as DATA_SG (the new columns are held separately, so DATA is not changed for the rest of the program).  Using WardTeam and not WardTeamOneOOA as having the OOA nodes separate.
     # 
     # Add the unique numberical ID for for WardTeams included in the subgroup data (running form 1 to n), to be used as the Source and Target node ID in the Edge output file.
     # 
-    # Call the function that calls the 3 functions in turn to output the files fo Gephi for this subgroup.
+    # Add the network to the list of networks to create.
     
     # In[61]:
     
@@ -685,16 +3741,14 @@ if __name__ == '__main__':
     
     clientID = [1007835,1004961]
     for cID in clientID:
-        subgroup_info={"DATA" : DATA[DATA.ClientID == cID].copy(deep = True), #Deep copy. Changing DATA_SG does not change DATA
+        subgroup_info={"DATA" : DATA, #Not a copy. Creating the network does not change DATA
+                       "CLIENTID" : cID, 
+                       "WARDTEAM" : 'WardTeam',
                        "COLUMN" : '',
                        "REPRESENT_REMOVED" : 0,
                        "SUBGROUP_NODE_NAME" :'',
-                       "SUBGROUP_FILENAME" : '_ClientID_'}
-        #KP need to find a way to set this in update_data
-        file_output_info["DATA_SG"] = DATA[DATA.ClientID == cID].copy(deep = True) #Deep copy. Changing DATA_SG does not change DATA
-    
-        file_output_info=update_dictionary(subgroup_info,file_output_info,"",cID)
-        create_output_files(file_output_info)
+                       "SUBGROUP_FILENAME" : '_ClientID_' + str(cID)}
+        networks.append(subgroup_info)
     
     
     # ### Networks 4 to 8. Network for each locality (#having a node to represent each of the other subgroups)
@@ -702,44 +3756,48 @@ if __name__ == '__main__':
     # Choice 1. n/a [OOA are already grouped as a single node due to the subgrouping].  
     # Choice 2. Option B: Represent the removed subgroups by their own node
     # 
-    # For each subgroup (each category of Locality in turn), pass a deep copy of the DATA to DATA_SG (otherwise changes to the columns remain for the rest of the program).  Using DATA and not DATA_OneOOA as having the OOA nodes separate.
+    # For each subgroup (each category of Locality in turn), pass DATA (not a copy, the changed columns are held separately for each subgroup so DATA is not changed for the rest of the program).  Using WardTeam and not WardTeamOneOOA as having the OOA nodes separate.
     # 
     # Edit the WardTeam column for the admissions that are not classified as the Locality category in focus by replacing their WardTeam name with their Locality category (so as to represent the subgroup data not in focus with a single node for their Locality category).
     # 
     # Add the unique numberical ID for for WardTeams included in the subgroup data (running form 1 to n), to be used as the Source and Target node ID in the Edge output file.
     # 
-    # Call the function that calls the 3 functions in turn to output the files fo Gephi for this subgroup.
+    # Add the network to the list of networks to create.
     
     # In[62]:
     
     
-    subgroup_info={"DATA" : DATA.copy(deep = True), #Deep copy. Changing DATA_SG does not change DATA
+    subgroup_info={"DATA" : DATA, #Not a copy. Creating the networks does not change DATA
+                   "WARDTEAM" : 'WardTeam',
                    "COLUMN" : 'Locality_Edit',
                    "REPRESENT_REMOVED" : 1,
                    "SUBGROUP_NODE_NAME" :'Locality ',
-                   "SUBGROUP_FILENAME" : '_Locality_'}
-    create_network_data_for_subgroup(subgroup_info,file_output_info)
+                   "SUBGROUP_FILENAME" : '_Locality_',
+                   "SINGLE_PASS" : 1}
+    networks.append(subgroup_info)
     
     # ### Networks 9 & 10. Network for two Clusters (#using one OOA node)
     # Subgroups: Clusters (7, 8)
     # Choice 1. Option A. Have one node to represent all OOA WardTeams
     # Choice 2. n/a as keeping all patient data together
     # 
-    # For each subgroup (each category of Cluster in turn), filter the DATA_OneOOA for just those admissions classified as teh Cluster in focus and pass a deep copy of the filtered DATA_OneOOA to DATA_SG (otherwise changes to the columns remain for the rest of the program).  Using DATA_OneOAA and not DATA as having one node to represent all the OOA WardTeams.
+    # For each subgroup (each category of Cluster in turn), find the rows of DATA for just those admissions classified as the Cluster in focus (DATA is not copied or changed).  Using WardTeamOneOOA and not WardTeam as having one node to represent all the OOA WardTeams.
     # 
     # Add the unique numberical ID for for WardTeams included in the subgroup data (running form 1 to n), to be used as the Source and Target node ID in the Edge output file.
     # 
-    # Call the function that calls the 3 functions in turn to output the files fo Gephi for this subgroup.
+    # Add the network to the list of networks to create.
     
     # In[63]:
     
     
-    subgroup_info={"DATA" : DATA_OneOOA.copy(deep = True), #Deep copy. Changing DATA_SG does not change DATA
+    subgroup_info={"DATA" : DATA, #Not a copy. Creating the networks does not change DATA
+                   "WARDTEAM" : 'WardTeamOneOOA',
                    "COLUMN" : 'Cluster',
                    "REPRESENT_REMOVED" : 0,
                    "SUBGROUP_NODE_NAME" :'',
-                   "SUBGROUP_FILENAME" : '_OneOOA_Cluster_'}
-    create_network_data_for_subgroup(subgroup_info,file_output_info)
+                   "SUBGROUP_FILENAME" : '_OneOOA_Cluster_',
+                   "SINGLE_PASS" : 1}
+    networks.append(subgroup_info)
     
     
     # ### Networks 11 to 12. Network for each General Specialty Age (using one OOA node, having a node to represent the other subgroup)
@@ -747,23 +3805,25 @@ if __name__ == '__main__':
     # Choice 1. Option A. Have one node to represent all OOA WardTeams
     # Choice 2. Option B. Represent the other subgroups that are removed with a single node for each subgroup
     # 
-    # For each subgroup (each category of General Specialty Age in turn), pass a deep copy of the DATA_OneOOA to DATA_SG (otherwise changes to the columns remain for the rest of the program).  Using DATA_OneOAA and not DATA as having one node to represent all the OOA WardTeams.
+    # For each subgroup (each category of General Specialty Age in turn), pass DATA (not a copy, the changed columns are held separately for each subgroup so DATA is not changed for the rest of the program).  Using WardTeamOneOOA and not WardTeam as having one node to represent all the OOA WardTeams.
     # 
     # Edit the WardTeam column for the admissions that are not classified as the General Specialty Age category in focus by replacing their WardTeam name with their General Specialty Age category (so as to represent the subgroup data not in focus with a single node for their General Specialty Age category).
     # 
     # Add the unique numberical ID for for WardTeams included in the subgroup data (running form 1 to n), to be used as the Source and Target node ID in the Edge output file.
     # 
-    # Call the function that calls the 3 functions in turn to output the files fo Gephi for this subgroup.
+    # Add the network to the list of networks to create.
     
     # In[64]:
     
     
-    subgroup_info={"DATA" : DATA_OneOOA.copy(deep = True), #Deep copy. Changing DATA_SG does not change DATA
+    subgroup_info={"DATA" : DATA, #Not a copy. Creating the networks does not change DATA
+                   "WARDTEAM" : 'WardTeamOneOOA',
                    "COLUMN" : 'GenSpecialty_Age',
                    "REPRESENT_REMOVED" : 1,
                    "SUBGROUP_NODE_NAME" :'General Specialty',
-                   "SUBGROUP_FILENAME" : '_OneOOA_GenSpecialtyAge_'}
-    create_network_data_for_subgroup(subgroup_info,file_output_info)
+                   "SUBGROUP_FILENAME" : '_OneOOA_GenSpecialtyAge_',
+                   "SINGLE_PASS" : 1}
+    networks.append(subgroup_info)
     
     
     # ### Network 13. Network for the patients that are <20 (Age Group 1) (#using one OOA node)
@@ -771,18 +3831,63 @@ if __name__ == '__main__':
     # Choice 1. Option A. Have one node to represent all OOA WardTeams
     # Choice 2. n/a as keeping all data for each patient together (this subgroup applies to the patient level), or if split, then it will be chronolgical and will then go into the next subgroup age.... no too'ing and fro'ing between subgroups
     # 
-    # For each subgroup (each category of Age Group in turn), filter the DATA_OneOOA for just those admissions classified as the Age Group in focus and pass a deep copy of the filtered DATA_OneOOA to DATA_SG (otherwise changes to the columns remain for the rest of the program).  Using DATA_OneOAA and not DATA as having one node to represent all the OOA WardTeams.
+    # For each subgroup (each category of Age Group in turn), find the rows of DATA for just those admissions classified as the Age Group in focus (DATA is not copied or changed).  Using WardTeamOneOOA and not WardTeam as having one node to represent all the OOA WardTeams.
     # 
     # Add the unique numberical ID for for WardTeams included in the subgroup data (running form 1 to n), to be used as the Source and Target node ID in the Edge output file.
     # 
-    # Call the function that calls the 3 functions in turn to output the files fo Gephi for this subgroup.
+    # Add the network to the list of networks to create.
     
     # In[65]:
     
     
-    subgroup_info={"DATA" : DATA_OneOOA.copy(deep = True), #Deep copy. Changing DATA_SG does not change DATA
+    subgroup_info={"DATA" : DATA, #Not a copy. Creating the networks does not change DATA
+                   "WARDTEAM" : 'WardTeamOneOOA',
                    "COLUMN" : 'AgeAtRefGroup',
                    "REPRESENT_REMOVED" : 0,
                    "SUBGROUP_NODE_NAME" :'',
-                   "SUBGROUP_FILENAME" : '_OneOOA_AgeAtRefGroup_'}
-    create_network_data_for_subgroup(subgroup_info,file_output_info)
+                   "SUBGROUP_FILENAME" : '_OneOOA_AgeAtRefGroup_',
+                   "SINGLE_PASS" : 1}
+    networks.append(subgroup_info)
+    
+    
+    # ### Create the networks
+    # Create the output files for all of the networks listed above (see <em>run_networks()</em>).  Each network, and each category of a subgroup column, is a job.  The jobs are run in a pool of worker processes if file_output_info['WORKERS'] is more than 1.
+    # 
+    # If file_output_info['STREAMING'] is 1 the networks are instead created from the input file in chunks (see <em>create_networks_streaming()</em>).  If file_output_info['DELTA'] is 1 the networks are updated with the new period of referrals in file_output_info['DELTAFILE'] (see <em>update_networks()</em>).  If file_output_info['SHARDS'] is more than 0 the networks are created from partitions of the patients, which can be processed on several hosts (see <em>create_networks_sharded()</em>).  If file_output_info['SNAPSHOTS'] is 'M' or 'Q' the networks are created for each month or quarter (see <em>create_network_snapshots()</em>).
+    # 
+    # Then the networks for any combination of filters (file_output_info['CUBE_QUERIES']) are created from the transition cube of the prepared data (see <em>create_transition_cube()</em>).  The cube is kept in the cache folder, so a run with new queries does not find the transitions again.
+    # 
+    # The same networks can be listed in a spec file instead, and run with <em>Run_PD_networks.py</em> (see <em>P206_networks.json</em>).
+    
+    # In[ ]:
+    
+    
+    memory_report = run_networks(networks, file_output_info, DATA, memory_report)
+    
+    
+    # ### Manifest
+    # Wait for the output files still being written, and write the manifest of the output files of the run (see <em>stop_output_writer()</em>).
+    
+    # In[ ]:
+    
+    
+    stop_output_writer(file_output_info)
+    
+    
+    # ### Memory report
+    # The resident set size (RSS) of the process (or worker process) at the start and end of each job, and the peak RSS while it was created.  Written to the data folder.
+    
+    # In[ ]:
+    
+    
+    write_memory_report(file_output_info, memory_report)
+    
+    
+    # ### Run report
+    # If file_output_info['INSTRUMENT'] is 1, the time, memory, rows, nodes and edges of each stage of the run (see <em>stage()</em>).  Written to the data folder as a csv file and a json file.
+    
+    # In[ ]:
+    
+    
+    if file_output_info['INSTRUMENT']:
+        write_run_report(file_output_info)
@@ -0,0 +1,243 @@
+# coding: utf-8
+
+# # Running the networks listed in a spec file
+
+# ## Overview of the code
+#
+# The networks created by <em>Gephi_Input_files_from_PD_data_v6.py</em> are listed in its main code.  This code instead creates the networks listed in one or more spec files, so a subset of the networks (or a new network) can be run without changing the code.
+#
+# A spec file is a json file (or a toml file, with Python 3.11 or later, or tomli installed) with two entries:
+#
+# 1. "SETTINGS" : the settings that are changed from <em>set_dictionary_for_filenames()</em> (for example {"WORKERS" : 4, "PATHWAYS" : [3]}).  An unknown setting is an error
+# 2. "NETWORKS" : a list of networks, each in the shape of <em>subgroup_info</em> in the main code (WARDTEAM, COLUMN, REPRESENT_REMOVED, SUBGROUP_NODE_NAME, SUBGROUP_FILENAME, and optionally CLIENTID, SINGLE_PASS, RELABEL...) without DATA, with a NAME (SUBGROUP_FILENAME without the underscores if not given) and a DESCRIPTION (optional)
+#
+# <em>P206_networks.json</em> lists the 13 networks of the P206 project, the same as the main code.
+#
+# The spec files are run in turn.  The PD data is prepared (or loaded from the cache) once for each input file, and used by all of the spec files with that input file.  Each spec file has its own output writer, manifest, memory report and run report, as a run of the main code would.
+#
+# Listing the networks (<em>--list</em>) and printing the plan of a run (<em>--dry-run</em>) only read the spec files (and the default settings from the code of the pipeline, without running it), so they do not import pandas and are near-instant.  The pipeline is only imported when the networks are run.
+#
+# Run with the spec files as arguments (<em>P206_networks.json</em> if none are given), for example:
+#
+# <em>python Run_PD_networks.py P206_networks.json --network OneOOA --network "ClientID_*"</em> (only the networks with these names, which can contain the wildcards * and ?)
+#
+# <em>python Run_PD_networks.py P206_networks.json --dry-run</em>
+
+# In[ ]:
+
+import argparse
+import fnmatch
+import json
+import os
+
+
+#The module of the pipeline, in the same folder as this code
+PIPELINE = 'Gephi_Input_files_from_PD_data_v6'
+
+#The keys of a network in a spec file that are not passed to the pipeline
+SPEC_KEYS = ('NAME', 'DESCRIPTION')
+
+#The subgroup_info settings that every network needs
+NETWORK_KEYS = ('WARDTEAM', 'COLUMN', 'REPRESENT_REMOVED', 'SUBGROUP_NODE_NAME', 'SUBGROUP_FILENAME')
+
+
+# ## Function load_spec()
+# Reads a spec file, and checks its networks
+
+# In[ ]:
+
+
+def load_spec(filename):
+    """Reads the spec file filename (json, or toml)
+    Returns a dictionary: FILE (filename), SETTINGS, and NETWORKS (a dictionary per network, each with its NAME)"""
+
+    if filename.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError('A toml spec file needs Python 3.11 or later (or tomli to be installed): ' + filename)
+        with open(filename, 'rb') as specFile:
+            spec = tomllib.load(specFile)
+    else:
+        with open(filename) as specFile:
+            spec = json.load(specFile)
+
+    networks = []
+    for n, network in enumerate(spec.get('NETWORKS', [])):
+        network = dict(network)
+        network.setdefault('NAME', str(network.get('SUBGROUP_FILENAME', n)).strip('_'))
+        missing = [key for key in NETWORK_KEYS if key not in network]
+        if missing:
+            raise ValueError('Network ' + network['NAME'] + ' in ' + filename + ' does not have ' + ', '.join(missing))
+        networks.append(network)
+    names = [network['NAME'] for network in networks]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError('The network names must be different, ' + filename + ' has more than one ' + ', '.join(duplicates))
+    return {'FILE' : filename, 'SETTINGS' : dict(spec.get('SETTINGS', {})), 'NETWORKS' : networks}
+
+
+# ## Function select_networks()
+# Keeps only the networks with the names asked for
+
+# In[ ]:
+
+
+def select_networks(specs, patterns):
+    """Keeps only the networks of the specs (from load_spec()) whose NAME matches one of patterns (names, which can contain
+    the wildcards * and ?), all of the networks if patterns is empty.  A pattern that matches no network is an error
+    Returns the specs that have networks left"""
+
+    if not patterns:
+        return specs
+    unmatched = [pattern for pattern in patterns
+                 if not any(fnmatch.fnmatchcase(network['NAME'], pattern) for spec in specs for network in spec['NETWORKS'])]
+    if unmatched:
+        raise ValueError('No network is named ' + ', '.join(unmatched))
+    selected = []
+    for spec in specs:
+        networks = [network for network in spec['NETWORKS']
+                    if any(fnmatch.fnmatchcase(network['NAME'], pattern) for pattern in patterns)]
+        if networks:
+            selected.append(dict(spec, NETWORKS = networks))
+    return selected
+
+
+# ## Function default_settings()
+# The settings of set_dictionary_for_filenames(), read from the code of the pipeline without running it
+
+# In[ ]:
+
+
+def default_settings():
+    """Returns the settings of set_dictionary_for_filenames() in the pipeline, read from its code without importing it (so
+    without importing pandas)"""
+
+    import ast
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), PIPELINE + '.py')) as code:
+        tree = ast.parse(code.read())
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == 'set_dictionary_for_filenames':
+            for statement in node.body:
+                if isinstance(statement, ast.Assign) and isinstance(statement.value, ast.Dict):
+                    return ast.literal_eval(statement.value)
+    raise ValueError('set_dictionary_for_filenames() was not found in ' + PIPELINE + '.py')
+
+
+# ## Function print_plan()
+# Prints what a run of the specs would do, without running it
+
+# In[ ]:
+
+
+def print_plan(specs, listOnly = False):
+    """Prints the networks of each spec (only their names and descriptions if listOnly), and for a dry run the input file,
+    how the networks are created, the settings changed and the output files of each network"""
+
+    defaults = default_settings() if not listOnly else {}
+    inputFiles = {}
+    for spec in specs:
+        print(spec['FILE'] + ': ' + str(len(spec['NETWORKS'])) + ' networks')
+        if not listOnly:
+            file_output_info = dict(defaults, **spec['SETTINGS'])
+            inputFile = file_output_info['FOLDER'] + str(file_output_info['FILESTART']) + '.csv'
+            size = '%.1f MB' % (os.path.getsize(inputFile) / 1e6) if os.path.exists(inputFile) else 'not found'
+            if file_output_info['DELTA']:
+                mode = 'updated with ' + str(file_output_info['DELTAFILE'] or 'no new period') + ' (delta mode)'
+            elif file_output_info['SHARDS']:
+                mode = 'from ' + str(file_output_info['SHARDS']) + ' partitions, step ' + str(file_output_info['SHARD_STEP'])
+            elif file_output_info['STREAMING']:
+                mode = 'from the input file in chunks of ' + str(file_output_info['CHUNKSIZE']) + ' rows'
+            elif file_output_info['SNAPSHOTS']:
+                mode = 'for each time window (' + str(file_output_info['SNAPSHOTS']) + ')'
+            else:
+                mode = 'in memory, from the prepared data' + (' (prepared once, for this and the specs before it)'
+                                                              if inputFile in inputFiles else '')
+                inputFiles[inputFile] = True
+            print('  Input file: ' + inputFile + ' (' + size + ')')
+            print('  Created: ' + mode + ', in ' + str(file_output_info['WORKERS']) + ' processes')
+            unknown = [key for key in spec['SETTINGS'] if key not in defaults]
+            for key, value in sorted(spec['SETTINGS'].items()):
+                print('  Setting: ' + key + ' = ' + repr(value) + (' (unknown setting)' if key in unknown else ''))
+        for network in spec['NETWORKS']:
+            print('  ' + network['NAME'] + (': ' + network['DESCRIPTION'] if network.get('DESCRIPTION') else ''))
+            if not listOnly:
+                if 'CLIENTID' in network:
+                    rows = 'patient ' + str(network['CLIENTID'])
+                elif network['COLUMN'] == '':
+                    rows = 'all of the data'
+                else:
+                    rows = 'each category of ' + network['COLUMN'] + (' (a node for each of the other categories)'
+                                                                      if network['REPRESENT_REMOVED'] else '')
+                print('    ' + rows + ', nodes ' + network['WARDTEAM'] + ', output files ' + file_output_info['FOLDER'] +
+                      str(file_output_info['FILESTART']) + network['SUBGROUP_FILENAME'] + '*')
+    return
+
+
+# ## Function run_specs()
+# Creates the networks of each spec, preparing the PD data once for each input file
+
+# In[ ]:
+
+
+def run_specs(specs):
+    """Creates the output files for the networks of each spec (from load_spec()), in turn, as the main code of the pipeline
+    does.  The PD data is prepared once for each input file, and used by every spec with that input file"""
+
+    import importlib
+    pipeline = importlib.import_module(PIPELINE)
+
+    preparedData = {}
+    for spec in specs:
+        file_output_info = pipeline.set_dictionary_for_filenames()
+        unknown = [key for key in spec['SETTINGS'] if key not in file_output_info]
+        if unknown:
+            raise ValueError('Unknown setting in ' + spec['FILE'] + ': ' + ', '.join(unknown))
+        file_output_info.update(spec['SETTINGS'])
+        pipeline.check_output_formats(file_output_info)
+        if file_output_info['INSTRUMENT']:
+            pipeline.start_instrumentation()
+        pipeline.start_output_writer(file_output_info)
+
+        memory_report = []
+        DATA = None #The data is read in chunks (or only the new period, or a partition) when the networks are created
+        if not (file_output_info['STREAMING'] or file_output_info['DELTA'] or file_output_info['SHARDS']):
+            inputFile = os.path.abspath(file_output_info['FOLDER'] + str(file_output_info['FILESTART']) + '.csv')
+            if inputFile not in preparedData:
+                pipeline.start_memory_report(memory_report, 'Read and prepare the data')
+                preparedData[inputFile] = pipeline.load_prepared_data(file_output_info)
+                pipeline.end_memory_report(memory_report)
+            DATA = preparedData[inputFile]
+            file_output_info = pipeline.create_node_registry(file_output_info, DATA)
+
+        networks = [dict({key : value for key, value in network.items() if key not in SPEC_KEYS}, DATA = DATA)
+                    for network in spec['NETWORKS']]
+        memory_report = pipeline.run_networks(networks, file_output_info, DATA, memory_report)
+        pipeline.stop_output_writer(file_output_info)
+        pipeline.write_memory_report(file_output_info, memory_report)
+        if file_output_info['INSTRUMENT']:
+            pipeline.write_run_report(file_output_info)
+            pipeline.stop_instrumentation()
+    return
+
+
+# In[ ]:
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Creates the Gephi input files for the networks listed in spec files')
+    parser.add_argument('specs', nargs = '*', default = ['P206_networks.json'], help = 'the spec files (json or toml)')
+    parser.add_argument('--network', action = 'append', default = [], metavar = 'NAME',
+                        help = 'only create the networks with this name (can contain * and ?, and can be given more than once)')
+    parser.add_argument('--list', action = 'store_true', help = 'list the networks, and stop')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'print what would be run, and stop')
+    arguments = parser.parse_args()
+
+    specs = select_networks([load_spec(filename) for filename in arguments.specs], arguments.network)
+    if arguments.list or arguments.dry_run:
+        print_plan(specs, listOnly = arguments.list)
+    else:
+        run_specs(specs)